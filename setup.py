@@ -1,5 +1,11 @@
+import sys
+
 from setuptools import setup, find_packages
 
+install_requires = ['jinja2==2.7.3']
+if sys.version_info[0] == 2:
+    install_requires.append('futures')
+
 setup(
     name='vdist',
     version='0.6',
@@ -12,7 +18,7 @@ setup(
     license='MIT',
     url='https://github.com/dante-signal31/vdist',
     packages=find_packages(),
-    install_requires=['jinja2==2.7.3'],
+    install_requires=install_requires,
     package_data={'': ['internal_profiles.json', '*.sh']},
     tests_require=['pytest'],
     classifiers=[
@@ -0,0 +1,133 @@
+import os
+import sys
+
+import pytest
+
+if sys.version_info < (3, 7):
+    pytest.skip('the asyncio build engine needs Python 3.7',
+                allow_module_level=True)
+
+import asyncio
+
+from vdist import asyncbuild
+from vdist.asyncbuild import AsyncBuildMachine
+from vdist.builder import BuildResult
+from vdist.endpoints import Endpoint
+
+from test_builder_setup import _fake_builder
+
+
+class FakeAsyncBuildMachine(object):
+    # stands in for AsyncBuildMachine, like FakeBuildMachine does for
+    # BuildMachine
+    instances = []
+
+    def __init__(self, machine_logs=True, image=None,
+                 insecure_registry=False, **kwargs):
+        self.image = image
+        self.phases = {}
+        self.slimmed = {}
+        self.log_tail = []
+        self.shut_down = False
+        self.remote = False
+        FakeAsyncBuildMachine.instances.append(self)
+
+    def launch(self, build_dir, extra_binds=None):
+        if self.image == 'fails':
+            return asyncio.sleep(0.1, result=2)
+        if self.image == 'hangs':
+            return asyncio.sleep(10, result=137)
+        with open(os.path.join(build_dir, 'myapp-1.0.deb'), 'w') as f:
+            f.write('package')
+        return asyncio.sleep(0, result=0)
+
+    def image_id(self, image=None):
+        return asyncio.sleep(0, result='sha256:%s' % (image or self.image))
+
+    def shutdown(self):
+        self.shut_down = True
+        return asyncio.sleep(0)
+
+
+def _fake_async_builder(tmpdir, monkeypatch, images, **kwargs):
+    monkeypatch.setattr(asyncbuild, 'AsyncBuildMachine',
+                        FakeAsyncBuildMachine)
+    FakeAsyncBuildMachine.instances = []
+    return _fake_builder(tmpdir, monkeypatch, images, **kwargs)
+
+
+def test_build_async_returns_results(tmpdir, monkeypatch):
+    b = _fake_async_builder(tmpdir, monkeypatch, ['works', 'fails'])
+
+    results = asyncio.run(b.build_async())
+
+    assert [r.build for r in results] == b.builds
+    assert [r.status for r in results] == [BuildResult.SUCCEEDED,
+                                           BuildResult.FAILED]
+    assert [os.path.basename(a) for a in results[0].artifacts] == \
+        ['myapp-1.0.deb']
+    assert all(m.shut_down for m in FakeAsyncBuildMachine.instances)
+
+
+def test_build_async_fail_fast_cancels_siblings(tmpdir, monkeypatch):
+    b = _fake_async_builder(tmpdir, monkeypatch, ['hangs', 'fails', 'works'],
+                            max_workers=2, fail_fast=True)
+
+    results = asyncio.run(asyncio.wait_for(b.build_async(), 5))
+
+    assert [r.status for r in results] == [
+        BuildResult.CANCELLED, BuildResult.FAILED, BuildResult.CANCELLED]
+    # the third build never got a build machine, the hanging one was
+    # shut down
+    assert len(FakeAsyncBuildMachine.instances) == 2
+    assert FakeAsyncBuildMachine.instances[0].shut_down
+
+
+def test_build_async_rejects_endpoints(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['works'],
+                      endpoints=[Endpoint(capacity=4)])
+
+    with pytest.raises(ValueError):
+        asyncio.run(b.build_async())
+    with pytest.raises(ValueError):
+        asyncio.run(b.run_build_async(b.builds[0]))
+
+
+def test_async_run_cli_streams_output():
+    script = ('for i in $(seq 2000); do echo "error $i: %s" >&2; done; '
+              'echo out; echo done' % ('x' * 100))
+
+    build_machine = AsyncBuildMachine()
+    exit_code, output = asyncio.run(
+        build_machine._run_cli(['bash', '-c', script], capture_output=True))
+
+    assert exit_code == 0
+    assert output == 'out\ndone\n'
+
+
+def test_async_build_machine_writes_build_log(tmpdir):
+    build_machine = AsyncBuildMachine()
+
+    async def run():
+        await build_machine._open_log(str(tmpdir))
+        try:
+            await build_machine._run_cli(['seq', '1', '5000'])
+        finally:
+            await build_machine._close_log()
+
+    asyncio.run(run())
+
+    log_file = tmpdir.join('scratch', 'build.log')
+    assert log_file.readlines()[-1] == '5000\n'
+    assert len(log_file.readlines()) == 5000
+    assert build_machine.log_tail[-1] == '5000'
+    assert build_machine.log is None
+
+
+def test_async_run_cli_cancellation_kills_command():
+    async_machine = AsyncBuildMachine()
+    run = asyncio.wait_for(
+        async_machine._run_cli(['sleep', '10']), 0.5)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run)
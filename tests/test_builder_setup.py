@@ -1,17 +1,28 @@
+import os
+import subprocess
+import threading
+
 import pytest
 
-from vdist.builder import Builder, NoBuildsFoundException
+from vdist import builder as builder_module
+from vdist.cache import ArtifactCache
+from vdist.mirrors import GitMirrors
+from vdist.builder import Build, Builder, BuildProfile, BuildResult, \
+    NoBuildsFoundException
+from vdist.buildmachine import DockerHostException
+from vdist.scheduler import BuildDurations
+from vdist.source import git, directory
 
 
-def test_builder_nobuilds():
-    b = Builder()
+def test_builder_nobuilds(tmpdir, monkeypatch):
+    b = _builder(tmpdir, monkeypatch)
 
     with pytest.raises(NoBuildsFoundException):
         b.build()
 
 
-def test_internal_profile_loads():
-    b = Builder()
+def test_internal_profile_loads(tmpdir, monkeypatch):
+    b = _builder(tmpdir, monkeypatch)
 
     profiles = b.get_available_profiles()
 
@@ -19,3 +30,857 @@ def test_internal_profile_loads():
 
     for profile_id in internal_profile_ids:
         assert profile_id in profiles
+
+
+@pytest.mark.parametrize('profile_id', ['ubuntu-trusty', 'centos6',
+                                        'centos7'])
+def test_rendered_script_has_phase_markers(tmpdir, monkeypatch, profile_id):
+    b = _builder(tmpdir, monkeypatch)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'))
+
+    script = b._render_template(b.builds[0])
+
+    for phase in ['provision', 'compile_python', 'fetch_source',
+                  'install_requirements', 'package']:
+        assert 'vdist_phase start %s' % phase in script
+        assert 'vdist_phase end %s' % phase in script
+
+
+class FakeBuildMachine(object):
+    # stands in for BuildMachine; the profile's image name decides how
+    # the build script "exits"
+    instances = []
+
+    def __init__(self, machine_logs=True, image=None,
+                 insecure_registry=False, **kwargs):
+        self.image = image
+        self.kwargs = kwargs
+        self.committed = None
+        self.phases = {}
+        self.slimmed = {}
+        self.log_tail = []
+        self.launched = False
+        self.remote = kwargs.get('remote', False)
+        self.pool = kwargs.get('pool')
+        self.stopped = threading.Event()
+        FakeBuildMachine.instances.append(self)
+
+    def launch(self, build_dir, extra_binds=None):
+        self.launched = True
+        self.build_dir = build_dir
+        self.extra_binds = extra_binds
+        if self.image == 'fails':
+            self.log_tail = ['error: it broke']
+            build_dir = os.path.join(build_dir, 'scratch')
+            with open(os.path.join(build_dir, 'build.log'), 'w') as f:
+                f.write('building\nerror: it broke\n')
+            return 2
+        if self.image == 'breaks':
+            build_dir = os.path.join(build_dir, 'scratch')
+            with open(os.path.join(build_dir, 'build.log'), 'w') as f:
+                f.write('building\n')
+            raise DockerHostException('docker daemon went away')
+        if self.image == 'hangs':
+            self.stopped.wait(10)
+            return 137
+        with open(os.path.join(build_dir, 'myapp-1.0.deb'), 'w') as f:
+            f.write('package')
+        return 0
+
+    def image_id(self, image=None):
+        return 'sha256:%s' % (image or self.image)
+
+    def commit(self, tag):
+        self.committed = tag
+
+    def shutdown(self):
+        self.stopped.set()
+
+
+def _builder(tmpdir, monkeypatch, **kwargs):
+    # a Builder keeping everything it writes in tmpdir instead of ~/.vdist
+    monkeypatch.setenv('HOME', str(tmpdir))
+    b = Builder(**kwargs)
+    b.build_basedir = str(tmpdir.join('dist'))
+    b.durations = BuildDurations(path=str(tmpdir.join('durations.json')))
+    b.cache = ArtifactCache(path=str(tmpdir.join('cache')))
+    b.python_cache_dir = str(tmpdir.join('cache', 'python'))
+    b.prewarm_basedir = str(tmpdir.join('prewarm'))
+    b.wheelhouse_dir = str(tmpdir.join('cache', 'wheels'))
+    b.package_cache_dir = str(tmpdir.join('cache', 'packages'))
+    b.ccache_dir = str(tmpdir.join('cache', 'ccache'))
+    b.template_cache_dir = str(tmpdir.join('cache', 'templates'))
+    if b.git_mirrors is not None:
+        b.git_mirrors = GitMirrors(path=str(tmpdir.join('cache', 'git')))
+    return b
+
+
+def _fake_builder(tmpdir, monkeypatch, images, source=None, build_deps=None,
+                  **kwargs):
+    monkeypatch.setattr(builder_module, 'BuildMachine', FakeBuildMachine)
+    FakeBuildMachine.instances = []
+
+    b = _builder(tmpdir, monkeypatch, **kwargs)
+    b.git_mirrors = None
+    if source is None:
+        source = git(uri='https://github.com/objectified/vdist')
+    b._load_profiles()
+    for image in images:
+        b.profiles[image] = BuildProfile(
+            profile_id=image, docker_image=image, script='debian.sh')
+        b.add_build(app='myapp', version='1.0', profile=image,
+                    source=source, build_deps=build_deps)
+    monkeypatch.setattr(b, '_load_profiles', lambda: None)
+    return b
+
+
+def test_builder_returns_results(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['works', 'fails'])
+
+    results = b.build()
+
+    assert [r.build for r in results] == b.builds
+    assert results[0].status == BuildResult.SUCCEEDED
+    assert results[0].exit_code == 0
+    assert results[0].duration >= 0
+    assert [os.path.basename(a) for a in results[0].artifacts] == \
+        ['myapp-1.0.deb']
+    assert results[1].status == BuildResult.FAILED
+    assert results[1].exit_code == 2
+
+
+def test_builder_fail_fast_tears_down_siblings(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['hangs', 'fails', 'works'],
+                      max_workers=2, fail_fast=True)
+
+    results = b.build()
+
+    assert [r.status for r in results] == [
+        BuildResult.CANCELLED, BuildResult.FAILED, BuildResult.CANCELLED]
+    # the third build never got a build machine
+    assert len(FakeBuildMachine.instances) == 2
+
+
+def test_builder_cache_skips_unchanged_builds(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works'], use_cache=True,
+                      source=directory(path=str(project)))
+    result = b.build()[0]
+    assert not result.cached
+    assert len([m for m in FakeBuildMachine.instances if m.launched]) == 1
+
+    FakeBuildMachine.instances = []
+    result = b.build()[0]
+    assert result.succeeded
+    assert result.cached
+    assert [os.path.basename(a) for a in result.artifacts] == \
+        ['myapp-1.0.deb']
+    assert not any(m.launched for m in FakeBuildMachine.instances)
+
+    # changing the source invalidates the cached packages
+    project.join('setup.py').write('# changed setup')
+    result = b.build()[0]
+    assert not result.cached
+
+
+def test_builder_mounts_source_read_only(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+    project.join('.vdistignore').write('node_modules/\n')
+    project.mkdir('node_modules').join('big.js').write('')
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works'], stage_sources='mount',
+                      source=directory(path=str(project)))
+    result = b.build()[0]
+
+    binds = FakeBuildMachine.instances[0].extra_binds
+    assert binds[str(project)] == '/vdist-source/myapp:ro'
+    source_dir = [d for d, m in binds.items() if m == '/vdist-source:ro'][0]
+    assert sorted(os.listdir(source_dir)) == ['myapp', 'source-files']
+    with open(os.path.join(source_dir, 'source-files')) as f:
+        assert f.read().split('\0') == ['myapp/.vdistignore',
+                                        'myapp/setup.py', '']
+    scratch_dir = os.path.join(result.build_dir, 'scratch')
+    with open(os.path.join(scratch_dir, 'buildscript.sh')) as f:
+        copy = [l.strip() for l in f
+                if 'tar -C /vdist-source --null -T' in l][0]
+
+    # a copy failing halfway stops the build script
+    mount = tmpdir.mkdir('mount')
+    mount.mkdir('myapp').join('setup.py').write('# setup')
+    mount.join('source-files').write('myapp/setup.py\0myapp/gone.py\0')
+    target = tmpdir.mkdir('target')
+    script = 'set -e\n%s\necho copied\n' % copy.replace('/vdist-source',
+                                                         str(mount))
+    p = subprocess.Popen(['bash', '-c', script], cwd=str(target),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = p.communicate()
+    assert p.returncode != 0
+    assert b'copied' not in out
+
+
+@pytest.mark.parametrize('stage_sources', ['copy', 'link', 'mount'])
+def test_staged_directory_sources_keep_git(tmpdir, monkeypatch,
+                                           stage_sources):
+    # projects taking their version from git (setuptools_scm, pbr) read
+    # .git in the install step
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+    for args in [['init', '-q'], ['config', 'user.email', 'vdist@example.com'],
+                 ['config', 'user.name', 'vdist'], ['add', '.'],
+                 ['commit', '-q', '-m', 'release'], ['tag', 'v1.0']]:
+        subprocess.check_call(['git', '-C', str(project)] + args)
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works'],
+                      stage_sources=stage_sources,
+                      source=directory(path=str(project)))
+    result = b.build()[0]
+
+    binds = FakeBuildMachine.instances[0].extra_binds
+    mount = [d for d, m in binds.items() if m == '/vdist-source:ro'][0]
+    if stage_sources == 'mount':
+        # what the build machine sees at /vdist-source
+        os.rmdir(os.path.join(mount, 'myapp'))
+        os.symlink(str(project), os.path.join(mount, 'myapp'))
+    scratch_dir = os.path.join(result.build_dir, 'scratch')
+    with open(os.path.join(scratch_dir, 'buildscript.sh')) as f:
+        copy = [l.strip() for l in f
+                if l.strip().startswith(('cp -r /vdist-source/',
+                                         '(set -o pipefail; tar -C'))][0]
+    target = tmpdir.mkdir('target')
+    script = 'set -e\n%s\ncd myapp\ngit describe --tags\n' % \
+        copy.replace('/vdist-source', mount)
+    p = subprocess.Popen(['bash', '-c', script], cwd=str(target),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    assert p.returncode == 0, err
+    assert out.strip() == b'v1.0'
+
+
+def test_builder_shares_sources_between_builds(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works', 'works2', 'works3'],
+                      source=directory(path=str(project)))
+    b.build()
+
+    source_dirs = set(d for m in FakeBuildMachine.instances
+                      for d, v in m.extra_binds.items()
+                      if v == '/vdist-source:ro')
+    assert len(source_dirs) == 1
+    source_dir = source_dirs.pop()
+    assert os.path.isfile(os.path.join(source_dir, 'myapp', 'setup.py'))
+    assert os.listdir(os.path.dirname(source_dir)) == \
+        [os.path.basename(source_dir)]
+
+
+def test_pooled_builds_see_shared_sources_read_only(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+    b = _fake_builder(tmpdir, monkeypatch, ['works'], pool_size=1,
+                      source=directory(path=str(project)))
+
+    def launched():
+        result = b.build()[0]
+        machine = [m for m in FakeBuildMachine.instances if m.launched][-1]
+        script = os.path.join(result.build_dir, 'scratch', 'buildscript.sh')
+        with open(script) as f:
+            return machine.extra_binds, f.read()
+
+    binds, script = launched()
+
+    # the dir of all shared sources, which outlives the sources staged in
+    # it, instead of a bind of their own, which the next run would not
+    # match; and the same script, and cache key, on every run
+    sources_dir = os.path.join(b.build_basedir, '.sources')
+    assert binds[sources_dir] == '/vdist-sources:ro'
+    assert not [d for d, m in binds.items()
+                if m.startswith('/vdist-source') and d != sources_dir]
+    assert launched()[1] == script
+    staged = [l.split()[2] for l in script.splitlines()
+              if l.strip().startswith('cp -r /vdist-sources/')][0]
+    host_path = os.path.join(
+        sources_dir, os.path.relpath(staged, '/vdist-sources'))
+    assert os.path.isfile(os.path.join(host_path, 'setup.py'))
+
+
+def test_builder_prewarm_commits_image_per_profile(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['works'])
+    b.add_build(app='otherapp', version='2.0', profile='works',
+                source=git(uri='https://github.com/objectified/vdist'))
+    b.add_build(app='thirdapp', version='2.0', profile='works',
+                source=git(uri='https://github.com/objectified/vdist'),
+                build_deps=['libpq-dev'])
+
+    images = b.prewarm()
+
+    assert len(images) == 2
+    assert all(i.startswith('vdist-prewarmed/works:') for i in images)
+    assert sorted(m.committed for m in FakeBuildMachine.instances) == \
+        sorted(images)
+
+    # builds start from the matching prewarmed image
+    FakeBuildMachine.instances = []
+    b.build()
+    assert sorted(m.kwargs['prewarmed_image']
+                  for m in FakeBuildMachine.instances) == \
+        sorted([images[0], images[0], images[1]])
+
+
+def test_rendered_script_skips_provisioning_when_prewarmed(tmpdir,
+                                                           monkeypatch):
+    b = _builder(tmpdir, monkeypatch)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=git(uri='https://github.com/objectified/vdist'))
+
+    script = b._render_template(b.builds[0], provision_key='abc',
+                                provision_only=True)
+
+    assert '"$(cat /etc/vdist-provisioned)" = "abc"' in script
+    assert 'echo "abc" > /etc/vdist-provisioned' in script
+
+
+@pytest.mark.parametrize('profile_id', ['centos6', 'centos7'])
+def test_rendered_script_skips_recent_system_update(tmpdir, monkeypatch,
+                                                    profile_id):
+    b = _builder(tmpdir, monkeypatch, system_update_interval=12)
+    b.package_cache_dir = str(tmpdir)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'))
+
+    context = {}
+    b._prepare_package_cache(b.builds[0], context, {})
+    script = b._render_template(b.builds[0], **context)
+
+    assert 'find /vdist-cache/packages/last-update -mmin -720' in script
+    assert '$YUM makecache' in script
+    assert 'YUM=vdist_yum' in script
+    assert 'VDIST_PACKAGE_CACHE=/vdist-cache/packages' in script
+
+
+def test_builder_plan_renders_and_fingerprints(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works', 'works2'],
+                      source=directory(path=str(project)))
+    plans = b.plan()
+
+    assert all(plan.valid for plan in plans)
+    assert plans[0].image == 'works'
+    assert plans[0].source_fingerprint == plans[1].source_fingerprint
+    assert plans[0].source_fingerprint.startswith('tree:')
+    assert 'cp -r /vdist-source/myapp .' in plans[0].script
+    assert len(plans[0].script_digest) == 64
+    assert not any(m.launched for m in FakeBuildMachine.instances)
+    # a plan doesn't create the caches the builds would use
+    for path in [b.python_cache_dir, b.wheelhouse_dir, b.package_cache_dir]:
+        assert not os.path.exists(path)
+
+
+def test_builder_plan_reports_errors(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    profiles_dir = tmpdir.mkdir('buildprofiles')
+    profiles_dir.join('typo.sh').write('echo {{ap}} {{version}}')
+
+    b = _fake_builder(tmpdir, monkeypatch, [],
+                      source=directory(path=str(project)),
+                      profiles_dir=str(profiles_dir))
+    b.profiles['typo'] = BuildProfile(
+        profile_id='typo', docker_image='typo', script='typo.sh')
+    source = directory(path=str(project))
+    b.add_build(app='myapp', version='1.0', profile='typo', source=source)
+    b.add_build(app='myapp', version='1.0', profile='missing', source=source)
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=source, working_dir='src')
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=directory(path=str(tmpdir.join('nonexisting'))))
+
+    plans = b.plan()
+
+    assert plans[0].errors == ['undefined variables in build script: ap']
+    assert plans[0].script == 'echo  1.0'
+    assert plans[1].errors == ['profile not found: missing']
+    assert plans[2].errors == [
+        'working_dir src not found in: %s' % project,
+        '2 builds share build dir: myapp-1.0-ubuntu-trusty']
+    assert plans[3].errors[0].startswith('could not fingerprint source')
+
+
+def test_builder_keeps_build_dirs_of_earlier_runs(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['works'])
+    first = b.build()[0]
+    assert first.build_dir == str(tmpdir.join('dist', 'myapp-1.0-works'))
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works2'])
+    b.build()
+    assert [os.path.basename(a) for a in first.collect_artifacts()] == \
+        ['myapp-1.0.deb']
+
+    # a failing build doesn't replace the packages of the last good one
+    b = _fake_builder(tmpdir, monkeypatch, ['works'])
+    b.profiles['works'].docker_image = 'fails'
+    result = b.build()[0]
+    assert result.build_dir == first.build_dir + '.failed'
+    assert os.path.isfile(os.path.join(first.build_dir, 'myapp-1.0.deb'))
+
+
+def test_builder_keeps_build_dirs_of_broken_off_builds(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['breaks'])
+
+    result = b.build()[0]
+
+    assert result.status == BuildResult.FAILED
+    assert isinstance(result.error, DockerHostException)
+    assert result.build_dir == str(tmpdir.join('dist', 'myapp-1.0-breaks')) \
+        + '.failed'
+    assert result.log_file == os.path.join(result.build_dir, 'scratch',
+                                           'build.log')
+    assert os.listdir(b.build_basedir) == ['myapp-1.0-breaks.failed']
+
+
+def test_builder_only_rebuilds_changed_builds(tmpdir, monkeypatch):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+
+    b = _fake_builder(tmpdir, monkeypatch, ['works'], only_changed=True,
+                      source=directory(path=str(project)))
+    assert not b.build()[0].unchanged
+
+    FakeBuildMachine.instances = []
+    result = b.build()[0]
+    assert result.succeeded
+    assert result.unchanged
+    assert [os.path.basename(a) for a in result.artifacts] == \
+        ['myapp-1.0.deb']
+    assert not any(m.launched for m in FakeBuildMachine.instances)
+    # nor was the source staged for it
+    assert not os.listdir(os.path.join(b.build_basedir, '.sources'))
+
+    project.join('setup.py').write('# changed setup')
+    assert not b.build()[0].unchanged
+    assert FakeBuildMachine.instances[-1].launched
+
+
+def _stage_launches(stage):
+    return [m for m in FakeBuildMachine.instances
+            if getattr(m, 'build_dir', None) and
+            os.path.basename(m.build_dir).startswith(stage + '-')]
+
+
+def test_builder_shares_stages_across_matrix(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, [], share_stages=True,
+                      cache_python=True)
+    b.profiles['works'] = BuildProfile(
+        profile_id='works', docker_image='works', script='debian.sh')
+    source = git(uri='https://github.com/objectified/vdist')
+    b.add_matrix(['works'], [dict(app='myapp', version='1.0', source=source),
+                             dict(app='other', version='2.0', source=source)],
+                 python_versions=['2.7.11', '3.5.1'])
+
+    results = b.build()
+
+    assert [r.build.python_version for r in results] == \
+        ['2.7.11', '3.5.1', '2.7.11', '3.5.1']
+    assert [r.build.variant for r in results] == \
+        ['python2.7.11', 'python3.5.1'] * 2
+    assert all(r.status == BuildResult.SUCCEEDED for r in results)
+    assert len(set(r.build_dir for r in results)) == 4
+    # one interpreter per Python version, not per build
+    assert len(_stage_launches('compile_python')) == 2
+
+
+def test_builder_fails_builds_of_failed_shared_stage(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, [], share_stages=True,
+                      cache_python=True)
+    b.profiles['fails'] = BuildProfile(
+        profile_id='fails', docker_image='fails', script='debian.sh')
+    b.add_matrix(['fails'], [
+        dict(app='myapp', version='1.0',
+             source=git(uri='https://github.com/objectified/vdist')),
+        dict(app='other', version='1.0',
+             source=git(uri='https://github.com/objectified/vdist'))])
+
+    results = b.build()
+
+    assert [r.status for r in results] == [BuildResult.FAILED] * 2
+    assert all(r.error is not None for r in results)
+    # the interpreter stage failed once, the builds never started
+    assert len([m for m in FakeBuildMachine.instances if m.launched]) == 1
+
+
+def test_builder_shares_interpreters_by_cache_key(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, [], share_stages=True,
+                      cache_python=True)
+    b.profiles['works'] = BuildProfile(
+        profile_id='works', docker_image='works', script='debian.sh')
+    source = git(uri='https://github.com/objectified/vdist')
+    for build_deps, optimize_python in [([], False), (['libssl-dev'], False),
+                                        ([], True)]:
+        b.add_build(app='myapp', version='1.0', profile='works',
+                    source=source, build_deps=build_deps,
+                    python_version='3.6.8', optimize_python=optimize_python,
+                    variant='%s-%s' % (len(build_deps), optimize_python))
+    b.add_build(app='myapp', version='1.0', profile='missing',
+                source=source)
+
+    results = b.build()
+
+    assert [r.status for r in results] == [BuildResult.SUCCEEDED] * 3 + \
+        [BuildResult.FAILED]
+    assert results[3].error is not None
+    # build dependencies don't change the interpreter, optimizing it does
+    assert len(_stage_launches('compile_python')) == 2
+
+
+def test_builds_wait_for_their_own_provisioning(tmpdir, monkeypatch):
+    b = _builder(tmpdir, monkeypatch, share_stages=True, cache_python=True,
+                 cache_wheels=False)
+    b._load_profiles()
+    source = git(uri='https://github.com/objectified/vdist')
+    for build_deps in [[], ['libpq-devel']]:
+        b.add_build(app='myapp', version='1.0', profile='centos7',
+                    source=source, build_deps=build_deps,
+                    variant=str(len(build_deps)))
+
+    graph, build_stages = b._stage_graph()
+
+    provisions = [k for k in graph.stages if k[0] == 'provision']
+    compiles = [k for k in graph.stages if k[0] == 'compile_python']
+    assert len(provisions) == 2
+    # the interpreter is shared, each build still waits for its own image
+    assert len(compiles) == 1
+    assert graph.stages[compiles[0]][1] == [provisions[0]]
+    dependencies = sorted(tuple(graph.stages[key][1])
+                          for _, key in build_stages)
+    assert dependencies == sorted((provision, compiles[0])
+                                  for provision in provisions)
+
+
+def test_stage_graph_fetches_git_sources_concurrently(tmpdir, monkeypatch):
+    b = _builder(tmpdir, monkeypatch, share_stages=True, max_workers=2)
+    b._load_profiles()
+    b.git_mirrors = GitMirrors(path=str(tmpdir.join('cache', 'git')))
+    # fails when the mirrors are fetched one after another
+    both_fetching = threading.Barrier(2, timeout=5)
+
+    def resolve(uri, ref):
+        both_fetching.wait()
+        return '0' * 40
+
+    monkeypatch.setattr(b.git_mirrors, 'resolve', resolve)
+    monkeypatch.setattr(b.git_mirrors, 'read',
+                        lambda uri, commit, path: b'requests\n')
+    for name in ['a', 'b']:
+        b.add_build(app='myapp', version='1.0', profile='centos7',
+                    source=git(uri='https://example.com/%s' % name),
+                    variant=name)
+
+    graph, build_stages = b._stage_graph()
+
+    # the same requirements, installed once
+    assert len([k for k in graph.stages
+                if k[0] == 'install_requirements']) == 1
+
+
+def test_builder_splits_host_resources(tmpdir, monkeypatch):
+    monkeypatch.setattr(builder_module, 'host_resources',
+                        lambda: (8.0, 4096))
+    b = _fake_builder(tmpdir, monkeypatch, ['works', 'works2'],
+                      max_workers=2, limit_resources=True)
+
+    b.build()
+
+    assert [(m.kwargs['cpus'], m.kwargs['memory'], m.kwargs['jobs'])
+            for m in FakeBuildMachine.instances] == [(4.0, 2048, 4)] * 2
+
+    # the share is worked out when a build starts, so the last build of a
+    # run gets the whole host
+    b.unfinished_builds = 1
+    assert b._build_resources() == (8.0, 4096)
+    b.unfinished_builds = 5
+    assert b._build_resources() == (4.0, 2048)
+
+
+@pytest.mark.parametrize('profile_id', ['ubuntu-trusty', 'centos6',
+                                        'centos7'])
+def test_rendered_script_compiles_through_ccache(tmpdir, monkeypatch,
+                                                 profile_id):
+    b = _builder(tmpdir, monkeypatch, cache_compiler=True)
+    b.ccache_dir = str(tmpdir)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'),
+                python_version='3.6.8', optimize_python=True)
+
+    binds = {}
+    context = {}
+    b._prepare_ccache(b.builds[0], context, binds)
+    script = b._render_template(b.builds[0], **context)
+
+    assert binds == {str(tmpdir.join(profile_id)): '/vdist-cache/ccache'}
+    assert 'export CCACHE_DIR=/vdist-cache/ccache' in script
+    assert 'export CC=' not in script
+    # before Python gets compiled
+    assert script.index('export PATH=$VDIST_CCACHE_LINKS:$PATH') < \
+        script.index('vdist_phase start compile_python')
+    assert 'PYTHON_CONFIGURE_FLAGS+=(--enable-optimizations --with-lto)' \
+        in script
+
+
+def test_ccache_leaves_cc_unset_for_configure(tmpdir, monkeypatch):
+    b = _builder(tmpdir, monkeypatch)
+    block = b._template_environment().get_template('ccache.sh').render(
+        ccache_dir=str(tmpdir.mkdir('ccache')), ccache_max_size='5G',
+        local_uid=os.getuid(), local_gid=os.getgid())
+    bin_dir = tmpdir.mkdir('bin')
+    bin_dir.join('ccache').write('#!/bin/sh\n')
+    bin_dir.join('ccache').chmod(0o755)
+
+    script = ('set -e\nunset CC CXX\nvdist_install() { false; }\n%s\n'
+              'echo "CC=${CC-unset} CXX=${CXX-unset}"\n'
+              'readlink $(command -v gcc)\n' % block)
+    env = dict(os.environ, PATH='%s:%s' % (bin_dir, os.environ['PATH']))
+    p = subprocess.Popen(['bash', '-c', script], env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    assert p.returncode == 0, err
+    # configure finds gcc through ccache, and writes plain gcc into the
+    # sysconfig of the packaged Python
+    assert out.decode().splitlines() == ['CC=unset CXX=unset',
+                                         str(bin_dir.join('ccache'))]
+
+
+@pytest.mark.parametrize('profile_id', ['ubuntu-trusty', 'centos6',
+                                        'centos7'])
+def test_rendered_script_slims_before_packaging(tmpdir, monkeypatch,
+                                                profile_id):
+    b = _builder(tmpdir, monkeypatch)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'),
+                slim=['strip', 'tests'], slim_globs=['lib/python*/ensurepip'])
+
+    script = b._render_template(b.builds[0])
+
+    assert script.index('vdist_slim strip') < \
+        script.index('vdist_phase start package')
+    assert 'vdist_slim tests' in script
+    assert 'vdist_slim headers' not in script
+    assert 'rm -rf -- lib/python*/ensurepip' in script
+
+
+def test_build_rejects_optimizing_python_without_pgo():
+    for python_version in ['2.7.9', '3.5.2']:
+        with pytest.raises(ValueError):
+            Build(app='myapp', version='1.0', profile='centos7',
+                  source=git(uri='https://github.com/objectified/vdist'),
+                  python_version=python_version, optimize_python=True)
+    for python_version in ['2.7.13', '3.6', '3.11.4']:
+        Build(app='myapp', version='1.0', profile='centos7',
+              source=git(uri='https://github.com/objectified/vdist'),
+              python_version=python_version, optimize_python=True)
+
+
+def test_build_rejects_unknown_slim_steps():
+    with pytest.raises(ValueError):
+        Build(app='myapp', version='1.0', profile='centos7',
+              source=git(uri='https://github.com/objectified/vdist'),
+              slim=['strip', 'docs'])
+
+
+@pytest.mark.parametrize('profile_id,expected', [
+    ('ubuntu-trusty', 'FPM_DEB_COMPRESSION_ARGS=(--deb-compression xz)'),
+    ('centos6', 'FPM_RPM_COMPRESSION_ARGS=(--rpm-compression xz)'),
+    ('centos7', 'FPM_RPM_COMPRESSION_ARGS=(--rpm-compression xz)')])
+def test_rendered_script_selects_compression(tmpdir, monkeypatch, profile_id,
+                                             expected):
+    b = _builder(tmpdir, monkeypatch)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'),
+                compression='xz', compression_level=9)
+
+    script = b._render_template(b.builds[0])
+
+    assert expected in script
+    if profile_id == 'ubuntu-trusty':
+        assert 'vdist_wrap xz $(command -v xz) -T $COMPRESS_JOBS -9' \
+            in script
+        assert '"${FPM_DEB_COMPRESSION_ARGS[@]}"' in script
+    else:
+        assert '--rpm-compression-level 9' in script
+        assert '"${FPM_RPM_COMPRESSION_ARGS[@]}"' in script
+
+
+@pytest.mark.parametrize('profile_id', ['ubuntu-trusty', 'centos6',
+                                        'centos7'])
+def test_rendered_script_packages_all_formats(tmpdir, monkeypatch,
+                                              profile_id):
+    b = _builder(tmpdir, monkeypatch)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'),
+                formats=['deb', 'rpm', 'tar'])
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'))
+
+    script = b._render_template(b.builds[0])
+
+    assert 'vdist_package deb /tmp/vdist-deb ' in script
+    assert 'vdist_package rpm /tmp/vdist-rpm ' in script
+    assert 'vdist_package tar /tmp/vdist-tar/myapp-1.0.$TAR_EXTENSION &' \
+        in script
+    assert script.count('cp /tmp/vdist-') == 3
+
+    # by default, only the format of the profile
+    script = b._render_template(b.builds[1])
+    assert script.count('cp /tmp/vdist-') == 1
+    assert ('vdist_package deb ' in script) == \
+        (profile_id == 'ubuntu-trusty')
+
+
+def test_rendered_script_compresses_tarballs_with_zstd(tmpdir, monkeypatch):
+    b = _builder(tmpdir, monkeypatch)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=git(uri='https://github.com/objectified/vdist'),
+                formats=['tar'], compression='zstd')
+
+    script = b._render_template(b.builds[0])
+
+    assert 'TAR_EXTENSION=tar.zst' in script
+    assert 'zstd -q --rm /tmp/vdist-tar/myapp-1.0.tar' in script
+
+
+def test_builder_rejects_zstd_rpms_before_starting(tmpdir, monkeypatch):
+    with pytest.raises(ValueError):
+        Build(app='myapp', version='1.0', profile='ubuntu-trusty',
+              source=git(uri='https://github.com/objectified/vdist'),
+              formats=['deb', 'rpm'], compression='zstd')
+
+    b = _fake_builder(tmpdir, monkeypatch, [])
+    b.add_build(app='myapp', version='1.0', profile='centos7',
+                source=git(uri='https://github.com/objectified/vdist'),
+                compression='zstd')
+
+    plan = b.plan(fingerprint_sources=False)[0]
+    assert plan.errors == ['rpms can\'t be compressed with zstd: '
+                           'myapp-1.0-centos7']
+    result = b.build()[0]
+    assert result.status == BuildResult.FAILED
+    assert isinstance(result.error, ValueError)
+    assert not any(m.launched for m in FakeBuildMachine.instances)
+
+
+def test_build_rejects_compression_levels_out_of_range():
+    for compression, level in [('gzip', 0), ('gzip', 15), ('xz', 10),
+                               ('zstd', 0), ('zstd', 20), (None, 9)]:
+        with pytest.raises(ValueError):
+            Build(app='myapp', version='1.0', profile='centos7',
+                  source=git(uri='https://github.com/objectified/vdist'),
+                  compression=compression, compression_level=level)
+    for compression, level in [('gzip', 1), ('xz', 0), ('zstd', 19)]:
+        Build(app='myapp', version='1.0', profile='centos7',
+              source=git(uri='https://github.com/objectified/vdist'),
+              compression=compression, compression_level=level)
+
+
+def test_build_result_records_compression(tmpdir):
+    build = Build(app='myapp', version='1.0', profile='centos7',
+                  source=git(uri='https://github.com/objectified/vdist'),
+                  compression='gzip')
+    with pytest.raises(ValueError):
+        Build(app='myapp', version='1.0', profile='centos7',
+              source=git(uri='https://github.com/objectified/vdist'),
+              compression='lzma')
+    tmpdir.join('myapp-1.0.rpm').write('x' * 1000)
+    result = BuildResult(build)
+    result.build_dir = str(tmpdir)
+    result.phases = {'package': 20.0, 'fpm': 12.5}
+    result.collect_artifacts()
+
+    assert result.compression == {'codec': 'gzip', 'level': None,
+                                  'seconds': 12.5, 'size': 1000}
+
+
+@pytest.mark.parametrize('profile_id', ['ubuntu-trusty', 'centos6',
+                                        'centos7'])
+def test_rendered_script_packages_reproducibly(tmpdir, monkeypatch,
+                                               profile_id):
+    monkeypatch.delenv('SOURCE_DATE_EPOCH', raising=False)
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('')
+    os.utime(str(project.join('setup.py')), (1500000000, 1500000000))
+    b = _builder(tmpdir, monkeypatch, reproducible=True)
+    b._load_profiles()
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=directory(path=str(project)))
+    b.add_build(app='myapp', version='1.0', profile=profile_id,
+                source=git(uri='https://github.com/objectified/vdist'))
+
+    script = b._render_template(
+        b.builds[0], **b._build_context(b.builds[0], None, {}))
+    assert 'export SOURCE_DATE_EPOCH=1500000000' in script
+    assert 'compileall -q -f' in script
+    assert 'export TAR_OPTIONS' in script
+
+    b.git_mirrors = None
+    script = b._render_template(
+        b.builds[1], **b._build_context(b.builds[1], None, {}))
+    assert 'export SOURCE_DATE_EPOCH=$(git log -1 --format=%ct)' in script
+
+    b.reproducible = False
+    assert 'SOURCE_DATE_EPOCH' not in b._render_template(b.builds[1])
+
+
+def test_builder_verify_compares_both_builds(tmpdir, monkeypatch):
+    b = _fake_builder(tmpdir, monkeypatch, ['ubuntu', 'fails'],
+                      reproducible=True, use_cache=True, cache_compiler=True,
+                      pool_size=2)
+    pool = b.container_pool
+    settings = []
+
+    def build():
+        settings.append((b.use_cache, b.only_changed, b.cache_python,
+                         b.cache_wheels, b.cache_compiler, b.share_stages,
+                         b.container_pool, b.use_prewarmed_images))
+        return Builder.build(b)
+    monkeypatch.setattr(b, 'build', build)
+
+    reports = b.verify()
+
+    assert [r.build for r in reports] == b.builds
+    assert reports[0].reproducible
+    assert reports[0].first == reports[0].second
+    assert list(reports[0].first) == ['myapp-1.0.deb']
+    assert not reports[1].reproducible
+    assert reports[1].error is not None
+    assert len([m for m in FakeBuildMachine.instances if m.launched]) == 4
+    assert not any(m.pool or m.kwargs.get('prewarmed_image')
+                   for m in FakeBuildMachine.instances)
+    # both builds run without any of the caches, which are back afterwards
+    assert settings == [(False,) * 6 + (None, False)] * 2
+    assert b.use_cache and b.cache_python and b.cache_wheels
+    assert b.cache_compiler and b.use_prewarmed_images
+    assert b.container_pool is pool
+
+
+def test_builder_reports_output_of_failed_builds(tmpdir, monkeypatch,
+                                                 caplog):
+    b = _fake_builder(tmpdir, monkeypatch, ['fails'])
+
+    result = b.build()[0]
+
+    assert result.log_tail == ['error: it broke']
+    assert result.log_file == os.path.join(
+        result.build_dir, 'scratch', 'build.log')
+    assert result.build_dir.endswith('.failed')
+    assert 'error: it broke' in caplog.text
@@ -0,0 +1,264 @@
+import logging
+import os
+
+from vdist.buildmachine import BuildMachine, ContainerPool, PhaseTimer, \
+    SlimReport
+
+
+def test_phase_timer_collects_phases():
+    timer = PhaseTimer()
+
+    assert timer.feed('##vdist-phase start provision 100.0')
+    assert not timer.feed('+ apt-get update')
+    assert timer.feed('##vdist-phase end provision 160.5')
+    assert timer.feed('##vdist-phase start package 170.0')
+
+    assert list(timer.phases.items()) == [('provision', 60.5),
+                                          ('package', None)]
+    assert timer.summary() == 'provision 60.5s, package unfinished'
+
+
+def test_phase_timer_ignores_traced_marker_commands():
+    timer = PhaseTimer()
+
+    # bash -x traces the echo in the marker function to stderr
+    assert not timer.feed(
+        "++ echo '##vdist-phase start provision 100.0'")
+    assert not timer.feed('##vdist-phase garbage')
+    assert timer.phases == {}
+
+
+def test_slim_report_adds_up_saved_bytes():
+    report = SlimReport()
+
+    assert report.feed('##vdist-slim strip 1048576')
+    assert report.feed('##vdist-slim tests 524288')
+    assert report.feed('##vdist-slim strip 1048576')
+    assert not report.feed("++ echo '##vdist-slim strip 5'")
+
+    assert report.saved == {'strip': 2097152, 'tests': 524288}
+    assert report.summary() == 'strip 2.0MB, tests 0.5MB'
+
+
+STUB_DOCKER = '''#!/bin/bash
+# stands in for the docker cli, logging every call
+echo "$@" >> {log}
+case "$1" in
+    run)
+        count=$(($(cat {state}/count 2>/dev/null || echo 0) + 1))
+        echo $count > {state}/count
+        echo container$count
+        ;;
+    exec)
+        cat {state}/exec_output 2>/dev/null
+        exit $(cat {state}/exec_exit 2>/dev/null || echo 0)
+        ;;
+    stats)
+        echo "100MiB / 1GiB"
+        ;;
+    inspect)
+        exit 1
+        ;;
+esac
+'''
+
+
+def _stub_docker(tmpdir):
+    state = tmpdir.mkdir('state')
+    log = tmpdir.join('docker.log')
+    docker = tmpdir.join('docker')
+    docker.write(STUB_DOCKER.format(log=log, state=state))
+    docker.chmod(0o755)
+    return str(docker), log, state
+
+
+def _pooled_build(docker_cli, pool, build_dir, provision_key=None,
+                  extra_binds=None, **kwargs):
+    build_machine = BuildMachine(image='ubuntu:trusty', docker_cli=docker_cli,
+                                 pool=pool, reset_paths=['/tmp/*'],
+                                 provision_key=provision_key, **kwargs)
+    exit_code = build_machine.launch(build_dir=build_dir,
+                                     extra_binds=extra_binds)
+    container_id = build_machine.container_id
+    build_machine.shutdown()
+    return exit_code, container_id
+
+
+def _docker_calls(log, command):
+    return [l for l in log.readlines() if l.startswith(command)]
+
+
+def test_container_pool_reuses_containers(tmpdir):
+    docker_cli, log, _ = _stub_docker(tmpdir)
+    pool = ContainerPool(max_idle=1)
+    builds = tmpdir.mkdir('dist')
+
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('a'))) == \
+        (0, 'container1')
+    build_dir = builds.mkdir('b')
+    build_dir.mkdir('scratch').join('buildscript.sh').write('')
+    assert _pooled_build(docker_cli, pool, str(build_dir)) == \
+        (0, 'container1')
+
+    # the container has a dir of its own bound, which only holds the build
+    # dir of the build it runs while it runs
+    assert len(_docker_calls(log, 'run')) == 1
+    pool_dir = builds.join('.pool').listdir()[0]
+    assert _docker_calls(log, 'run')[0] == \
+        'run -d -ti -v %s:/work ubuntu:trusty bash\n' % pool_dir
+    assert 'exec container1 /work/scratch/buildscript.sh\n' in \
+        _docker_calls(log, 'exec')
+    assert 'exec container1 bash -c rm -rf /tmp/*\n' in \
+        _docker_calls(log, 'exec')
+    assert sorted(build_dir.join('scratch').listdir()) == [
+        build_dir.join('scratch', 'build.log'),
+        build_dir.join('scratch', 'buildscript.sh')]
+    assert pool_dir.listdir() == []
+    assert not _docker_calls(log, 'rm')
+
+    pool.close()
+    assert _docker_calls(log, 'rm') == ['rm -f container1\n']
+    assert not pool_dir.exists()
+
+
+def test_container_pool_retires_containers(tmpdir):
+    docker_cli, log, state = _stub_docker(tmpdir)
+    builds = tmpdir.mkdir('dist')
+
+    pool = ContainerPool(max_uses=1)
+    _pooled_build(docker_cli, pool, str(builds.mkdir('a')))
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('b')))[1] == \
+        'container2'
+
+    pool = ContainerPool(max_memory=50)
+    _pooled_build(docker_cli, pool, str(builds.mkdir('c')))
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('d')))[1] == \
+        'container4'
+
+    # containers of failed builds are never reused
+    state.join('exec_exit').write('1')
+    pool = ContainerPool()
+    _pooled_build(docker_cli, pool, str(builds.mkdir('e')))
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('f')))[1] == \
+        'container6'
+
+
+def test_container_pool_keeps_provisioning_apart(tmpdir):
+    docker_cli, log, _ = _stub_docker(tmpdir)
+    pool = ContainerPool(max_idle=2)
+    builds = tmpdir.mkdir('dist')
+
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('a')),
+                         'deps-a')[1] == 'container1'
+    # other build dependencies need a container of their own
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('b')),
+                         'deps-b')[1] == 'container2'
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('c')),
+                         'deps-a')[1] == 'container1'
+    pool.close()
+
+
+def test_container_pool_matches_binds_and_limits(tmpdir):
+    docker_cli, log, _ = _stub_docker(tmpdir)
+    pool = ContainerPool(max_idle=3)
+    builds = tmpdir.mkdir('dist')
+    caches = {'/cache/python': '/vdist-cache/python'}
+
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('a')),
+                         extra_binds=caches, cpus=4.0, memory=2048)[1] == \
+        'container1'
+    # fewer binds and other limits, like a build of another app in the
+    # next run
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('b')),
+                         cpus=2.0, memory=1024)[1] == 'container1'
+    assert 'update --cpus 2.00 --memory 1024m --memory-swap 2048m ' \
+        'container1\n' in _docker_calls(log, 'update')
+    # a bind the container doesn't have, or limits it can't lift
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('c')),
+                         extra_binds={'/src': '/vdist-source/src:ro'},
+                         cpus=2.0, memory=1024)[1] == 'container2'
+    assert _pooled_build(docker_cli, pool, str(builds.mkdir('d')))[1] == \
+        'container3'
+
+    pool.max_idle = 1
+    pool.trim()
+    assert [e[1] for e in pool.idle] == ['container3']
+    assert sorted(_docker_calls(log, 'rm')) == ['rm -f container1\n',
+                                               'rm -f container2\n']
+    pool.close()
+
+
+def test_run_cli_drains_stdout_and_stderr_concurrently(caplog):
+    caplog.set_level(logging.DEBUG)
+    # fills the stderr pipe before anything is written to stdout, which
+    # blocks forever when the pipes are read one after the other
+    script = ('for i in $(seq 2000); do echo "error $i: %s" >&2; done; '
+              'echo out; sleep 0.2; echo err >&2; sleep 0.2; echo done' % ('x' * 100))
+
+    exit_code, output = BuildMachine()._run_cli(
+        ['bash', '-c', script], capture_output=True)
+
+    assert exit_code == 0
+    assert output == 'out\ndone\n'
+    messages = [r.getMessage() for r in caplog.records]
+    assert len([m for m in messages if m.startswith('error')]) == 2000
+    assert messages.index('out') < messages.index('err') < \
+        messages.index('done')
+
+
+def test_run_cli_returns_exit_code():
+    build_machine = BuildMachine()
+    assert build_machine._run_cli(['bash', '-c', 'exit 3']) == (3, None)
+
+
+def test_run_cli_passes_environment(tmpdir):
+    docker = tmpdir.join('docker')
+    docker.write('#!/bin/sh\necho "$DOCKER_HOST $PATH"\n')
+    docker.chmod(0o755)
+    build_machine = BuildMachine(docker_cli=str(docker),
+                                 env={'DOCKER_HOST': 'tcp://buildhost:2376'})
+
+    _, output = build_machine._run_cli(build_machine._docker('info'),
+                                       capture_output=True)
+
+    # on top of the environment of vdist itself
+    assert output.split() == ['tcp://buildhost:2376', os.environ['PATH']]
+
+
+def test_build_machine_passes_resource_share(tmpdir):
+    docker_cli, log, _ = _stub_docker(tmpdir)
+    build_machine = BuildMachine(image='ubuntu:trusty', docker_cli=docker_cli,
+                                 cpus=2.5, memory=2048, jobs=3)
+
+    build_machine.launch(build_dir=str(tmpdir.mkdir('build')))
+
+    assert _docker_calls(log, 'run')[0].startswith(
+        'run -d -ti --cpus 2.50 --memory 2048m -v ')
+    assert _docker_calls(log, 'exec') == [
+        'exec -e VDIST_JOBS=3 container1 /work/scratch/buildscript.sh\n']
+
+
+def test_build_machine_writes_build_log(tmpdir, caplog):
+    caplog.set_level(logging.INFO)
+    docker_cli, _, state = _stub_docker(tmpdir)
+    state.join('exec_output').write(
+        ''.join('line %d\n' % i for i in range(1, 101)))
+
+    build_dir = tmpdir.mkdir('build')
+    build_machine = BuildMachine(image='ubuntu:trusty', docker_cli=docker_cli,
+                                 log_tail_lines=3)
+    build_machine.launch(build_dir=str(build_dir))
+
+    log_file = build_dir.join('scratch', 'build.log')
+    assert log_file.read().splitlines()[-1] == 'line 100'
+    assert len(log_file.readlines()) == 100
+    assert list(build_machine.log_tail) == ['line 98', 'line 99', 'line 100']
+    # the console only gets what vdist does, not the build output
+    assert 'line 100' not in [r.getMessage() for r in caplog.records]
+
+    build_dir = tmpdir.mkdir('quiet')
+    build_machine = BuildMachine(image='ubuntu:trusty', docker_cli=docker_cli,
+                                 machine_logs=False)
+    build_machine.launch(build_dir=str(build_dir))
+    assert not build_dir.join('scratch', 'build.log').check()
+    assert build_machine.log_tail[-1] == 'line 100'
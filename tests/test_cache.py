@@ -0,0 +1,112 @@
+import subprocess
+
+from vdist.cache import ArtifactCache, fingerprint_source
+from vdist.source import directory, git, git_directory
+
+
+def _git(path, *args):
+    subprocess.check_call(['git', '-C', str(path)] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _git_repo(tmpdir):
+    repo = tmpdir.mkdir('repo')
+    _git(repo, 'init', '-q', '-b', 'master')
+    _git(repo, 'config', 'user.email', 'vdist@example.com')
+    _git(repo, 'config', 'user.name', 'vdist')
+    repo.join('setup.py').write('# setup')
+    _git(repo, 'add', '.')
+    _git(repo, 'commit', '-q', '-m', 'initial')
+    return repo
+
+
+def test_cache_key_requires_all_inputs():
+    assert ArtifactCache.key('script', 'tree:abc', 'sha256:123') == \
+        ArtifactCache.key('script', 'tree:abc', 'sha256:123')
+    assert ArtifactCache.key('script', 'tree:abc', 'sha256:123') != \
+        ArtifactCache.key('script', 'tree:abd', 'sha256:123')
+    assert ArtifactCache.key('script', None, 'sha256:123') is None
+
+
+def test_cache_store_and_restore(tmpdir):
+    cache = ArtifactCache(path=str(tmpdir.join('cache')))
+    package = tmpdir.join('myapp-1.0.deb')
+    package.write('package')
+
+    assert cache.restore('somekey', str(tmpdir)) is None
+
+    cache.store('somekey', [str(package)])
+
+    target_dir = tmpdir.mkdir('restored')
+    artifacts = cache.restore('somekey', str(target_dir))
+    assert artifacts == [str(target_dir.join('myapp-1.0.deb'))]
+    assert target_dir.join('myapp-1.0.deb').read() == 'package'
+
+
+def test_fingerprint_directory_follows_content(tmpdir):
+    project = tmpdir.mkdir('project')
+    project.join('requirements.txt').write('jinja2')
+    source = directory(path=str(project))
+
+    fingerprint = fingerprint_source(source)
+    assert fingerprint == fingerprint_source(source)
+
+    project.join('requirements.txt').write('jinja2==2.7.3')
+    assert fingerprint != fingerprint_source(source)
+
+
+def test_fingerprint_git_sources(tmpdir):
+    repo = _git_repo(tmpdir)
+
+    remote = fingerprint_source(git(uri='file://%s' % repo))
+    local = fingerprint_source(git_directory(path=str(repo)))
+    assert remote.startswith('git:')
+    assert local.startswith('tree:')
+
+    repo.join('setup.py').write('# changed')
+    _git(repo, 'commit', '-q', '-am', 'change')
+    assert remote != fingerprint_source(git(uri='file://%s' % repo))
+    assert local != fingerprint_source(git_directory(path=str(repo)))
+
+
+def test_fingerprint_missing_source():
+    assert fingerprint_source(directory(path='/does/not/exist')) is None
+    assert fingerprint_source(
+        git(uri='file:///does/not/exist', branch='master')) is None
+
+
+def test_fingerprint_directory_covers_staged_files(tmpdir):
+    project = tmpdir.mkdir('project')
+    project.join('setup.py').write('# setup')
+    project.join('.gitignore').write('*.pyc\nnode_modules/\n')
+    project.mkdir('node_modules').join('big.js').write('')
+    data = tmpdir.mkdir('data')
+    data.join('f').write('data')
+    project.join('data').mksymlinkto(data)
+    source = directory(path=str(project))
+    fingerprint = fingerprint_source(source)
+
+    # ignored files don't end up in the build
+    project.join('app.pyc').write('')
+    project.join('node_modules', 'big.js').write('changed')
+    assert fingerprint_source(source) == fingerprint
+
+    # files behind a symlinked directory do
+    data.join('f').write('changed')
+    assert fingerprint_source(source) != fingerprint
+
+
+def test_fingerprint_directory_follows_git_tags(tmpdir):
+    repo = _git_repo(tmpdir)
+    source = directory(path=str(repo))
+    fingerprint = fingerprint_source(source)
+
+    # the install step may take the version from the tags
+    _git(repo, 'tag', 'v1.0')
+    assert fingerprint_source(source) != fingerprint
+
+
+def test_fingerprint_git_source_uses_resolved_commit():
+    source = git(uri='file:///does/not/exist', branch='master')
+    assert fingerprint_source(source, git_commit='a' * 40) == \
+        'git:%s' % ('a' * 40)
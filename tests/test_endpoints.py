@@ -0,0 +1,154 @@
+import threading
+
+from vdist.builder import BuildResult
+from vdist.endpoints import Endpoint, EndpointPool
+from vdist.source import directory
+
+from test_builder_setup import _builder
+
+
+def test_endpoint_pool_picks_least_loaded_endpoint():
+    small = Endpoint(docker_host='tcp://small:2376', capacity=1)
+    big = Endpoint(docker_host='tcp://big:2376', capacity=3)
+    pool = EndpointPool([small, big])
+
+    assert [pool.acquire().name for _ in range(4)] == [
+        'tcp://small:2376', 'tcp://big:2376', 'tcp://big:2376',
+        'tcp://big:2376']
+    assert pool.acquire(exclude=[small, big]) is None
+
+    # all endpoints are busy, so this waits for a release
+    acquired = []
+    waiting = threading.Thread(
+        target=lambda: acquired.append(pool.acquire(exclude=[big])))
+    waiting.start()
+    pool.release(small)
+    waiting.join(5)
+    assert acquired == [small]
+
+
+def test_endpoint_pool_prefers_endpoints_that_did_not_fail():
+    flaky = Endpoint(name='flaky')
+    steady = Endpoint(name='steady')
+    pool = EndpointPool([flaky, steady])
+
+    pool.release(pool.acquire(), failed=True)
+
+    assert pool.acquire() is steady
+
+
+def test_endpoint_is_local_without_remote_docker_host():
+    assert Endpoint().local
+    assert Endpoint(docker_host='unix:///var/run/docker.sock').local
+    assert not Endpoint(docker_host='tcp://buildhost:2376').local
+    assert Endpoint(docker_host='tcp://buildhost:2376') \
+        .build_machine_args() == dict(
+            docker_cli='docker', env={'DOCKER_HOST': 'tcp://buildhost:2376'},
+            remote=True)
+
+
+# stands in for the docker cli talking to a remote daemon: the single
+# container's filesystem is a directory, and the build script "builds" a
+# package when it was copied in
+STUB_REMOTE_DOCKER = '''#!/bin/bash
+echo "$@" >> {log}
+root={state}/root
+case "$1" in
+    run)
+        [ -f {state}/down ] && exit 1
+        mkdir -p $root
+        echo container1
+        ;;
+    exec)
+        shift 2
+        if [ "$1" = mkdir ]; then
+            mkdir -p "$root$3"
+        else
+            [ -x "$root$1" ] || exit 127
+            [ -f "$root/vdist-source/project/setup.py" ] || exit 1
+            echo package > $root/work/myapp-1.0.deb
+        fi
+        ;;
+    cp)
+        case "$2" in
+            container1:*) cp -a "$root${{2#container1:}}" "$3" ;;
+            *) cp -a "$2" "$root${{3#container1:}}" ;;
+        esac
+        ;;
+    inspect)
+        exit 1
+        ;;
+esac
+'''
+
+
+def _stub_remote_docker(tmpdir, name):
+    state = tmpdir.mkdir(name)
+    log = state.join('docker.log')
+    docker = state.join('docker')
+    docker.write(STUB_REMOTE_DOCKER.format(log=log, state=state))
+    docker.chmod(0o755)
+    return Endpoint(docker_cli=str(docker), name=name, local=False), state
+
+
+def test_builder_retries_builds_on_other_endpoints(tmpdir, monkeypatch):
+    down, down_state = _stub_remote_docker(tmpdir, 'down')
+    down_state.join('down').write('')
+    up, up_state = _stub_remote_docker(tmpdir, 'up')
+    project = tmpdir.mkdir('project')
+    project.join('setup.py').write('')
+
+    b = _builder(tmpdir, monkeypatch, endpoints=[down, up])
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=directory(path=str(project)))
+
+    results = b.build()
+
+    assert results[0].status == BuildResult.SUCCEEDED
+    assert results[0].endpoint == 'up'
+    assert [a.basename for a in tmpdir.join('dist').visit('*.deb')] == \
+        ['myapp-1.0.deb']
+    assert down.failures == 1
+    # nothing gets bind mounted on a remote daemon
+    assert not [l for l in up_state.join('docker.log').readlines()
+                if l.startswith('run') and ' -v ' in l]
+
+
+def test_builder_runs_all_stages_on_endpoints(tmpdir, monkeypatch):
+    up, up_state = _stub_remote_docker(tmpdir, 'up')
+    project = tmpdir.mkdir('project')
+    project.join('setup.py').write('')
+
+    b = _builder(tmpdir, monkeypatch, endpoints=[up], share_stages=True,
+                 cache_python=True)
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=directory(path=str(project)))
+
+    results = b.build()
+
+    # no stage ran on the local daemon first
+    assert not b.share_stages
+    assert results[0].status == BuildResult.SUCCEEDED
+    assert results[0].endpoint == 'up'
+    assert len([l for l in up_state.join('docker.log').readlines()
+                if l.startswith('run')]) == 1
+
+
+def test_remote_builds_only_get_files_that_are_not_ignored(tmpdir,
+                                                           monkeypatch):
+    up, up_state = _stub_remote_docker(tmpdir, 'up')
+    project = tmpdir.mkdir('project')
+    project.join('setup.py').write('')
+    project.join('.vdistignore').write('node_modules/\n')
+    project.mkdir('node_modules').join('big.js').write('')
+
+    b = _builder(tmpdir, monkeypatch, endpoints=[up], stage_sources='mount')
+    b.add_build(app='myapp', version='1.0', profile='ubuntu-trusty',
+                source=directory(path=str(project)))
+
+    results = b.build()
+
+    assert results[0].status == BuildResult.SUCCEEDED
+    copied = up_state.join('root', 'vdist-source', 'project')
+    assert copied.join('setup.py').check()
+    assert not copied.join('node_modules').check()
@@ -0,0 +1,114 @@
+import os
+import subprocess
+
+import pytest
+
+from vdist.mirrors import GitMirrorException, GitMirrors
+from vdist.source import git
+
+
+def _git(path, *args):
+    return subprocess.check_output(
+        ['git', '-C', str(path)] + list(args),
+        stderr=subprocess.PIPE).decode('utf-8').strip()
+
+
+def _commit(repo, filename, content):
+    repo.join(filename).write(content)
+    _git(repo, 'add', '.')
+    _git(repo, 'commit', '-q', '-m', 'change %s' % filename)
+    return _git(repo, 'rev-parse', 'HEAD')
+
+
+def _origin(tmpdir):
+    repo = tmpdir.mkdir('myapp')
+    _git(repo, 'init', '-q', '-b', 'master')
+    _git(repo, 'config', 'user.email', 'vdist@example.com')
+    _git(repo, 'config', 'user.name', 'vdist')
+    _commit(repo, 'setup.py', '# setup')
+    return repo
+
+
+def test_mirror_exports_checkout(tmpdir):
+    origin = _origin(tmpdir)
+    first = _git(origin, 'rev-parse', 'HEAD')
+    _git(origin, 'tag', 'v1.0')
+    head = _commit(origin, 'README', 'readme')
+    uri = 'file://%s' % origin
+    mirrors = GitMirrors(path=str(tmpdir.join('mirrors')))
+
+    assert mirrors.resolve(uri, 'master') == head
+    assert mirrors.resolve(uri, first[:10]) == first
+    assert os.path.isdir(mirrors.mirror_path(uri))
+
+    # commits that aren't a branch head can be exported too
+    target = tmpdir.join('export')
+    mirrors.export(uri, first, str(target))
+    assert target.join('setup.py').check()
+    assert not target.join('README').check()
+    assert _git(target, 'rev-parse', 'HEAD') == first
+    # tools taking the version from git need the tags and history
+    assert _git(target, 'describe', '--tags') == 'v1.0'
+    target = tmpdir.join('export-head')
+    mirrors.export(uri, head, str(target))
+    assert _git(target, 'describe', '--tags').startswith('v1.0-1-g')
+    assert _git(target, 'remote', 'get-url', 'origin') == uri
+
+    with pytest.raises(GitMirrorException):
+        mirrors.resolve(uri, 'nonexisting')
+
+
+def test_mirror_fetches_once_per_run(tmpdir):
+    origin = _origin(tmpdir)
+    uri = 'file://%s' % origin
+    mirrors = GitMirrors(path=str(tmpdir.join('mirrors')))
+    first = mirrors.resolve(uri, 'master')
+
+    head = _commit(origin, 'README', 'readme')
+    assert mirrors.resolve(uri, 'master') == first
+
+    mirrors.forget_fetched()
+    assert mirrors.resolve(uri, 'master') == head
+
+
+def test_mirror_fails_when_remote_is_unreachable(tmpdir):
+    origin = _origin(tmpdir)
+    uri = 'file://%s' % origin
+    mirrors = GitMirrors(path=str(tmpdir.join('mirrors')))
+    head = mirrors.resolve(uri, 'master')
+
+    origin.move(tmpdir.join('gone'))
+    mirrors.forget_fetched()
+
+    # the branch may have moved on, an abbreviated id may have become
+    # ambiguous
+    with pytest.raises(GitMirrorException):
+        mirrors.resolve(uri, 'master')
+    with pytest.raises(GitMirrorException):
+        mirrors.resolve(uri, head[:10])
+    # a full commit id in the mirror is still what it was
+    assert mirrors.resolve(uri, head) == head
+    target = tmpdir.join('export')
+    mirrors.export(uri, head, str(target))
+    assert target.join('setup.py').check()
+
+
+def test_builder_exports_git_sources(tmpdir, monkeypatch):
+    from test_builder_setup import FakeBuildMachine, _fake_builder
+
+    origin = _origin(tmpdir)
+    head = _git(origin, 'rev-parse', 'HEAD')
+    b = _fake_builder(tmpdir, monkeypatch, ['works'],
+                      source=git(uri='file://%s' % origin))
+    b.git_mirrors = GitMirrors(path=str(tmpdir.join('mirrors')))
+
+    result = b.build()[0]
+
+    binds = FakeBuildMachine.instances[0].extra_binds
+    source_dir = [d for d, m in binds.items() if m == '/vdist-source:ro'][0]
+    assert os.path.isfile(os.path.join(source_dir, 'myapp', 'setup.py'))
+    scratch_dir = os.path.join(result.build_dir, 'scratch')
+    with open(os.path.join(scratch_dir, 'buildscript.sh')) as f:
+        script = f.read()
+    assert 'at %s, exported from a mirror' % head in script
+    assert 'git clone' not in script
@@ -0,0 +1,349 @@
+import os
+import subprocess
+import sys
+
+from jinja2 import Environment, FileSystemLoader
+
+PROFILES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'vdist', 'profiles')
+
+
+def _run_script(tmpdir, template, **variables):
+    # returns what the script wrote to stdout
+    env = Environment(loader=FileSystemLoader([PROFILES_DIR]))
+    script = tmpdir.join('script.sh')
+    script.write(env.from_string(template).render(
+        local_uid=os.getuid(), local_gid=os.getgid(), **variables))
+    return subprocess.check_output(['bash', str(script)],
+                                   stderr=subprocess.PIPE).decode('utf-8')
+
+
+COMPILE_PYTHON_TEMPLATE = '''
+set -e
+PYTHON_VERSION=3.5.1
+PYTHON_BASEDIR={{basedir}}
+PYTHON_CONFIGURE_FLAGS=(--prefix=$PYTHON_BASEDIR)
+PYTHON_SHARED={{shared or 'false'}}
+vdist_compile_python() {
+    mkdir -p $PYTHON_BASEDIR/bin $PYTHON_BASEDIR/lib
+    echo "#!$PYTHON_BASEDIR/bin/python3" > $PYTHON_BASEDIR/bin/pip3
+    echo "prefix = '$PYTHON_BASEDIR'" > $PYTHON_BASEDIR/lib/sysconfig.py
+    echo "data = '$PYTHON_BASEDIR-data/$PYTHON_BASEDIR'" >> $PYTHON_BASEDIR/lib/sysconfig.py
+    echo compiled >> {{compile_log}}
+    {% if flags_log %}
+    echo "${PYTHON_CONFIGURE_FLAGS[*]}" > {{flags_log}}
+    {% endif %}
+}
+{% if tools_dir %}
+# installs a patchelf logging its calls
+export PATH={{tools_dir}}:$PATH
+vdist_install() {
+    printf '#!/bin/sh\\necho "$*" >> {{tools_dir}}/calls\\n' > {{tools_dir}}/$1
+    chmod +x {{tools_dir}}/$1
+}
+{% endif %}
+{% include 'compile_python.sh' %}
+'''
+
+
+def test_compile_python_reuses_and_relocates_cached_interpreter(tmpdir):
+    compile_log = tmpdir.join('compile.log')
+    variables = dict(compile_log=str(compile_log),
+                     python_cache_dir=str(tmpdir.mkdir('cache')),
+                     python_cache_tag='sha256:image')
+
+    first = str(tmpdir.join('opt', 'first'))
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, basedir=first, **variables)
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, basedir=first, **variables)
+    assert compile_log.read() == 'compiled\n'
+
+    second = str(tmpdir.join('opt', 'second'))
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, basedir=second, **variables)
+    assert compile_log.read() == 'compiled\n'
+    with open(os.path.join(second, 'bin', 'pip3')) as f:
+        assert f.read() == '#!%s/bin/python3\n' % second
+
+
+def test_compile_python_relocates_whole_paths_only(tmpdir):
+    variables = dict(compile_log=str(tmpdir.join('compile.log')),
+                     python_cache_dir=str(tmpdir.mkdir('cache')),
+                     python_cache_tag='sha256:image', shared='true',
+                     tools_dir=str(tmpdir.mkdir('tools')))
+
+    first = str(tmpdir.join('opt', 'app'))
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, basedir=first, **variables)
+    second = str(tmpdir.join('opt', 'other.app'))
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, basedir=second, **variables)
+
+    with open(os.path.join(second, 'lib', 'sysconfig.py')) as f:
+        assert f.read().splitlines() == [
+            "prefix = '%s'" % second,
+            "data = '%s-data/%s'" % (first, second)]
+    # the shared interpreter gets the rpath of its new prefix
+    calls = tmpdir.join('tools', 'calls').read().splitlines()
+    assert '--set-rpath $ORIGIN/../lib:%s/lib %s/bin/pip3' % \
+        (second, second) in calls
+
+
+def test_compile_python_optimizes_in_interpreter_of_its_own(tmpdir):
+    compile_log = tmpdir.join('compile.log')
+    flags_log = tmpdir.join('flags.log')
+    basedir = str(tmpdir.join('opt', 'myapp'))
+    variables = dict(basedir=basedir, compile_log=str(compile_log),
+                     flags_log=str(flags_log),
+                     python_cache_dir=str(tmpdir.mkdir('cache')),
+                     python_cache_tag='sha256:image')
+
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, **variables)
+    assert flags_log.read() == '--prefix=%s\n' % basedir
+
+    # an optimized interpreter isn't the cached plain one
+    _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, optimize_python=True,
+                **variables)
+    assert compile_log.read() == 'compiled\ncompiled\n'
+    assert flags_log.read() == \
+        '--prefix=%s --enable-optimizations --with-lto\n' % basedir
+
+
+def test_compile_python_without_cache(tmpdir):
+    compile_log = tmpdir.join('compile.log')
+    basedir = str(tmpdir.join('opt', 'myapp'))
+
+    for _ in range(2):
+        _run_script(tmpdir, COMPILE_PYTHON_TEMPLATE, basedir=basedir,
+                    compile_log=str(compile_log))
+    assert compile_log.read() == 'compiled\ncompiled\n'
+
+
+FAKE_PIP = '''#!/bin/bash
+echo "$@" >> {{pip_log}}
+if [ "$1" = "wheel" ]; then
+    while [ "$1" != "-w" ]; do shift; done
+    touch $2/foo-1.0-py2.py3-none-any.whl
+elif [ "$2" = "--no-index" ]; then
+    # succeeds when one of the find-links dirs has the wheel
+    while [ "$1" != "-r" ]; do
+        if [ "$1" = "--find-links" ] && ls $2/*.whl; then
+            exit 0
+        fi
+        shift
+    done
+    exit 1
+fi
+'''
+
+
+PIP_INSTALL_TEMPLATE = '''
+set -e
+PYTHON_BIN={{python_bin}}
+PIP_BIN={{pip_bin}}
+cd {{project}}
+{% include 'pip_install.sh' %}
+'''
+
+
+def test_pip_install_fills_and_uses_wheelhouse(tmpdir):
+    pip_log = tmpdir.join('pip.log')
+    pip_bin = tmpdir.join('pip')
+    pip_bin.write(FAKE_PIP.replace('{{pip_log}}', str(pip_log)))
+    pip_bin.chmod(0o755)
+    project = tmpdir.mkdir('project')
+    project.join('requirements.txt').write('foo==1.0')
+    wheelhouse = tmpdir.mkdir('wheels')
+
+    variables = dict(python_bin=sys.executable, pip_bin=str(pip_bin),
+                     project=str(project), pip_args='',
+                     requirements_path='/requirements.txt',
+                     wheelhouse_dir=str(wheelhouse))
+
+    _run_script(tmpdir, PIP_INSTALL_TEMPLATE, **variables)
+    assert 'wheel' in [l.split()[0] for l in pip_log.readlines()]
+    wheels = [str(p.basename) for p in wheelhouse.visit('*.whl')]
+    assert wheels == ['foo-1.0-py2.py3-none-any.whl']
+
+    pip_log.remove()
+    _run_script(tmpdir, PIP_INSTALL_TEMPLATE, **variables)
+    assert len(pip_log.readlines()) == 1
+
+
+def test_pip_install_resolves_unpinned_requirements_on_index(tmpdir):
+    pip_log = tmpdir.join('pip.log')
+    pip_bin = tmpdir.join('pip')
+    pip_bin.write(FAKE_PIP.replace('{{pip_log}}', str(pip_log)))
+    pip_bin.chmod(0o755)
+    project = tmpdir.mkdir('project')
+    requirements = project.join('requirements.txt')
+    variables = dict(python_bin=sys.executable, pip_bin=str(pip_bin),
+                     project=str(project), pip_args='',
+                     requirements_path='/requirements.txt',
+                     wheelhouse_dir=str(tmpdir.mkdir('wheels')))
+
+    requirements.write('# pinned\nfoo==1.0  # comment\n')
+    _run_script(tmpdir, PIP_INSTALL_TEMPLATE, **variables)
+    pip_log.remove()
+
+    # the wheelhouse has foo 1.0 now, the index may have something newer
+    requirements.write('foo>=1.0\n')
+    _run_script(tmpdir, PIP_INSTALL_TEMPLATE, **variables)
+
+    commands = [' '.join(l.split()[:2]) for l in pip_log.readlines()]
+    # and wheel, which was only needed to build wheels, is gone again
+    assert commands == ['freeze', 'install wheel', 'wheel --find-links',
+                        'uninstall -y', 'install --no-index']
+
+
+SLIM_TEMPLATE = '''
+set -e
+PYTHON_BASEDIR={{basedir}}
+PYTHON_BIN={{python_bin}}
+vdist_phase() {
+    :
+}
+{% include 'slim.sh' %}
+'''
+
+
+def test_slim_removes_what_is_not_needed_at_runtime(tmpdir):
+    basedir = tmpdir.mkdir('python')
+    cache_tag = sys.implementation.cache_tag
+    kept = ['bin/python3', 'lib/python3.5/os.py',
+            'lib/python3.5/__pycache__/os.%s.pyc' % cache_tag,
+            'lib/python3.5/site-packages/foo/tests/test_foo.py']
+    removed = {
+        'tests': ['lib/python3.5/test/test_os.py',
+                  'lib/python3.5/unittest/test/test_case.py',
+                  'share/man/man1/python3.1'],
+        'gui': ['bin/idle3', 'lib/python3.5/idlelib/idle.py',
+                'lib/python3.5/tkinter/__init__.py'],
+        'static': ['lib/python3.5/config/libpython3.5m.a'],
+        'headers': ['include/python3.5m/Python.h'],
+        'bytecode': ['lib/python3.5/__pycache__/os.cpython-27.pyc',
+                     'lib/python3.5/__pycache__/os.%s.opt-1.pyc' % cache_tag,
+                     'lib/python2.7/os.pyo'],
+        'globs': ['lib/python3.5/ensurepip/__init__.py'],
+    }
+    for path in kept + sum(removed.values(), []):
+        basedir.join(path).write('x' * 4096, ensure=True)
+
+    out = _run_script(tmpdir, SLIM_TEMPLATE, basedir=str(basedir),
+                      python_bin=sys.executable,
+                      slim=['strip', 'tests', 'gui', 'static', 'headers',
+                            'bytecode'],
+                      slim_globs=['lib/python*/ensurepip'])
+
+    assert sorted(p for p in kept + sum(removed.values(), [])
+                  if basedir.join(p).check()) == sorted(kept)
+    report = [l.split() for l in out.splitlines()
+              if l.startswith('##vdist-slim ')]
+    assert [step for _, step, _ in report] == \
+        ['strip', 'tests', 'gui', 'static', 'headers', 'bytecode', 'globs']
+    saved = dict((step, int(size)) for _, step, size in report)
+    # the fake binaries have nothing to strip
+    assert saved.pop('strip') == 0
+    for step, size in saved.items():
+        assert size >= 4096 * len(removed[step])
+
+
+FAKE_FPM = '''#!/bin/bash
+echo "$@" >> {{fpm_log}}
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -t) format=$2; shift ;;
+        -p) output=$2; shift ;;
+    esac
+    shift
+done
+if [ -d "$output" ]; then
+    output=$output/myapp-1.0.$format
+fi
+echo $format > $output
+'''
+
+
+PACKAGE_TEMPLATE = '''
+set -e
+built=true
+PYTHON_BASEDIR={{basedir}}
+export PATH={{tools_dir}}:$PATH
+vdist_phase() {
+    :
+}
+vdist_install() {
+    :
+}
+{% set native_format = 'deb' %}
+{% include 'package.sh' %}
+'''
+
+
+def test_package_builds_every_format_from_one_tree(tmpdir):
+    tools_dir = tmpdir.mkdir('tools')
+    fpm_log = tmpdir.join('fpm.log')
+    tools_dir.join('fpm').write(FAKE_FPM.replace('{{fpm_log}}', str(fpm_log)))
+    tools_dir.join('fpm').chmod(0o755)
+    basedir = tmpdir.mkdir('python')
+    basedir.join('bin', 'python3').write('', ensure=True)
+    shared_dir = tmpdir.mkdir('shared')
+
+    _run_script(tmpdir, PACKAGE_TEMPLATE, basedir=str(basedir),
+                tools_dir=str(tools_dir), formats=['deb', 'rpm', 'tar'],
+                app='myapp', version='1.0', runtime_deps=[], fpm_args='',
+                package_tmp_root=str(tmpdir.mkdir('tmp')),
+                package_install_root=str(tmpdir.mkdir('install')),
+                shared_dir=str(shared_dir), compression=None)
+
+    # fpm runs once per format, on the same installed tree
+    calls = [l.split() for l in fpm_log.readlines()]
+    assert sorted(c[c.index('-t') + 1] for c in calls) == \
+        ['deb', 'rpm', 'tar']
+    assert all(c[-1] == str(basedir) for c in calls)
+    assert sorted(p.basename for p in shared_dir.listdir()) == \
+        ['myapp-1.0.deb', 'myapp-1.0.rpm', 'myapp-1.0.tar.gz']
+
+
+# logs its arguments, and whether the lock on the package cache was held
+PACKAGE_MANAGER_STUB = '''#!/bin/sh
+if flock -n {cache}/lock true; then state=unlocked; else state=locked; fi
+echo "$state $*" >> {log}
+'''
+
+PACKAGE_CACHE_TEMPLATE = '''
+set -e
+export PATH={{stubs}}:$PATH
+{% include include %}
+{% if include == 'apt_cache.sh' %}
+$APT_GET install -y ruby-dev
+{% else %}
+$YUM install -y "Development Tools"
+$YUM makecache
+{% endif %}
+'''
+
+
+def test_package_cache_is_only_locked_for_downloads(tmpdir):
+    cache = tmpdir.mkdir('cache')
+    log = tmpdir.join('calls')
+    stubs = tmpdir.mkdir('stubs')
+    for command in ['apt-get', 'yum']:
+        stubs.join(command).write(PACKAGE_MANAGER_STUB.format(cache=cache,
+                                                              log=log))
+        stubs.join(command).chmod(0o755)
+
+    for include in ['apt_cache.sh', 'yum_cache.sh']:
+        _run_script(tmpdir, PACKAGE_CACHE_TEMPLATE, include=include,
+                    package_cache_dir=str(cache), stubs=str(stubs))
+
+    calls = [l.split(' ', 1) for l in log.read().splitlines()]
+    archives = '-o Dir::Cache::Archives=%s/archives' % cache
+    assert calls == [
+        ['locked', '%s --download-only install -y ruby-dev' % archives],
+        ['unlocked', '%s -o Debug::NoLocking=1 install -y ruby-dev' %
+         archives],
+        ['locked', '--setopt=cachedir=%s/$basearch/$releasever '
+         '--setopt=keepcache=1 --downloadonly install -y Development Tools'
+         % cache],
+        ['unlocked', '--setopt=cachedir=%s/$basearch/$releasever '
+         '--setopt=keepcache=1 -C install -y Development Tools' % cache],
+        ['locked', '--setopt=cachedir=%s/$basearch/$releasever '
+         '--setopt=keepcache=1 makecache' % cache]]
@@ -0,0 +1,83 @@
+import pytest
+
+from vdist import defaults, scheduler
+from vdist.builder import Build
+from vdist.scheduler import BuildDurations, build_jobs, host_resources, \
+    partition_resources, resolve_max_workers
+from vdist.source import git
+
+
+def _build(profile, compile_python=True):
+    return Build(
+        app='myapp',
+        version='1.0',
+        source=git(uri='https://github.com/objectified/vdist'),
+        profile=profile,
+        compile_python=compile_python
+    )
+
+
+def test_resolve_max_workers_fixed():
+    assert resolve_max_workers(4, 10) == 4
+    assert resolve_max_workers('4', 10) == 4
+
+
+def test_resolve_max_workers_capped_by_builds():
+    assert resolve_max_workers(8, 3) == 3
+
+
+def test_resolve_max_workers_auto():
+    assert 1 <= resolve_max_workers('auto', 10) <= 10
+
+
+def test_resolve_max_workers_invalid():
+    with pytest.raises(ValueError):
+        resolve_max_workers(0, 3)
+
+
+def test_durations_longest_first_estimates(tmpdir):
+    durations = BuildDurations(path=str(tmpdir.join('durations.json')))
+
+    trusty = _build('ubuntu-trusty', compile_python=False)
+    centos6 = _build('centos6')
+    centos7 = _build('centos7')
+
+    ordered = durations.longest_first([trusty, centos7, centos6])
+
+    assert ordered == [centos6, centos7, trusty]
+
+
+def test_durations_recorded_roundtrip(tmpdir):
+    path = str(tmpdir.join('durations.json'))
+
+    trusty = _build('ubuntu-trusty', compile_python=False)
+    centos6 = _build('centos6')
+
+    durations = BuildDurations(path=path)
+    durations.record(trusty, 5000.0)
+    durations.record(centos6, 10.0)
+    durations.save()
+
+    durations = BuildDurations(path=path).load()
+    assert durations.expected(trusty) == 5000.0
+    assert durations.longest_first([centos6, trusty]) == [trusty, centos6]
+
+
+def test_partition_resources_splits_host(monkeypatch):
+    monkeypatch.setattr(scheduler, '_cpu_count', lambda: 8)
+    monkeypatch.setattr(scheduler, '_free_memory_mb', lambda: 16384)
+    host = host_resources()
+
+    assert partition_resources(host, 1) == (8.0, 16384)
+    assert partition_resources(host, 3) == (8.0 / 3, 5461)
+    # never less memory than a build needs to get anywhere
+    assert partition_resources(host, 64)[1] == defaults.MIN_BUILD_MEMORY
+
+    monkeypatch.setattr(scheduler, '_free_memory_mb', lambda: None)
+    assert partition_resources(host_resources(), 2) == (4.0, None)
+
+
+def test_build_jobs_rounds_share_of_cores():
+    assert build_jobs(8.0) == 8
+    assert build_jobs(8.0 / 3) == 3
+    assert build_jobs(0.25) == 1
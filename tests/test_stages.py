@@ -0,0 +1,71 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from vdist.stages import StageGraph
+
+
+def test_stage_graph_runs_shared_stages_once():
+    calls = []
+    lock = threading.Lock()
+
+    def stage(name):
+        def run():
+            with lock:
+                calls.append(name)
+            return name
+        return run
+
+    graph = StageGraph()
+    base = graph.add('base', stage('base'))
+    for app in ['a', 'b', 'c']:
+        # every build adds the shared stage again
+        shared = graph.add('base', stage('base again'))
+        assert shared == base
+        graph.add(app, stage(app), depends_on=[shared])
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = graph.run(executor)
+
+    assert [futures[key].result(5) for key in ['a', 'b', 'c']] == \
+        ['a', 'b', 'c']
+    executor.shutdown()
+    assert calls[0] == 'base'
+    assert sorted(calls) == ['a', 'b', 'base', 'c']
+
+
+def test_stage_graph_waiting_stages_dont_hold_workers():
+    # with one worker, a dependent stage submitted first would deadlock
+    # if it waited for its dependency in the worker
+    release = threading.Event()
+    graph = StageGraph()
+    first = graph.add('first', lambda: release.wait(5) and 'first')
+    graph.add('second', lambda: 'second', depends_on=[first])
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    futures = graph.run(executor)
+    release.set()
+
+    assert futures['second'].result(5) == 'second'
+    executor.shutdown()
+
+
+def test_stage_graph_propagates_failures():
+    def fails():
+        raise ValueError('broken')
+
+    graph = StageGraph()
+    base = graph.add('base', fails)
+    graph.add('plain', lambda: 'plain', depends_on=[base])
+    graph.add('handled', lambda: 'handled', depends_on=[base],
+              on_dependency_failure=lambda e: 'handled %s' % e)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = graph.run(executor)
+
+    with pytest.raises(ValueError):
+        futures['plain'].result(5)
+    assert futures['handled'].result(5) == 'handled broken'
+    executor.shutdown()
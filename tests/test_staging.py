@@ -0,0 +1,145 @@
+import os
+import subprocess
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from vdist.staging import IgnoreRules, SharedSources, source_files, \
+    stage_tree, write_file_list
+
+
+def _project(tmpdir):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+    project.join('.gitignore').write(
+        '# build output\n*.pyc\nbuild/\n/dist\n!keep.pyc\n')
+    project.join('keep.pyc').write('')
+    project.join('app.pyc').write('')
+    project.mkdir('build').join('lib.so').write('')
+    project.mkdir('dist').join('app.tar.gz').write('')
+    project.mkdir('.git').join('HEAD').write('ref: refs/heads/master')
+    pkg = project.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    # unanchored patterns match at any depth, anchored ones don't
+    pkg.mkdir('build').join('x').write('')
+    pkg.mkdir('dist').join('y').write('')
+    pkg.join('.gitignore').write('*.log\n')
+    pkg.join('debug.log').write('')
+    project.join('top.log').write('')
+    return project
+
+
+def test_ignore_rules():
+    rules = IgnoreRules()
+    for pattern in ['*.pyc', 'node_modules/', '/dist', 'docs/**/*.tmp',
+                    '!important.pyc', '', '# comment']:
+        rules.add_pattern(pattern)
+
+    assert rules.ignored('a.pyc')
+    assert rules.ignored('pkg/a.pyc')
+    assert not rules.ignored('important.pyc')
+    assert rules.ignored('web/node_modules', is_dir=True)
+    assert not rules.ignored('web/node_modules')
+    assert rules.ignored('dist', is_dir=True)
+    assert not rules.ignored('pkg/dist', is_dir=True)
+    assert rules.ignored('docs/a/b/c.tmp')
+    assert rules.ignored('docs/c.tmp')
+    assert not rules.ignored('c.tmp')
+
+
+def test_source_files_honour_ignore_files(tmpdir):
+    project = _project(tmpdir)
+    project.join('.vdistignore').write('pkg/dist/\n!app.pyc\n')
+
+    assert list(source_files(str(project))) == [
+        '.gitignore', '.vdistignore', 'app.pyc', 'keep.pyc', 'setup.py',
+        'top.log', 'pkg/.gitignore', 'pkg/__init__.py']
+    assert '.git/HEAD' in source_files(str(project), include_vcs=True)
+
+
+def test_source_files_keep_tracked_files(tmpdir):
+    project = tmpdir.mkdir('myapp')
+    project.join('.gitignore').write('*.so\nbuild/\n')
+    project.join('setup.py').write('# setup')
+    project.join('vendored.so').write('')
+    project.join('local.so').write('')
+    project.mkdir('build').join('tracked.txt').write('')
+    project.join('build', 'untracked.txt').write('')
+    for args in [['init', '-q'],
+                 ['add', '-f', 'setup.py', 'vendored.so', 'build/tracked.txt']]:
+        subprocess.check_call(['git'] + args, cwd=str(project))
+
+    # git tracks files whatever .gitignore says, and so does vdist
+    assert list(source_files(str(project))) == [
+        '.gitignore', 'setup.py', 'vendored.so', 'build/tracked.txt']
+
+
+def test_source_files_skip_symlink_cycles(tmpdir):
+    project = tmpdir.mkdir('myapp')
+    project.join('setup.py').write('# setup')
+    pkg = project.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    pkg.join('parent').mksymlinkto(project)
+    project.join('pkg_link').mksymlinkto(pkg)
+
+    assert list(source_files(str(project))) == [
+        'setup.py', 'pkg/__init__.py', 'pkg_link/__init__.py']
+
+
+def test_stage_tree_links_files(tmpdir):
+    project = _project(tmpdir)
+
+    counts = stage_tree(str(project), str(tmpdir.join('scratch', 'myapp')))
+
+    staged = tmpdir.join('scratch', 'myapp')
+    assert staged.join('pkg', '__init__.py').check()
+    assert not staged.join('build').check()
+    assert not staged.join('.git').check()
+    assert counts['copied'] == 0
+    if counts['hardlinked']:
+        assert os.path.samefile(str(project.join('setup.py')),
+                                str(staged.join('setup.py')))
+
+
+def test_write_file_list(tmpdir):
+    project = _project(tmpdir)
+    file_list = tmpdir.join('source-files')
+
+    write_file_list(str(project), str(file_list), prefix='myapp/')
+
+    assert file_list.read_binary().split(b'\0')[:3] == \
+        [b'myapp/.gitignore', b'myapp/keep.pyc', b'myapp/setup.py']
+
+
+def test_shared_sources_prepare_once(tmpdir):
+    shared_sources = SharedSources(str(tmpdir.join('sources')))
+    calls = []
+
+    def stage(source_dir):
+        calls.append(source_dir)
+        open(os.path.join(source_dir, 'setup.py'), 'w').close()
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    source_dirs = list(executor.map(
+        lambda key: shared_sources.prepare(key, stage), ['a', 'a', 'b', 'a']))
+
+    assert len(calls) == 2
+    assert source_dirs[0] == source_dirs[1] == source_dirs[3]
+    assert source_dirs[2] != source_dirs[0]
+
+
+def test_shared_sources_prepare_concurrently(tmpdir):
+    shared_sources = SharedSources(str(tmpdir.join('sources')))
+    b_prepared = threading.Event()
+
+    def slow_stage(source_dir):
+        # only finishes when b gets prepared while a is still busy
+        assert b_prepared.wait(5)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    a = executor.submit(shared_sources.prepare, 'a', slow_stage)
+    b = executor.submit(shared_sources.prepare, 'b', lambda d: None)
+    b.result()
+    b_prepared.set()
+
+    assert a.result() != b.result()
@@ -0,0 +1,349 @@
+# an asyncio based build engine, for embedding vdist in asyncio
+# applications; it needs Python 3.7 or newer, so it is only imported
+# when used
+import asyncio
+import functools
+import logging
+import posixpath
+import time
+
+from vdist import defaults
+from vdist.builder import BuildResult
+from vdist.buildmachine import BuildMachine, BuildMachineException, \
+    DockerHostException, LOG_BUFFER_SIZE, READ_CHUNK_SIZE, READ_QUEUE_SIZE
+
+
+logger = logging.getLogger('AsyncBuilder')
+
+
+class AsyncBuildLog(object):
+    # BuildLog for the event loop: a task writes the queued output, and
+    # the file is only touched from the default executor, so a slow disk
+    # holds up the build writing to it, but never the loop
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = asyncio.Queue(maxsize=READ_QUEUE_SIZE)
+        self.writer = asyncio.ensure_future(self._write())
+
+    async def write(self, lines):
+        await self.chunks.put(lines)
+
+    async def _next_lines(self):
+        # everything queued so far, and whether the log was closed
+        lines = []
+        chunk = await self.chunks.get()
+        while chunk is not None:
+            lines.extend(chunk)
+            if self.chunks.empty():
+                return lines, False
+            chunk = self.chunks.get_nowait()
+        return lines, True
+
+    async def _write(self):
+        log_file = None
+        closed = False
+        try:
+            log_file = await _run_in_executor(open, self.path, 'ab',
+                                              LOG_BUFFER_SIZE)
+            while not closed:
+                lines, closed = await self._next_lines()
+                if lines:
+                    await _run_in_executor(log_file.writelines, lines)
+        except (IOError, OSError) as e:
+            logging.getLogger('BuildLog').warning(
+                'Could not write %s: %s' % (self.path, e))
+            # keep emptying the queue, so the build doesn't block
+            while not closed:
+                closed = await self.chunks.get() is None
+        finally:
+            if log_file is not None:
+                await _run_in_executor(log_file.close)
+
+    async def close(self):
+        # returns once everything written so far is on disk
+        await self.chunks.put(None)
+        await self.writer
+
+
+class AsyncBuildMachine(BuildMachine):
+    # drives the docker cli like BuildMachine does, but from an event
+    # loop instead of a thread per build; all methods talking to docker
+    # are coroutines. Containers aren't pooled.
+
+    def __init__(self, **kwargs):
+        super(AsyncBuildMachine, self).__init__(**kwargs)
+        if self.pool is not None:
+            raise ValueError('AsyncBuildMachine does not support pools')
+        if self.remote:
+            raise ValueError('AsyncBuildMachine does not support remote '
+                             'daemons')
+
+    async def _read_stream(self, stream, output=None):
+        partial = b''
+        while True:
+            chunk = await stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines, partial = self._split_lines(partial, chunk)
+            if output is not None:
+                output.extend(lines)
+            await self._write_log(lines)
+            self._log_lines(lines)
+        if partial:
+            if output is not None:
+                output.append(partial)
+            await self._write_log([partial])
+            self._log_lines([partial])
+
+    async def _write_log(self, lines):
+        if self.log is not None:
+            await self.log.write(lines)
+
+    async def _open_log(self, build_dir):
+        if self.machine_logs:
+            self.log = AsyncBuildLog(
+                await _run_in_executor(self._log_path, build_dir))
+
+    async def _close_log(self):
+        log = self.log
+        self.log = None
+        if log is not None:
+            await log.close()
+
+    async def _run_cli(self, args, capture_output=False):
+        self.logger.info('Running command: "%s"' % ' '.join(args))
+        p = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self._cli_env()
+        )
+
+        output = [] if capture_output else None
+        try:
+            await asyncio.gather(self._read_stream(p.stdout, output),
+                                 self._read_stream(p.stderr))
+            exit_code = await p.wait()
+        except asyncio.CancelledError:
+            # don't leave the docker cli behind when the build is cancelled
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            raise
+
+        if capture_output:
+            return exit_code, b''.join(output).decode('UTF-8', 'replace')
+        return exit_code, None
+
+    async def image_id(self, image=None):
+        if image is None:
+            image = self.image
+        exit_code, output = await self._run_cli(
+            self._docker('inspect', '--format', '{{.Id}}', image),
+            capture_output=True)
+        if exit_code != 0 or not output.strip():
+            return None
+        return output.strip()
+
+    async def _start_container(self, image, binds):
+        self.logger.info('Starting container: %s' % image)
+        exit_code, output = await self._run_cli(self._run_args(image, binds),
+                                                capture_output=True)
+        if exit_code != 0:
+            raise DockerHostException(
+                'could not start container from image %s (exit code %d)' %
+                (image, exit_code))
+        return output.strip()
+
+    async def launch(self, build_dir, extra_binds=None):
+        binds = {build_dir: defaults.SHARED_DIR}
+        if extra_binds:
+            binds.update(extra_binds)
+        path_to_command = posixpath.join(
+            defaults.SHARED_DIR,
+            defaults.SCRATCH_DIR,
+            defaults.SCRATCH_BUILDSCRIPT_NAME
+        )
+        image = self.image
+        if self.prewarmed_image and await self.image_id(self.prewarmed_image):
+            self.logger.info('Using prewarmed image: %s' %
+                             self.prewarmed_image)
+            image = self.prewarmed_image
+
+        self.container_id = await self._start_container(image, binds)
+
+        await self._open_log(build_dir)
+        try:
+            exit_code, _ = await self._run_cli(
+                self._exec_args(self.container_id, path_to_command))
+        finally:
+            # a cancelled build still gets what it wrote on disk
+            await asyncio.shield(self._close_log())
+        self.exit_code = exit_code
+
+        if self.phases:
+            self.logger.info('Build phases: %s' % self.phase_timer.summary())
+        if self.slimmed:
+            self.logger.info('Slimmed: %s' % self.slim_report.summary())
+        return exit_code
+
+    async def commit(self, tag):
+        self.logger.info('Committing container %s as: %s' %
+                         (self.container_id, tag))
+        exit_code, _ = await self._run_cli(
+            self._docker('commit', self.container_id, tag))
+        if exit_code != 0:
+            raise BuildMachineException(
+                'could not commit container as %s (exit code %d)' %
+                (tag, exit_code))
+
+    async def shutdown(self):
+        container_id = self.container_id
+        self.container_id = None
+        if container_id is None:
+            return
+        await self._remove_container(container_id)
+
+    async def _remove_container(self, container_id):
+        self.logger.info('Removing container: %s' % container_id)
+        await self._run_cli(self._docker('rm', '-f', container_id))
+
+
+def _run_in_executor(func, *args):
+    # template rendering, copying sources and hashing packages block, so
+    # they run in the default executor of the loop
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(func, *args))
+
+
+async def _run_build_machine(builder, build, result):
+    build_machine = AsyncBuildMachine(**builder._build_machine_args(build))
+    image_id = None
+    if builder.use_cache or builder.cache_python:
+        image_id = await build_machine.image_id()
+
+    prepared = await _run_in_executor(
+        builder._prepare_build, build, build_machine, image_id, result)
+    if prepared is None:
+        return
+    script, extra_binds, cache_key, git_commit = prepared
+
+    try:
+        try:
+            logger.info('Running build machine for: %s' % build.name)
+            result.exit_code = await build_machine.launch(
+                build_dir=result.build_dir, extra_binds=extra_binds)
+        finally:
+            result.phases = build_machine.phases
+            result.slimmed = build_machine.slimmed
+            result.log_tail = list(build_machine.log_tail)
+
+            # a cancelled build still gets its container removed
+            logger.info('Shutting down build machine: %s' % build.name)
+            await asyncio.shield(build_machine.shutdown())
+    except BaseException:
+        # cancelled builds too
+        await asyncio.shield(_run_in_executor(
+            builder._publish_broken_off, build, result))
+        raise
+
+    if (builder.use_cache or builder.only_changed) and \
+            result.exit_code == 0 and cache_key is None:
+        cache_key = await _run_in_executor(
+            builder._cache_key, build, script,
+            await build_machine.image_id(), git_commit)
+    await _run_in_executor(builder._finish_build, build, result, cache_key)
+
+
+def _check_builder(builder):
+    # builds on other docker hosts would need an endpoint per build, which
+    # the builds of the loop don't pick
+    if builder.endpoints is not None:
+        raise ValueError('the asyncio build engine does not support '
+                         'endpoints')
+
+
+async def run_build(builder, build):
+    # the coroutine version of Builder.run_build; a cancelled build
+    # returns a cancelled result instead of raising
+    _check_builder(builder)
+    result = BuildResult(build)
+    result.started = time.time()
+
+    try:
+        await _run_build_machine(builder, build, result)
+    except asyncio.CancelledError:
+        result.status = BuildResult.CANCELLED
+    except Exception as e:
+        logger.exception('Build failed: %s' % build.name)
+        result.error = e
+
+    result.finished = time.time()
+
+    if result.status == BuildResult.CANCELLED:
+        logger.info('Build cancelled: %s' % build.name)
+    elif result.error is None and result.exit_code == 0:
+        result.status = BuildResult.SUCCEEDED
+    else:
+        result.status = BuildResult.FAILED
+
+    if result.build_dir is not None:
+        result.collect_artifacts()
+        result.log_compression(logger)
+
+    return result
+
+
+async def _run_scheduled_build(builder, build, semaphore, tasks):
+    try:
+        async with semaphore:
+            result = await run_build(builder, build)
+    except asyncio.CancelledError:
+        # cancelled while waiting for its turn
+        result = BuildResult(build)
+        result.status = BuildResult.CANCELLED
+        return result
+    finally:
+        builder._build_finished()
+
+    if result.status == BuildResult.SUCCEEDED:
+        builder.durations.record(build, result.duration)
+        await _run_in_executor(builder.durations.save)
+    elif result.status == BuildResult.FAILED and builder.fail_fast:
+        logger.warning('Fail fast: cancelling the other builds')
+        builder.abort_event.set()
+        for task in tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    return result
+
+
+async def build_async(builder, max_workers=None):
+    # runs all builds of the builder as tasks of the running event loop,
+    # at most max_workers (by default the builder's max_workers) at the
+    # same time; returns their results in the order they were added.
+    # Cancelling this coroutine cancels all builds and removes their
+    # containers.
+    _check_builder(builder)
+    session_workers = await _run_in_executor(builder._start_session)
+    if max_workers is None:
+        max_workers = session_workers
+    semaphore = asyncio.Semaphore(max_workers)
+    builder.local_workers = max_workers
+
+    # the semaphore lets builds in, in the order they were scheduled, so
+    # the longest builds go first like with Builder.build
+    tasks = []
+    for build in builder.durations.longest_first(builder.builds):
+        tasks.append(asyncio.ensure_future(
+            _run_scheduled_build(builder, build, semaphore, tasks)))
+
+    results = await asyncio.gather(*tasks)
+    for result in results:
+        logger.info('%s: %s' % (result.build.name, result.status))
+
+    by_build = dict((r.build, r) for r in results)
+    return [by_build[build] for build in builder.builds]
@@ -1,14 +1,49 @@
+import collections
+import errno
+import functools
 import logging
 import os
+import posixpath
 import shutil
 import re
 import json
+import hashlib
 import threading
+import time
 
-from jinja2 import Environment, FileSystemLoader
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import Environment, FileSystemBytecodeCache, \
+    FileSystemLoader, TemplateError, Undefined
 
 from vdist import defaults
-from vdist.buildmachine import BuildMachine
+from vdist.buildmachine import BuildMachine, BuildMachineException, \
+    ContainerPool, DockerHostException
+from vdist.cache import ArtifactCache, _hash_file, fingerprint_source
+from vdist.endpoints import EndpointPool
+from vdist.mirrors import GitMirrorException, GitMirrors, git_available
+from vdist.scheduler import BuildDurations, build_jobs, host_resources, \
+    partition_resources, resolve_max_workers
+from vdist.stages import StageGraph
+from vdist.staging import SharedSources, source_files, stage_tree, \
+    write_file_list
+
+
+# names of the undefined variables printed while rendering a build script
+undefined_names = threading.local()
+
+
+class RecordingUndefined(Undefined):
+    # renders as an empty string, like jinja's default, but keeps track of
+    # the name; an undefined variable printed in a build script is most
+    # likely a typo
+
+    def __str__(self):
+        names = getattr(undefined_names, 'names', None)
+        if names is not None:
+            names.append(self._undefined_name)
+        return u''
+
+    __unicode__ = __str__
 
 
 class BuildProfile(object):
@@ -54,7 +89,12 @@ class Build(object):
                  working_dir='', python_basedir=None,
                  compile_python=True,
                  python_version=defaults.PYTHON_VERSION,
-                 requirements_path='/requirements.txt'):
+                 requirements_path='/requirements.txt',
+                 variant=None,
+                 optimize_python=False,
+                 slim=None, slim_globs=None,
+                 compression=None, compression_level=None,
+                 formats=None):
         self.app = app
         self.version = version.format(**os.environ)
         self.source = source
@@ -74,7 +114,53 @@ class Build(object):
         else:
             self.python_basedir = python_basedir.format(**os.environ)
         self.compile_python = compile_python
+        # profile guided and link time optimization of the interpreter
+        self.optimize_python = optimize_python
+
+        # the steps leaving what isn't needed at runtime out of the
+        # package; True means all of them
+        if slim is True:
+            slim = defaults.SLIM_STEPS
+        self.slim = list(slim or [])
+        unknown = set(self.slim) - set(defaults.SLIM_STEPS)
+        if unknown:
+            raise ValueError('unknown slim steps: %s' %
+                             ', '.join(sorted(unknown)))
+        self.slim_globs = []
+        if slim_globs:
+            self.slim_globs = [g.format(**os.environ) for g in slim_globs]
+
+        # None leaves the compression of the packages to fpm
+        if compression is not None and \
+                compression not in defaults.COMPRESSIONS:
+            raise ValueError('compression should be one of %s: %s' %
+                             (', '.join(defaults.COMPRESSIONS), compression))
+        self.compression = compression
+        if compression_level is not None:
+            compression_level = int(compression_level)
+            if compression is None:
+                raise ValueError('compression_level needs a compression')
+            lowest, highest = defaults.COMPRESSION_LEVELS[compression]
+            if not lowest <= compression_level <= highest:
+                raise ValueError('%s compression level should be %d to %d: '
+                                 '%d' % (compression, lowest, highest,
+                                         compression_level))
+        self.compression_level = compression_level
+
+        # the package formats to build, by default only the one of the
+        # profile (which Builder checks once it renders the build script)
+        self.formats = list(formats or [])
+        unknown = set(self.formats) - set(defaults.PACKAGE_FORMATS)
+        if unknown:
+            raise ValueError('unknown package formats: %s' %
+                             ', '.join(sorted(unknown)))
+        if compression == 'zstd' and 'rpm' in self.formats:
+            raise ValueError('rpms can\'t be compressed with zstd')
         self.python_version = python_version.format(**os.environ)
+        if optimize_python and not self._knows_optimizations(
+                self.python_version):
+            raise ValueError('optimize_python needs Python 2.7.13, 3.6 or '
+                             'newer: %s' % self.python_version)
         if custom_filename:
             self.custom_filename = custom_filename.format(**os.environ)
         else:
@@ -89,6 +175,8 @@ class Build(object):
             self.runtime_deps = runtime_deps
 
         self.profile = profile
+        # tells builds of the same app, version and profile apart
+        self.variant = variant
         self.fpm_args = fpm_args.format(**os.environ)
         self.pip_args = pip_args.format(**os.environ)
 
@@ -100,6 +188,15 @@ class Build(object):
     def __str__(self):
         return str(self.__dict__)
 
+    @staticmethod
+    def _knows_optimizations(python_version):
+        # older versions ignore --enable-optimizations and --with-lto
+        match = re.match(r'(\d+)\.(\d+)(?:\.(\d+))?', python_version)
+        if match is None:
+            return True
+        version = tuple(int(n or 0) for n in match.groups())
+        return version >= (3, 6) or (2, 7, 13) <= version < (3,)
+
     def get_project_root_from_source(self):
         if self.source['type'] == 'git':
             return os.path.basename(self.source['uri'].rstrip('/'))
@@ -108,13 +205,138 @@ class Build(object):
         return ''
 
     def get_safe_dirname(self):
+        parts = [self.app, self.version, self.profile]
+        if self.variant:
+            parts.append(self.variant)
         return re.sub(
             '[^A-Za-z0-9\.\-]',
             '_',
-            '-'.join(
-                [self.app, self.version, self.profile]
-            )
+            '-'.join(parts)
+        )
+
+
+class BuildResult(object):
+
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, build):
+        self.build = build
+        self.status = None
+        self.exit_code = None
+        self.error = None
+        self.build_dir = None
+        self.artifacts = []
+        self.phases = {}
+        # bytes left out of the packages, per slimming step
+        self.slimmed = {}
+        self.cached = False
+        self.unchanged = False
+        # the name of the endpoint the build ran on
+        self.endpoint = None
+        # the output of the build script, when machine_logs is set, and its
+        # last lines
+        self.log_file = None
+        self.log_tail = []
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def succeeded(self):
+        return self.status == self.SUCCEEDED
+
+    @property
+    def compression(self):
+        # the codec the packages were compressed with, how long calling
+        # fpm took and how big the packages are, to compare codecs by
+        return {
+            'codec': self.build.compression or 'default',
+            'level': self.build.compression_level,
+            'seconds': self.phases.get('fpm'),
+            'size': sum(os.path.getsize(a) for a in self.artifacts)
+        }
+
+    def log_compression(self, logger):
+        compression = self.compression
+        if compression['seconds'] is None:
+            return
+        logger.info('%s: packaged with %s%s in %.1fs, %.1fMB' % (
+            self.build.name, compression['codec'],
+            '' if compression['level'] is None
+            else ' level %d' % compression['level'],
+            compression['seconds'], compression['size'] / 1024.0 / 1024))
+
+    def collect_artifacts(self):
+        # the build scripts copy the resulting packages to the root of
+        # the build dir, next to the scratch dir
+        self.artifacts = sorted(
+            os.path.join(self.build_dir, f)
+            for f in os.listdir(self.build_dir)
+            if os.path.isfile(os.path.join(self.build_dir, f))
         )
+        return self.artifacts
+
+    def digests(self):
+        # the sha256 of every package, by file name
+        return dict((os.path.basename(a), _hash_file(a).hexdigest())
+                    for a in self.artifacts)
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
+class ReproducibilityReport(object):
+    # the packages of two builds of the same build, see Builder.verify
+
+    def __init__(self, build):
+        self.build = build
+        # the digests of the packages of both builds, by file name
+        self.first = None
+        self.second = None
+        self.error = None
+
+    @property
+    def differences(self):
+        # the packages that differ, or that only one of the builds made
+        if self.first is None or self.second is None:
+            return []
+        return sorted(name for name in set(self.first) | set(self.second)
+                      if self.first.get(name) != self.second.get(name))
+
+    @property
+    def reproducible(self):
+        return self.error is None and bool(self.first) and \
+            self.second is not None and not self.differences
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
+class BuildPlan(object):
+
+    def __init__(self, build):
+        self.build = build
+        self.profile = None
+        self.image = None
+        self.prewarmed_image = None
+        self.script = None
+        self.script_digest = None
+        self.source_fingerprint = None
+        self.errors = []
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def __str__(self):
+        return str(self.__dict__)
 
 
 class Builder(object):
@@ -122,7 +344,25 @@ class Builder(object):
     def __init__(
             self,
             profiles_dir=defaults.LOCAL_PROFILES_DIR,
-            machine_logs=True):
+            machine_logs=True,
+            max_workers=defaults.MAX_WORKERS,
+            fail_fast=False,
+            use_cache=False,
+            cache_python=True,
+            cache_wheels=True,
+            cache_packages=True,
+            system_update_interval=None,
+            pool_size=0,
+            pool_max_uses=10,
+            pool_max_memory=None,
+            stage_sources=defaults.STAGE_SOURCES,
+            mirror_git_sources=True,
+            only_changed=False,
+            share_stages=False,
+            endpoints=None,
+            limit_resources=False,
+            cache_compiler=False,
+            reproducible=False):
         logging.basicConfig(format='%(asctime)s %(levelname)s '
                             '[%(threadName)s] %(name)s %(message)s',
                             level=logging.INFO)
@@ -130,14 +370,101 @@ class Builder(object):
 
         self.build_basedir = defaults.BUILD_BASEDIR
         self.profiles = {}
+        self.profiles_loaded = None
         self.builds = []
 
         self.machine_logs = machine_logs
         self.local_profiles_dir = profiles_dir
+        self.max_workers = max_workers
+        self.fail_fast = fail_fast
+        self.use_cache = use_cache
+        self.only_changed = only_changed
+        self.share_stages = share_stages
+        self.endpoints = None
+        if endpoints:
+            self.endpoints = EndpointPool(endpoints)
+            # shared stages run on the local daemon and fill the caches of
+            # this host, which builds on other daemons can't use
+            if share_stages:
+                self.logger.warning('Shared stages are turned off for '
+                                    'builds on endpoints')
+                self.share_stages = False
+        self.limit_resources = limit_resources
+        # the cores and memory of this host, the number of builds that run
+        # on it at the same time and the builds of the run that haven't
+        # finished yet, set per run; see _build_resources
+        self.host_resources = None
+        self.local_workers = 0
+        self.unfinished_builds = 0
+        self.unfinished_builds_lock = threading.Lock()
+        self.cache = ArtifactCache()
+        self.cache_python = cache_python
+        self.python_cache_dir = defaults.PYTHON_CACHE_DIR
+        self.prewarm_basedir = defaults.PREWARM_BASEDIR
+        # builds start from the images made by prewarm when there are any
+        self.use_prewarmed_images = True
+        self.cache_wheels = cache_wheels
+        self.wheelhouse_dir = defaults.WHEELHOUSE_DIR
+        self.cache_packages = cache_packages
+        self.package_cache_dir = defaults.PACKAGE_CACHE_DIR
+        self.cache_compiler = cache_compiler
+        self.ccache_dir = defaults.CCACHE_DIR
+        self.reproducible = reproducible
+        self.template_cache_dir = defaults.TEMPLATE_CACHE_DIR
+        self.template_env = None
+        self.system_update_interval = system_update_interval
+
+        if stage_sources not in ['copy', 'link', 'mount']:
+            raise ValueError('stage_sources should be "copy", "link" or '
+                             '"mount": %s' % stage_sources)
+        self.stage_sources = stage_sources
+        self.shared_sources = SharedSources(self._shared_sources_dir())
+
+        self.git_mirrors = None
+        if mirror_git_sources:
+            if git_available():
+                self.git_mirrors = GitMirrors()
+            else:
+                self.logger.warning('git not found, git sources are cloned '
+                                    'in the build machines')
+
+        self.container_pool = None
+        if pool_size > 0:
+            self.container_pool = ContainerPool(
+                max_idle=pool_size,
+                max_uses=pool_max_uses,
+                max_memory=pool_max_memory)
+        self.durations = BuildDurations()
+
+        self.build_machines = {}
+        self.build_machines_lock = threading.Lock()
+        self.abort_event = threading.Event()
 
     def add_build(self, **kwargs):
         self.builds.append(Build(**kwargs))
 
+    def add_matrix(self, profiles, apps, python_versions=None, **kwargs):
+        # adds a build for every combination of profile, Python version
+        # and app; apps are dicts of add_build arguments, the keyword
+        # arguments apply to all builds
+        if python_versions is None:
+            python_versions = [defaults.PYTHON_VERSION]
+        for app in apps:
+            for profile in profiles:
+                for python_version in python_versions:
+                    build_args = dict(kwargs)
+                    build_args.update(app)
+                    build_args['profile'] = profile
+                    build_args['python_version'] = python_version
+                    if len(python_versions) > 1:
+                        build_args['variant'] = 'python%s' % python_version
+                        if 'name' in app:
+                            build_args['name'] = '%s %s python%s' % (
+                                app['name'], profile, python_version)
+                    elif 'name' in app:
+                        build_args['name'] = '%s %s' % (app['name'], profile)
+                    self.add_build(**build_args)
+
     def _create_vdist_dir(self):
         vdist_path = os.path.join(os.path.expanduser('~'), '.vdist')
         if not os.path.exists(vdist_path):
@@ -160,55 +487,113 @@ class Builder(object):
                 self.profiles[profile_id] = profile
 
     def _load_profiles(self):
+        local_profiles = os.path.join(
+            self.local_profiles_dir, defaults.LOCAL_PROFILES_FILE)
+        local_mtime = None
+        if os.path.isfile(local_profiles):
+            local_mtime = os.path.getmtime(local_profiles)
+
+        # only read the profiles again when the local ones changed
+        if self.profiles_loaded == (local_profiles, local_mtime):
+            return
+        self.profiles_loaded = (local_profiles, local_mtime)
+
         internal_profiles = os.path.join(
             os.path.dirname(__file__),
             'profiles', 'internal_profiles.json')
         self._add_profiles_from_file(internal_profiles)
 
-        local_profiles = os.path.join(
-            self.local_profiles_dir, defaults.LOCAL_PROFILES_FILE)
-        if os.path.isfile(local_profiles):
+        if local_mtime is not None:
             self._add_profiles_from_file(local_profiles)
 
-    def _render_template(self, build):
+    def _template_environment(self):
+        # compiling the templates takes longer than rendering them, so the
+        # environment is kept, and the compiled templates are cached on disk
+        if self.template_env is not None:
+            return self.template_env
+
         internal_template_dir = os.path.join(
             os.path.dirname(__file__), 'profiles')
 
         local_template_dir = os.path.abspath(self.local_profiles_dir)
 
-        env = Environment(loader=FileSystemLoader(
-            [internal_template_dir, local_template_dir]))
+        self._makedirs(self.template_cache_dir)
+        self.template_env = Environment(
+            loader=FileSystemLoader(
+                [internal_template_dir, local_template_dir]),
+            bytecode_cache=FileSystemBytecodeCache(self.template_cache_dir),
+            undefined=RecordingUndefined)
+        return self.template_env
 
+    def _render(self, build, **context):
+        # returns the build script and the undefined variables it printed
         if build.profile not in self.profiles:
             raise BuildProfileNotFoundException(
                 'profile not found: %s' % build.profile)
 
         profile = self.profiles[build.profile]
         template_name = profile.script
-        template = env.get_template(template_name)
-
-        scratch_dir = os.path.join(
-            defaults.SHARED_DIR,
-            defaults.SCRATCH_DIR
-        )
+        template = self._template_environment().get_template(template_name)
 
         # local uid and gid are needed to correctly set permissions
         # on the created artifacts after the build completes
-        return template.render(
+        variables = dict(
             local_uid=os.getuid(),
             local_gid=os.getgid(),
             project_root=build.get_project_root_from_source(),
             shared_dir=defaults.SHARED_DIR,
-            scratch_dir=scratch_dir,
-            **build.__dict__
+            reproducible=self.reproducible,
+            source_date_epoch=None
+        )
+        variables.update(build.__dict__)
+        variables.update(context)
+
+        variables['scratch_dir'] = posixpath.join(
+            variables['shared_dir'],
+            defaults.SCRATCH_DIR
         )
 
-    def _clean_build_basedir(self):
-        if os.path.exists(self.build_basedir):
-            shutil.rmtree(self.build_basedir)
+        undefined_names.names = []
+        try:
+            # rendered like template.render does, keeping the context for
+            # the package format the profile sets
+            template_context = template.new_context(variables)
+            script = u''.join(template.root_render_func(template_context))
+            undefined = sorted(set(undefined_names.names))
+        finally:
+            undefined_names.names = None
+
+        formats = build.formats or \
+            [template_context.vars.get('native_format')]
+        if build.compression == 'zstd' and 'rpm' in formats:
+            raise ValueError('rpms can\'t be compressed with zstd: %s' %
+                             build.name)
+        return script, undefined
+
+    def _render_template(self, build, **context):
+        script, undefined = self._render(build, **context)
+        if undefined:
+            self.logger.warning('Undefined variables in build script of '
+                                '%s: %s' % (build.name, ', '.join(undefined)))
+        return script
 
     def _create_build_basedir(self):
-        os.mkdir(self.build_basedir)
+        # the build dirs of earlier runs are kept, only the sources they
+        # were built from and leftover shared stages are removed. Pooled
+        # containers of earlier runs have the shared sources dir bound, so
+        # only what's in it goes.
+        self._makedirs(self.build_basedir)
+        sources_dir = self._shared_sources_dir()
+        paths = [os.path.join(self.build_basedir, defaults.SHARED_STAGES_DIR)]
+        if os.path.isdir(sources_dir):
+            paths += [os.path.join(sources_dir, name)
+                      for name in os.listdir(sources_dir)]
+        for path in paths:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def _shared_sources_dir(self):
+        return os.path.join(self.build_basedir, defaults.SHARED_SOURCES_DIR)
 
     @staticmethod
     def _write_build_script(path, script):
@@ -216,11 +601,14 @@ class Builder(object):
             f.write(script)
         os.chmod(path, 0o777)
 
-    def _populate_scratch_dir(self, scratch_dir, build):
+    def _populate_scratch_dir(self, scratch_dir, build, script=None):
+        if script is None:
+            script = self._render_template(build)
+
         # write rendered build script to scratch dir
         self._write_build_script(
             os.path.join(scratch_dir, defaults.SCRATCH_BUILDSCRIPT_NAME),
-            self._render_template(build)
+            script
         )
 
         # copy local ~/.pip if necessary
@@ -230,84 +618,1112 @@ class Builder(object):
                 os.path.join(scratch_dir, '.pip')
             )
 
-        # local source type, copy local dir to scratch dir
-        if build.source['type'] in ['directory', 'git_directory']:
-            if not os.path.exists(build.source['path']):
-                raise ValueError(
-                    'path does not exist: %s' % build.source['path'])
-            else:
-                subdir = os.path.basename(build.source['path'])
-                shutil.copytree(
-                    build.source['path'].rstrip('/'),
-                    os.path.join(scratch_dir, subdir)
-                )
+    def _build_dir(self, build):
+        return os.path.join(self.build_basedir, build.get_safe_dirname())
 
-    def _create_build_dir(self, build):
-        subdir_name = build.get_safe_dirname()
+    def _staging_dir(self, build):
+        # builds run in a staging dir, which only replaces the build dir of
+        # an earlier run when the build succeeds
+        return os.path.join(self.build_basedir,
+                            '.%s.tmp' % build.get_safe_dirname())
 
-        build_dir = os.path.join(self.build_basedir, subdir_name)
+    def _create_empty_build_dir(self, build):
+        build_dir = self._staging_dir(build)
 
         if os.path.exists(build_dir):
             shutil.rmtree(build_dir)
 
         os.mkdir(build_dir)
+        os.mkdir(os.path.join(build_dir, defaults.SCRATCH_DIR))
+
+        return build_dir
 
-        # create "scratch" subdirectory for stuff needed at build time
+    def _publish_build_dir(self, build, staging_dir, succeeded):
+        # swaps the staging dir with the build dir of the previous run; a
+        # failed build keeps the previous packages, and ends up next to
+        # them for inspection
+        build_dir = self._build_dir(build)
+        if not succeeded:
+            build_dir += '.failed'
+        elif os.path.exists(build_dir + '.failed'):
+            shutil.rmtree(build_dir + '.failed')
+
+        previous_dir = None
+        if os.path.exists(build_dir):
+            previous_dir = '%s.%d.old' % (staging_dir, os.getpid())
+            os.rename(build_dir, previous_dir)
+        os.rename(staging_dir, build_dir)
+        if previous_dir is not None:
+            shutil.rmtree(previous_dir)
+        return build_dir
+
+    def _fingerprint_path(self, build_dir):
+        return os.path.join(build_dir, defaults.SCRATCH_DIR,
+                            defaults.SCRATCH_FINGERPRINT_NAME)
+
+    def _unchanged(self, build, fingerprint):
+        # whether the build dir of an earlier run was built from the same
+        # inputs and still holds its packages
+        build_dir = self._build_dir(build)
+        try:
+            with open(self._fingerprint_path(build_dir)) as f:
+                if f.read().strip() != fingerprint:
+                    return False
+        except IOError:
+            return False
+        return any(os.path.isfile(os.path.join(build_dir, f))
+                   for f in os.listdir(build_dir))
+
+    def _create_build_dir(self, build, script=None):
+        # the "scratch" subdirectory holds stuff needed at build time
+        build_dir = self._create_empty_build_dir(build)
         scratch_dir = os.path.join(build_dir, defaults.SCRATCH_DIR)
-        os.mkdir(scratch_dir)
 
         # write necessary stuff to scratch_dir
-        self._populate_scratch_dir(scratch_dir, build)
+        self._populate_scratch_dir(scratch_dir, build, script)
 
         return build_dir
 
+    @staticmethod
+    def _cache_key(build, script, image_id, git_commit=None):
+        # everything that ends up in the package: the rendered build
+        # script (which holds all build arguments), the source and the
+        # image it is built on
+        inputs = [script, fingerprint_source(build.source, git_commit),
+                  image_id]
+        if build.use_local_pip_conf:
+            pip_conf = os.path.join(os.path.expanduser('~'), '.pip')
+            inputs.append(fingerprint_source(
+                {'type': 'directory', 'path': pip_conf}))
+        return ArtifactCache.key(*inputs)
+
     def run_build(self, build):
+        result = BuildResult(build)
+        result.started = time.time()
+
+        try:
+            self._run_build_machine(build, result)
+        except Exception as e:
+            self.logger.exception('Build failed: %s' % build.name)
+            result.error = e
+
+        result.finished = time.time()
+
+        if self.abort_event.is_set() and result.exit_code != 0:
+            # torn down because a sibling build failed
+            result.status = BuildResult.CANCELLED
+        elif result.error is None and result.exit_code == 0:
+            result.status = BuildResult.SUCCEEDED
+        else:
+            result.status = BuildResult.FAILED
+
+        if result.build_dir is not None:
+            result.collect_artifacts()
+            result.log_compression(self.logger)
+
+        return result
+
+    def _provisioning(self, build):
+        # the provisioning part of a build script only depends on the
+        # profile and the build dependencies; returns a key identifying
+        # that and the tag of the prewarmed image for it
+        if build.profile not in self.profiles:
+            raise BuildProfileNotFoundException(
+                'profile not found: %s' % build.profile)
         profile = self.profiles[build.profile]
 
-        build_dir = self._create_build_dir(build)
+        env = self._template_environment()
+        template_source = env.loader.get_source(env, profile.script)[0]
+
+        digest = hashlib.sha256()
+        for value in [profile.docker_image, template_source] + \
+                sorted(build.build_deps):
+            digest.update(value.encode('utf-8'))
+            digest.update(b'\0')
+        key = digest.hexdigest()[:16]
+
+        tag = '%s/%s:%s' % (
+            defaults.PREWARMED_IMAGE_PREFIX,
+            re.sub('[^a-z0-9_.-]', '-', profile.profile_id.lower()),
+            key)
+        return key, tag
+
+    def _prewarm_image(self, build, key, tag):
+        threading.current_thread().name = 'prewarm %s' % tag
+        profile = self.profiles[build.profile]
 
-        self.logger.info('launching docker image: %s' % profile.docker_image)
+        prewarm_dir = os.path.join(self.prewarm_basedir, key)
+        if os.path.exists(prewarm_dir):
+            shutil.rmtree(prewarm_dir)
+        scratch_dir = os.path.join(prewarm_dir, defaults.SCRATCH_DIR)
+        os.makedirs(scratch_dir)
+        self._write_build_script(
+            os.path.join(scratch_dir, defaults.SCRATCH_BUILDSCRIPT_NAME),
+            self._render_template(build, provision_key=key,
+                                  provision_only=True)
+        )
 
         build_machine = BuildMachine(
             machine_logs=self.machine_logs,
             image=profile.docker_image,
             insecure_registry=profile.insecure_registry
         )
+        try:
+            exit_code = build_machine.launch(build_dir=prewarm_dir)
+            if exit_code != 0:
+                raise BuildMachineException(
+                    'provisioning failed with exit code %d' % exit_code)
+            build_machine.commit(tag)
+        finally:
+            build_machine.shutdown()
+            shutil.rmtree(prewarm_dir)
+
+        self.logger.info('*** Prewarmed image: %s ***' % tag)
+        return tag
+
+    def prewarm(self):
+        # provision every distinct profile/build dependencies combination
+        # of the added builds once, and commit the result as a local image
+        # that later builds start from
+        self._create_vdist_dir()
+        self._load_profiles()
+
+        if len(self.builds) < 1:
+            raise NoBuildsFoundException()
+
+        images = collections.OrderedDict()
+        for build in self.builds:
+            key, tag = self._provisioning(build)
+            if tag not in images:
+                images[tag] = (build, key)
+
+        max_workers = resolve_max_workers(self.max_workers, len(images))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(self._prewarm_image, build, key, tag)
+                   for tag, (build, key) in images.items()]
+        executor.shutdown(wait=True)
 
-        self.logger.info('Running build machine for: %s' % build.name)
-        build_machine.launch(build_dir=build_dir)
+        return [future.result() for future in futures]
 
-        self.logger.info('Shutting down build machine: %s' % build.name)
-        build_machine.shutdown()
+    @staticmethod
+    def _makedirs(path):
+        # builds running at the same time share these directories
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _prewarmed_image(self, build):
+        # the provisioning stage of shared stage builds, which only needs
+        # to run when there's no prewarmed image yet
+        key, tag = self._provisioning(build)
+        if BuildMachine().image_id(tag) is not None:
+            return tag
+        return self._prewarm_image(build, key, tag)
+
+    def _run_stage(self, build, stage):
+        # runs the build script of build up to and including stage, which
+        # fills the host caches the other builds sharing the stage use
+        threading.current_thread().name = '%s %s' % (stage, build.name)
+
+        build_machine = BuildMachine(**self._build_machine_args(build))
+        image_id = None
+        if self.cache_python:
+            image_id = build_machine.image_id()
+
+        stage_dir = os.path.join(
+            self.build_basedir, defaults.SHARED_STAGES_DIR,
+            '%s-%s' % (stage, build.get_safe_dirname()))
+        binds = {}
+        git_commit = None
+        if self.git_mirrors is not None and build.source['type'] == 'git':
+            git_commit = self.git_mirrors.resolve(
+                build.source['uri'], build.source['branch'])
+        context = self._build_context(build, image_id, binds, git_commit)
+        self._create_cache_dirs(binds)
+        context['stop_after'] = stage
+        if 'source_mount' in context:
+            self._source_context(build, context, binds)
+            self._prepare_source(build, context)
+
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+        scratch_dir = os.path.join(stage_dir, defaults.SCRATCH_DIR)
+        os.makedirs(scratch_dir)
+        self._populate_scratch_dir(
+            scratch_dir, build, self._render_template(build, **context))
+
+        with self.build_machines_lock:
+            if self.abort_event.is_set():
+                raise BuildMachineException('build aborted')
+            self.build_machines[stage_dir] = build_machine
+
+        try:
+            exit_code = build_machine.launch(build_dir=stage_dir,
+                                             extra_binds=binds)
+        finally:
+            with self.build_machines_lock:
+                self.build_machines.pop(stage_dir, None)
+            build_machine.shutdown()
+
+        if exit_code != 0:
+            raise BuildMachineException(
+                'stage %s failed with exit code %d' % (stage, exit_code))
+        shutil.rmtree(stage_dir)
+        self.logger.info('*** Finished stage %s of: %s ***' %
+                         (stage, build.name))
+
+    def _resolve_git_sources(self):
+        # fetches the mirrors of all git sources at the same time, so a
+        # slow clone doesn't hold up setting up the stages of the others;
+        # returns the commit, or the error, per uri and branch
+        sources = sorted(set((build.source['uri'], build.source['branch'])
+                             for build in self.builds
+                             if build.source['type'] == 'git'))
+        if self.git_mirrors is None or not sources:
+            return {}
+
+        def resolve(source):
+            try:
+                return self.git_mirrors.resolve(*source), None
+            except GitMirrorException as e:
+                return None, e
+
+        executor = ThreadPoolExecutor(
+            max_workers=resolve_max_workers(self.max_workers, len(sources)))
+        try:
+            return dict(zip(sources, executor.map(resolve, sources)))
+        finally:
+            executor.shutdown()
+
+    def _requirements_digest(self, build, git_commits):
+        # the requirements of a build, or None when they can't be read
+        # before the build runs
+        path = posixpath.join(build.working_dir,
+                              build.requirements_path.lstrip('/'))
+        requirements = None
+        if build.source['type'] in ['directory', 'git_directory']:
+            try:
+                with open(os.path.join(build.source['path'], path),
+                          'rb') as f:
+                    requirements = f.read()
+            except IOError:
+                return None
+        elif build.source['type'] == 'git' and self.git_mirrors is not None:
+            commit, error = git_commits[(build.source['uri'],
+                                         build.source['branch'])]
+            if error is not None:
+                raise error
+            requirements = self.git_mirrors.read(build.source['uri'],
+                                                 commit, path)
+        if requirements is None:
+            return None
+        return hashlib.sha256(requirements).hexdigest()
+
+    def _stage_graph(self):
+        # every build becomes a chain of stages: provisioning per profile
+        # and build dependencies, the interpreter per Python version, the
+        # requirements per set of requirements, and finally the build
+        # itself; builds share the stages with the same key
+        graph = StageGraph()
+        build_stages = []
+        git_commits = {}
+        if self.cache_wheels:
+            git_commits = self._resolve_git_sources()
+        for build in self.durations.longest_first(self.builds):
+            key = ('build', build.name, build.get_safe_dirname())
+            try:
+                stages = self._add_shared_stages(graph, build, git_commits)
+            except Exception as e:
+                # like a build that fails to start, a build whose stages
+                # can't be set up fails on its own
+                self.logger.exception('Build failed: %s' % build.name)
+                build_stages.append((build, graph.add(
+                    key, functools.partial(self._stage_failed, build, e))))
+                continue
+
+            build_stages.append((build, graph.add(
+                key, functools.partial(self._run_scheduled_build, build),
+                depends_on=stages,
+                on_dependency_failure=functools.partial(
+                    self._stage_failed, build))))
+        return graph, build_stages
+
+    def _add_shared_stages(self, graph, build, git_commits):
+        # adds the stages build shares with other builds to graph; returns
+        # the keys of the stages the build itself depends on
+        _, tag = self._provisioning(build)
+        provision = graph.add(('provision', tag),
+                              functools.partial(self._prewarmed_image, build))
+        stages = [provision]
+
+        if build.compile_python and self.cache_python:
+            # the same inputs as the key of the interpreter cache: the
+            # image, the Python version and the configure flags, which
+            # come from the profile's script and optimize_python; builds
+            # with other build dependencies share it, so the stages after
+            # it still wait for their own provisioning
+            profile = self.profiles[build.profile]
+            stages = [provision, graph.add(
+                ('compile_python', profile.docker_image, profile.script,
+                 build.python_version, build.optimize_python),
+                functools.partial(self._run_stage, build, 'compile_python'),
+                depends_on=[provision])]
+
+        if self.cache_wheels:
+            requirements = self._requirements_digest(build, git_commits)
+            if requirements is not None:
+                stages = [graph.add(
+                    ('install_requirements', requirements, build.pip_args,
+                     tag, build.python_version, build.python_basedir,
+                     build.compile_python, build.optimize_python),
+                    functools.partial(self._run_stage, build,
+                                      'install_requirements'),
+                    depends_on=stages)]
+        return stages
+
+    def _stage_failed(self, build, error):
+        result = BuildResult(build)
+        result.error = error
+        result.status = BuildResult.CANCELLED
+        if not self.abort_event.is_set():
+            result.status = BuildResult.FAILED
+            self.logger.error('Shared stage of %s failed: %s' %
+                              (build.name, error))
+            if self.fail_fast:
+                self._abort_builds()
+        return result
+
+    def _prepare_python_cache(self, build, image_id, context, binds):
+        profile = self.profiles[build.profile]
+
+        binds[self.python_cache_dir] = defaults.CONTAINER_PYTHON_CACHE_DIR
+
+        context['python_cache_dir'] = defaults.CONTAINER_PYTHON_CACHE_DIR
+        context['python_cache_tag'] = image_id or profile.docker_image
+
+    def _prepare_wheelhouse(self, build, context, binds):
+        # the build script adds a subdirectory per Python ABI
+        wheelhouse_dir = os.path.join(self.wheelhouse_dir, build.profile)
+        binds[wheelhouse_dir] = defaults.CONTAINER_WHEELHOUSE_DIR
+
+        context['wheelhouse_dir'] = defaults.CONTAINER_WHEELHOUSE_DIR
+
+    def _prepare_package_cache(self, build, context, binds):
+        package_cache_dir = os.path.join(self.package_cache_dir, build.profile)
+        binds[package_cache_dir] = defaults.CONTAINER_PACKAGE_CACHE_DIR
+
+        context['package_cache_dir'] = defaults.CONTAINER_PACKAGE_CACHE_DIR
+        context['system_update_interval'] = self.system_update_interval
+
+    def _prepare_ccache(self, build, context, binds):
+        # object files depend on the compiler of the profile
+        ccache_dir = os.path.join(self.ccache_dir, build.profile)
+        binds[ccache_dir] = defaults.CONTAINER_CCACHE_DIR
+
+        context['ccache_dir'] = defaults.CONTAINER_CCACHE_DIR
+        context['ccache_max_size'] = defaults.CCACHE_MAX_SIZE
+
+    def _staging_method(self, context):
+        # builds on remote daemons can't bind the source itself, so those
+        # get it staged like a linked one, which leaves out ignored files
+        # too, and copied in
+        if self.stage_sources == 'mount' and 'source_files' not in context:
+            return 'link'
+        return self.stage_sources
+
+    def _source_key(self, build, context):
+        git_commit = context.get('git_commit')
+        if git_commit is not None:
+            return 'git', build.source['uri'], git_commit
+        return (build.source['type'], os.path.abspath(build.source['path']),
+                build.source.get('branch', ''),
+                self._staging_method(context))
+
+    def _stage_source(self, build, git_commit, method, source_dir):
+        project_root = build.get_project_root_from_source()
+        target = os.path.join(source_dir, project_root)
+
+        # git source resolved in a mirror, export the commit
+        if git_commit is not None:
+            self.git_mirrors.export(build.source['uri'], git_commit, target)
+            return
+
+        if not os.path.exists(build.source['path']):
+            raise ValueError(
+                'path does not exist: %s' % build.source['path'])
+
+        source_path = build.source['path'].rstrip('/')
+        # a git_directory gets checked out inside the build machine, and
+        # the install step of other sources may take the version from .git
+        # too; the build script removes it before packaging
+        if method == 'copy':
+            shutil.copytree(source_path, target)
+        elif method == 'link':
+            stage_tree(source_path, target, include_vcs=True)
+        else:
+            # the source itself gets mounted here, the build machine
+            # copies the files that aren't ignored from it
+            os.makedirs(target)
+            write_file_list(
+                source_path,
+                os.path.join(source_dir, defaults.SOURCE_FILES_NAME),
+                prefix=project_root + '/', include_vcs=True)
+
+    def _source_context(self, build, context, binds, pooled=False):
+        # builds with the same source share a single read-only copy of it;
+        # binds it and points the build script at it, _prepare_source
+        # stages it once the build turns out to run
+        source_dir = self.shared_sources.source_dir(
+            self._source_key(build, context))
+        if pooled:
+            # pooled containers outlive the build, and the dirs sources are
+            # staged in, so they have the dir of all shared sources bound
+            staged_dir = posixpath.join(defaults.POOL_SOURCES_DIR,
+                                        os.path.basename(source_dir))
+            binds[self._shared_sources_dir()] = \
+                '%s:ro' % defaults.POOL_SOURCES_DIR
+        else:
+            staged_dir = defaults.CONTAINER_SOURCE_DIR
+            binds[source_dir] = '%s:ro' % staged_dir
+
+        if 'source_files' in context:
+            # the source itself is bound, the staged dir only has the list
+            # of its files
+            source_path = os.path.abspath(build.source['path'].rstrip('/'))
+            binds[source_path] = '%s:ro' % posixpath.join(
+                defaults.CONTAINER_SOURCE_DIR, os.path.basename(source_path))
+            context['source_files'] = posixpath.join(
+                staged_dir, defaults.SOURCE_FILES_NAME)
+        else:
+            context['source_mount'] = staged_dir
 
-        self.logger.info('*** Resulting OS packages are in: %s ***' % build_dir)
+    def _prepare_source(self, build, context):
+        git_commit = context.get('git_commit')
+        self.shared_sources.prepare(
+            self._source_key(build, context),
+            functools.partial(self._stage_source, build, git_commit,
+                              self._staging_method(context)))
+
+    @staticmethod
+    def _reset_paths(build):
+        # everything a build leaves behind in its container
+        return [
+            posixpath.join(build.package_tmp_root, '*'),
+            posixpath.join(build.package_install_root, build.app),
+            build.python_basedir,
+            '/var/tmp/Python-*',
+            '/root/.pip'
+        ]
+
+    def _container_pool(self, build):
+        # a build that doesn't compile Python installs into an interpreter
+        # of the image, which can't be reset for the next build
+        if build.compile_python:
+            return self.container_pool
+        return None
+
+    def _build_machine_args(self, build):
+        profile = self.profiles[build.profile]
+        provision_key, prewarmed_image = self._provisioning(build)
+        if not self.use_prewarmed_images:
+            prewarmed_image = None
+        args = dict(
+            machine_logs=self.machine_logs,
+            image=profile.docker_image,
+            insecure_registry=profile.insecure_registry,
+            prewarmed_image=prewarmed_image,
+            provision_key=provision_key
+        )
+        resources = self._build_resources()
+        if resources is not None:
+            cpus, memory = resources
+            args['jobs'] = build_jobs(cpus)
+            if self.limit_resources:
+                args['cpus'] = cpus
+                args['memory'] = memory
+        return args
+
+    def _build_resources(self):
+        # the share of this host a build starting now gets: the builds that
+        # haven't finished yet run at the same time as far as there are
+        # workers for them, so the builds at the end of a run, or a build
+        # running alone, get more of it
+        if self.host_resources is None:
+            return None
+        with self.unfinished_builds_lock:
+            builds = min(self.local_workers, self.unfinished_builds)
+        return partition_resources(self.host_resources, max(1, builds))
+
+    def _build_finished(self, *args):
+        with self.unfinished_builds_lock:
+            self.unfinished_builds -= 1
+
+    def _build_context(self, build, image_id, binds, git_commit=None,
+                       host_caches=True):
+        # the variables the build script is rendered with, next to those
+        # of the build itself; binds gets the host dirs they refer to.
+        # Builds on remote daemons can't use the caches on this host, nor
+        # have the source itself bound.
+        provision_key, _ = self._provisioning(build)
+        context = {
+            'provision_key': provision_key,
+            'shared_dir': defaults.SHARED_DIR
+        }
+        if host_caches and self.cache_python and build.compile_python:
+            self._prepare_python_cache(build, image_id, context, binds)
+        if host_caches and self.cache_wheels:
+            self._prepare_wheelhouse(build, context, binds)
+        if host_caches and self.cache_packages:
+            self._prepare_package_cache(build, context, binds)
+        if host_caches and self.cache_compiler:
+            self._prepare_ccache(build, context, binds)
+
+        if self.reproducible:
+            context['source_date_epoch'] = self._source_date_epoch(
+                build, git_commit)
+
+        if git_commit is not None:
+            context['git_commit'] = git_commit
+        if git_commit is not None or \
+                build.source['type'] in ['directory', 'git_directory']:
+            context['source_mount'] = defaults.CONTAINER_SOURCE_DIR
+            if self.stage_sources == 'mount' and git_commit is None and \
+                    host_caches:
+                context['source_files'] = posixpath.join(
+                    defaults.CONTAINER_SOURCE_DIR, defaults.SOURCE_FILES_NAME)
+        return context
+
+    def _create_cache_dirs(self, binds):
+        # the host dirs of the caches _build_context binds; it leaves
+        # creating them to the builds, so planning doesn't touch the host
+        for host_path in binds:
+            self._makedirs(host_path)
+
+    def _source_date_epoch(self, build, git_commit):
+        # the time the files of reproducible packages get: the time of the
+        # commit built, or of the newest file of a directory; None leaves
+        # it to the build script, which checks out the commit itself
+        if 'SOURCE_DATE_EPOCH' in os.environ:
+            return int(os.environ['SOURCE_DATE_EPOCH'])
+        if git_commit is not None:
+            return self.git_mirrors.commit_time(build.source['uri'],
+                                                git_commit)
+        path = build.source.get('path')
+        if build.source['type'] == 'directory' and os.path.isdir(path):
+            mtimes = [os.lstat(os.path.join(path, f)).st_mtime
+                      for f in source_files(path)]
+            if mtimes:
+                return int(max(mtimes))
+        return None
+
+    def _prepare_build(self, build, build_machine, image_id, result):
+        # renders the build script and sets up the build dir; returns the
+        # script, the binds it needs, its cache key and the commit of a git
+        # source, or None when the packages were restored from the cache
+        # instead
+        build_dir = self._staging_dir(build)
+        extra_binds = {}
+        git_commit = None
+        if self.git_mirrors is not None and build.source['type'] == 'git':
+            git_commit = self.git_mirrors.resolve(
+                build.source['uri'], build.source['branch'])
+        context = self._build_context(
+            build, image_id, extra_binds, git_commit,
+            host_caches=not build_machine.remote)
+        self._create_cache_dirs(extra_binds)
+        if 'source_mount' in context:
+            self._source_context(build, context, extra_binds,
+                                 pooled=build_machine.pool is not None)
+
+        script = self._render_template(build, **context)
+
+        cache_key = None
+        if self.use_cache or self.only_changed:
+            cache_key = self._cache_key(build, script, image_id, git_commit)
+
+        if self.only_changed and cache_key is not None and \
+                self._unchanged(build, cache_key):
+            result.build_dir = self._build_dir(build)
+            result.exit_code = 0
+            result.unchanged = True
+            self.logger.info('*** Unchanged build, OS packages of the '
+                             'previous run kept in: %s ***' %
+                             result.build_dir)
+            return None
+
+        if self.use_cache:
+            build_dir = self._create_empty_build_dir(build)
+            if self.cache.restore(cache_key, build_dir) is not None:
+                result.build_dir = build_dir
+                result.exit_code = 0
+                result.cached = True
+                self._finish_build(build, result, cache_key)
+                self.logger.info('*** Unchanged build, OS packages restored '
+                                 'from cache in: %s ***' % result.build_dir)
+                return None
+
+        # staging the source only pays off for builds that run
+        if 'source_mount' in context:
+            self._prepare_source(build, context)
+        result.build_dir = self._create_build_dir(build, script)
+        return script, extra_binds, cache_key, git_commit
+
+    def _publish_result(self, build, result, succeeded):
+        result.build_dir = self._publish_build_dir(build, result.build_dir,
+                                                   succeeded)
+        log_file = os.path.join(result.build_dir, defaults.SCRATCH_DIR,
+                                defaults.SCRATCH_LOG_NAME)
+        # a build retried on another endpoint has the log of its last try
+        result.log_file = log_file if os.path.exists(log_file) else None
+
+    def _publish_broken_off(self, build, result):
+        # a build that raised instead of running to its end (aborted, or
+        # its docker daemon failed) leaves its build dir like a failed one
+        if result.build_dir is not None and \
+                result.build_dir == self._staging_dir(build) and \
+                os.path.exists(result.build_dir):
+            self._publish_result(build, result, False)
+
+    def _finish_build(self, build, result, cache_key):
+        succeeded = result.exit_code == 0
+        self._publish_result(build, result, succeeded)
+        if not succeeded:
+            self.logger.error('Build script exited with code %d: %s' %
+                              (result.exit_code, build.name))
+            if result.log_tail:
+                self.logger.error('Last lines of the output of %s:\n%s' %
+                                  (build.name, '\n'.join(result.log_tail)))
+            if result.log_file is not None:
+                self.logger.error('Full output in: %s' % result.log_file)
+            return
+
+        if cache_key is not None:
+            with open(self._fingerprint_path(result.build_dir), 'w') as f:
+                f.write(cache_key)
+        if result.cached:
+            return
+
+        self.logger.info(
+            '*** Resulting OS packages are in: %s ***' % result.build_dir)
+        if self.use_cache:
+            self.cache.store(cache_key, result.collect_artifacts())
+
+    def _run_build_machine(self, build, result):
+        if self.endpoints is None:
+            self._run_on_endpoint(build, result, None)
+            return
+
+        # a build that failed because of its docker daemon is retried on
+        # the endpoints it didn't run on yet
+        tried = []
+        while True:
+            endpoint = self.endpoints.acquire(exclude=tried)
+            failed = False
+            try:
+                self._run_on_endpoint(build, result, endpoint)
+                return
+            except DockerHostException as e:
+                failed = True
+                tried.append(endpoint)
+                if self.abort_event.is_set() or \
+                        len(tried) == len(self.endpoints.endpoints):
+                    raise
+                self.logger.warning('%s failed on %s, retrying elsewhere: %s'
+                                    % (build.name, endpoint, e))
+            finally:
+                self.endpoints.release(endpoint, failed)
+
+    def _run_on_endpoint(self, build, result, endpoint):
+        # endpoint is None for the docker daemon of this host
+        machine_args = self._build_machine_args(build)
+        pool = self._container_pool(build)
+        if endpoint is not None:
+            self.logger.info('Running %s on: %s' % (build.name, endpoint))
+            result.endpoint = endpoint.name
+            machine_args.update(endpoint.build_machine_args())
+            if not endpoint.local:
+                # the cores of other hosts aren't ours to split
+                machine_args.update(cpus=None, memory=None, jobs=None)
+                pool = None
+        build_machine = BuildMachine(
+            pool=pool,
+            reset_paths=self._reset_paths(build),
+            **machine_args
+        )
+        image_id = None
+        if self.use_cache or self.cache_python:
+            image_id = build_machine.image_id()
+
+        prepared = self._prepare_build(build, build_machine, image_id, result)
+        if prepared is None:
+            return
+        script, extra_binds, cache_key, git_commit = prepared
+
+        try:
+            self._launch(build, build_machine, result, extra_binds)
+        except Exception:
+            self._publish_broken_off(build, result)
+            raise
+
+        if (self.use_cache or self.only_changed) and \
+                result.exit_code == 0 and cache_key is None:
+            # the image wasn't pulled before the build started
+            cache_key = self._cache_key(build, script,
+                                        build_machine.image_id(), git_commit)
+        self._finish_build(build, result, cache_key)
+
+    def _launch(self, build, build_machine, result, extra_binds):
+        self.logger.info('launching docker image: %s' % build_machine.image)
+
+        with self.build_machines_lock:
+            if self.abort_event.is_set():
+                raise BuildMachineException('build aborted')
+            self.build_machines[build.name] = build_machine
+
+        try:
+            self.logger.info('Running build machine for: %s' % build.name)
+            result.exit_code = build_machine.launch(
+                build_dir=result.build_dir, extra_binds=extra_binds)
+        finally:
+            result.phases = build_machine.phases
+            result.slimmed = build_machine.slimmed
+            result.log_tail = list(build_machine.log_tail)
+
+            with self.build_machines_lock:
+                self.build_machines.pop(build.name, None)
+
+            self.logger.info('Shutting down build machine: %s' % build.name)
+            build_machine.shutdown()
+
+    def _abort_builds(self):
+        # called when a build fails in fail fast mode: builds that did not
+        # start yet are cancelled, running ones are torn down
+        with self.build_machines_lock:
+            if self.abort_event.is_set():
+                return
+            self.abort_event.set()
+            build_machines = list(self.build_machines.values())
+
+        self.logger.warning('Fail fast: aborting %d running builds' %
+                            len(build_machines))
+        for build_machine in build_machines:
+            build_machine.shutdown()
+
+    def close(self):
+        # retire the idle containers of the container pool
+        if self.container_pool is not None:
+            self.container_pool.close()
 
     def get_available_profiles(self):
         self._load_profiles()
         return self.profiles
 
     def build(self):
+        futures = self.build_futures()
+        results = [future.result() for future in futures]
+
+        for result in results:
+            self.logger.info('%s: %s' % (result.build.name, result.status))
+
+        return results
+
+    def verify(self):
+        # builds everything twice, without the artifact cache, and compares
+        # the packages; returns a ReproducibilityReport per build
+        if not self.reproducible:
+            self.logger.warning('Verifying builds without reproducible, '
+                                'their packages will most likely differ')
+
+        reports = collections.OrderedDict(
+            (build, ReproducibilityReport(build)) for build in self.builds)
+        # anything kept between builds could hand the second build what
+        # the first one made, instead of making it again
+        settings = dict(use_cache=False, only_changed=False,
+                        cache_python=False, cache_wheels=False,
+                        cache_compiler=False, share_stages=False,
+                        container_pool=None, use_prewarmed_images=False)
+        saved = dict((name, getattr(self, name)) for name in settings)
+        for name, value in settings.items():
+            setattr(self, name, value)
+        try:
+            for attr in ['first', 'second']:
+                # the second build replaces the packages of the first, so
+                # they're hashed right away
+                for result in self.build():
+                    report = reports[result.build]
+                    if result.succeeded:
+                        setattr(report, attr, result.digests())
+                    elif report.error is None:
+                        report.error = result.error or \
+                            'build %s, exit code %s' % (result.status,
+                                                        result.exit_code)
+        finally:
+            for name, value in saved.items():
+                setattr(self, name, value)
+
+        for report in reports.values():
+            if report.error is not None:
+                self.logger.error('%s: not verified, %s' %
+                                  (report.build.name, report.error))
+            elif report.reproducible:
+                self.logger.info('%s: reproducible' % report.build.name)
+            else:
+                self.logger.error('%s: packages differ: %s' %
+                                  (report.build.name,
+                                   ', '.join(report.differences)))
+        return list(reports.values())
+
+    def _start_session(self):
         self._create_vdist_dir()
         self._load_profiles()
-        self._clean_build_basedir()
         self._create_build_basedir()
 
         if len(self.builds) < 1:
             raise NoBuildsFoundException()
 
-        threads = []
+        self.abort_event.clear()
+        self.durations.load()
+        if self.git_mirrors is not None:
+            self.git_mirrors.forget_fetched()
+        self.shared_sources = SharedSources(self._shared_sources_dir())
+        max_workers = self.max_workers
+        if self.endpoints is not None and max_workers in (None, 'auto'):
+            # the builds run elsewhere, so the endpoints decide
+            max_workers = self.endpoints.capacity
+        max_workers = resolve_max_workers(max_workers, len(self.builds))
+
+        local_builds = max_workers
+        if self.endpoints is not None:
+            local_builds = min(max_workers, sum(
+                e.capacity for e in self.endpoints.endpoints if e.local))
+        self.host_resources = None
+        if local_builds:
+            self.host_resources = host_resources()
+        self.local_workers = local_builds
+        self.unfinished_builds = len(self.builds)
+        self.logger.info('Running %d builds with %d workers' %
+                         (len(self.builds), max_workers))
+        return max_workers
+
+    def build_futures(self):
+        max_workers = self._start_session()
+
+        # the executor hands out work in submission order, so submitting
+        # the longest builds first keeps a slow build from ending up alone
+        # at the tail of the run
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {}
+        if self.share_stages:
+            graph, build_stages = self._stage_graph()
+            stage_futures = graph.run(executor)
+            for build, stage in build_stages:
+                futures[build] = stage_futures[stage]
+            # stages get submitted when the ones they depend on are done
+            remaining = [len(stage_futures)]
+            lock = threading.Lock()
+
+            def stage_done(_):
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        executor.shutdown(wait=False)
+
+            for future in stage_futures.values():
+                future.add_done_callback(stage_done)
+        else:
+            for build in self.durations.longest_first(self.builds):
+                futures[build] = executor.submit(self._run_scheduled_build,
+                                                 build)
+            executor.shutdown(wait=False)
+
+        for future in futures.values():
+            future.add_done_callback(self._build_finished)
+        self._end_session_when_done(list(futures.values()))
+        return [futures[build] for build in self.builds]
+
+    def _end_session_when_done(self, futures):
+        # the containers left idle at the end of a run mostly have binds of
+        # builds that are done; only a few are kept for the next run
+        if self.container_pool is None:
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def build_done(_):
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self.container_pool.trim()
+
+        for future in futures:
+            future.add_done_callback(build_done)
+
+    def build_async(self):
+        # returns a coroutine running all builds from the asyncio event
+        # loop it is awaited in; see vdist.asyncbuild
+        from vdist.asyncbuild import build_async
+        return build_async(self)
+
+    def run_build_async(self, build):
+        from vdist.asyncbuild import run_build
+        return run_build(self, build)
 
-        for build in self.builds:
-            t = threading.Thread(
-                name=build.name,
-                target=self.run_build,
-                args=(build,)
-            )
-            threads.append(t)
-            t.start()
+    @staticmethod
+    def _source_id(source):
+        if source['type'] == 'git':
+            return source['type'], source['uri'], source['branch']
+        return (source['type'], os.path.abspath(source.get('path', '')),
+                source.get('branch', ''))
+
+    def _fingerprint_source(self, source):
+        # returns the fingerprint and an error
+        if source['type'] == 'git' and self.git_mirrors is not None:
+            try:
+                commit = self.git_mirrors.resolve(source['uri'],
+                                                  source['branch'])
+            except GitMirrorException as e:
+                return None, str(e)
+            return 'git:%s' % commit, None
+
+        fingerprint = fingerprint_source(source)
+        if fingerprint is None:
+            return None, 'could not fingerprint source: %s' % \
+                self._source_id(source)[1]
+        return fingerprint, None
+
+    def _check_source(self, build, git_commit):
+        source = build.source
+        if source['type'] in ['directory', 'git_directory']:
+            if not os.path.isdir(source['path']):
+                return 'path does not exist: %s' % source['path']
+            if build.working_dir and not os.path.isdir(
+                    os.path.join(source['path'], build.working_dir)):
+                return 'working_dir %s not found in: %s' % (
+                    build.working_dir, source['path'])
+        elif source['type'] == 'git':
+            if build.working_dir and git_commit is not None and \
+                    not self.git_mirrors.contains(source['uri'], git_commit,
+                                                  build.working_dir):
+                return 'working_dir %s not found in %s at %s' % (
+                    build.working_dir, source['uri'], git_commit)
+        else:
+            return 'invalid source type: %s' % source['type']
+
+        if build.use_local_pip_conf and not os.path.isdir(
+                os.path.join(os.path.expanduser('~'), '.pip')):
+            return 'use_local_pip_conf is set, but ~/.pip does not exist'
+        return None
+
+    def _plan_build(self, build, fingerprints):
+        plan = BuildPlan(build)
+        if build.profile not in self.profiles:
+            plan.errors.append('profile not found: %s' % build.profile)
+            return plan
+
+        profile = self.profiles[build.profile]
+        plan.profile = profile.profile_id
+        plan.image = profile.docker_image
+
+        source_id = self._source_id(build.source)
+        git_commit = None
+        if source_id in fingerprints:
+            plan.source_fingerprint, error = fingerprints[source_id]
+            if error is not None:
+                plan.errors.append(error)
+            elif build.source['type'] == 'git' and \
+                    self.git_mirrors is not None:
+                git_commit = plan.source_fingerprint[len('git:'):]
+
+        error = self._check_source(build, git_commit)
+        if error is not None:
+            plan.errors.append(error)
+
+        try:
+            _, plan.prewarmed_image = self._provisioning(build)
+            context = self._build_context(build, None, {}, git_commit)
+            plan.script, undefined = self._render(build, **context)
+        except TemplateError as e:
+            plan.errors.append('error in template %s: %s' %
+                               (profile.script, e))
+            return plan
+        except ValueError as e:
+            plan.errors.append(str(e))
+            return plan
+
+        if undefined:
+            plan.errors.append('undefined variables in build script: %s' %
+                               ', '.join(undefined))
+        plan.script_digest = hashlib.sha256(
+            plan.script.encode('utf-8')).hexdigest()
+        return plan
+
+    def plan(self, fingerprint_sources=True):
+        # renders and checks every build without starting any container;
+        # with fingerprint_sources, every distinct source is fingerprinted
+        # once (which may mean fetching git sources)
+        self._load_profiles()
+
+        if len(self.builds) < 1:
+            raise NoBuildsFoundException()
+
+        fingerprints = {}
+        if fingerprint_sources:
+            sources = collections.OrderedDict()
+            for build in self.builds:
+                sources.setdefault(self._source_id(build.source), build.source)
+            executor = ThreadPoolExecutor(
+                max_workers=resolve_max_workers(self.max_workers,
+                                                len(sources)))
+            results = executor.map(self._fingerprint_source,
+                                   list(sources.values()))
+            fingerprints = dict(zip(sources.keys(), results))
+            executor.shutdown()
+
+        plans = [self._plan_build(build, fingerprints)
+                 for build in self.builds]
+
+        # builds with the same build dir would overwrite each other
+        build_dirs = collections.defaultdict(list)
+        for plan in plans:
+            build_dirs[plan.build.get_safe_dirname()].append(plan)
+        for build_dir, same_dir in build_dirs.items():
+            if len(same_dir) > 1:
+                for plan in same_dir:
+                    plan.errors.append('%d builds share build dir: %s' %
+                                       (len(same_dir), build_dir))
+
+        for plan in plans:
+            if plan.valid:
+                self.logger.info('%s: %s on %s, script %s, source %s' % (
+                    plan.build.name, plan.profile, plan.image,
+                    plan.script_digest[:12], plan.source_fingerprint))
+            else:
+                self.logger.error('%s: %s' % (plan.build.name,
+                                              '; '.join(plan.errors)))
+        return plans
+
+    def _run_scheduled_build(self, build):
+        # keep the build name in the log records, like the former
+        # one-thread-per-build model did
+        threading.current_thread().name = build.name
+
+        if self.abort_event.is_set():
+            result = BuildResult(build)
+            result.status = BuildResult.CANCELLED
+            return result
+
+        result = self.run_build(build)
+
+        if result.status == BuildResult.SUCCEEDED:
+            self.durations.record(build, result.duration)
+            self.durations.save()
+        elif result.status == BuildResult.FAILED and self.fail_fast:
+            self._abort_builds()
 
-        for t in threads:
-            t.join()
+        return result
 
 
 class BuildProfileNotFoundException(Exception):
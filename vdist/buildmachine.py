@@ -1,86 +1,675 @@
-import itertools
+import atexit
+import collections
 import logging
 import os
+import posixpath
+import re
+import shlex
+import shutil
 import subprocess
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from vdist import defaults
 
 
+READ_CHUNK_SIZE = 64 * 1024
+# chunks of lines waiting to be logged; when logging falls behind, the
+# reader threads stop reading and the command blocks until it catches up
+READ_QUEUE_SIZE = 256
+LOG_BUFFER_SIZE = 1024 * 1024
+
+
+class PhaseTimer(object):
+    # the build scripts print lines like
+    #   ##vdist-phase start compile_python 1445007015.213
+    # around every phase of the build; this collects them into a
+    # per-phase timing breakdown
+
+    MARKER = '##vdist-phase'
+
+    def __init__(self):
+        self.started = {}
+        self.phases = collections.OrderedDict()
+
+    def feed(self, line):
+        if not line.startswith(self.MARKER):
+            return False
+
+        try:
+            _, event, name, timestamp = line.split()
+            timestamp = float(timestamp)
+        except ValueError:
+            return False
+
+        if event == 'start':
+            self.started[name] = timestamp
+            self.phases[name] = None
+        elif event == 'end' and name in self.started:
+            self.phases[name] = timestamp - self.started.pop(name)
+        return True
+
+    def summary(self):
+        return ', '.join(
+            '%s %s' % (name, 'unfinished' if seconds is None
+                       else '%.1fs' % seconds)
+            for name, seconds in self.phases.items())
+
+
+class SlimReport(object):
+    # the build scripts print lines like
+    #   ##vdist-slim strip 1048576
+    # for every step slimming the package down; this adds up the bytes
+    # every step saved
+
+    MARKER = '##vdist-slim'
+
+    def __init__(self):
+        self.saved = collections.OrderedDict()
+
+    def feed(self, line):
+        if not line.startswith(self.MARKER):
+            return False
+
+        try:
+            _, category, saved = line.split()
+            saved = int(saved)
+        except ValueError:
+            return False
+
+        self.saved[category] = self.saved.get(category, 0) + saved
+        return True
+
+    def summary(self):
+        return ', '.join('%s %.1fMB' % (category, saved / 1024.0 / 1024)
+                         for category, saved in self.saved.items())
+
+
+class BuildLog(object):
+    # writes the output of a build to its log file from a thread of its
+    # own, through a large buffer, so the build doesn't wait for the disk
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = queue.Queue(maxsize=READ_QUEUE_SIZE)
+        self.file = open(path, 'ab', LOG_BUFFER_SIZE)
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write(self, lines):
+        self.chunks.put(lines)
+
+    def _write(self):
+        failed = False
+        try:
+            while True:
+                lines = self.chunks.get()
+                if lines is None:
+                    break
+                if failed:
+                    # keep emptying the queue, so the build doesn't block
+                    continue
+                try:
+                    self.file.writelines(lines)
+                except (IOError, OSError) as e:
+                    logging.getLogger('BuildLog').warning(
+                        'Could not write %s: %s' % (self.path, e))
+                    failed = True
+        finally:
+            self.file.close()
+
+    def close(self):
+        # returns once everything written so far is on disk
+        self.chunks.put(None)
+        self.writer.join()
+
+
+class ContainerPool(object):
+    # keeps containers that finished a build successfully around, so the
+    # next build with the same image and provisioning doesn't have to start
+    # (and provision) a new one
+
+    def __init__(self, max_idle=2, max_uses=10, max_memory=None):
+        self.logger = logging.getLogger('ContainerPool')
+
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        # in MiB
+        self.max_memory = max_memory
+
+        # (key, container id, uses, binds, limits), the most recently
+        # released last
+        self.idle = []
+        self.lock = threading.Lock()
+
+        atexit.register(self.close)
+
+    @staticmethod
+    def _key(build_machine, image):
+        # a container is provisioned by the first build it runs, so it is
+        # only reused for builds provisioning the same way
+        return (build_machine.docker_cli,
+                tuple(sorted((build_machine.env or {}).items())), image,
+                build_machine.provision_key)
+
+    @staticmethod
+    def _fits(entry, key, binds, limits):
+        # binds can't be added to a running container, and its limits can
+        # be changed but not lifted
+        entry_key, _, _, entry_binds, entry_limits = entry
+        return entry_key == key and \
+            all(entry_binds.get(path) == bind
+                for path, bind in binds.items()) and \
+            all(limit is not None or entry_limit is None
+                for entry_limit, limit in zip(entry_limits, limits))
+
+    @staticmethod
+    def pool_dir(binds):
+        # the dir of its own a pooled container has bound as the shared
+        # dir; the build dir of every build it runs is moved in for the
+        # build, so it never sees the build dirs of other builds
+        return [path for path, bind in binds.items()
+                if bind == defaults.SHARED_DIR][0]
+
+    def acquire(self, build_machine, image, binds, build_dir):
+        # returns a container id, the number of builds it ran before and
+        # the binds it has, which may be more than binds
+        key = self._key(build_machine, image)
+        limits = (build_machine.cpus, build_machine.memory)
+        with self.lock:
+            entry = None
+            for i in reversed(range(len(self.idle))):
+                if self._fits(self.idle[i], key, binds, limits):
+                    entry = self.idle.pop(i)
+                    break
+
+        if entry is not None:
+            _, container_id, uses, binds, entry_limits = entry
+            if entry_limits == limits or build_machine._update_limits(
+                    container_id):
+                self.logger.info('Reusing container: %s' % container_id)
+                return container_id, uses, binds
+            self.discard(build_machine, container_id, binds)
+
+        pool_basedir = os.path.join(os.path.dirname(build_dir),
+                                    defaults.POOL_DIR)
+        if not os.path.isdir(pool_basedir):
+            os.makedirs(pool_basedir)
+        binds = dict(binds)
+        binds[tempfile.mkdtemp(dir=pool_basedir)] = defaults.SHARED_DIR
+        try:
+            container_id = build_machine._start_container(image, binds)
+        except Exception:
+            shutil.rmtree(self.pool_dir(binds))
+            raise
+        return container_id, 0, binds
+
+    def _should_retire(self, build_machine, container_id, uses):
+        if uses >= self.max_uses:
+            return True
+        if self.max_memory is not None:
+            memory = build_machine._memory_usage(container_id)
+            if memory is None or memory > self.max_memory:
+                return True
+        return False
+
+    def release(self, build_machine, image, binds, container_id, uses,
+                reset_paths):
+        uses += 1
+        retire = self._should_retire(build_machine, container_id, uses)
+
+        if not retire and reset_paths:
+            # get rid of everything the build left behind
+            exit_code, _ = build_machine._run_cli(
+                build_machine._docker('exec', container_id, 'bash', '-c',
+                                      'rm -rf %s' % ' '.join(reset_paths)))
+            retire = exit_code != 0
+
+        key = self._key(build_machine, image)
+        with self.lock:
+            if not retire and len([e for e in self.idle if e[0] == key]) < \
+                    self.max_idle:
+                self.idle.append((key, container_id, uses, binds,
+                                  (build_machine.cpus, build_machine.memory)))
+                return
+
+        self.discard(build_machine, container_id, binds)
+
+    def discard(self, build_machine, container_id, binds):
+        # the dir of a container is empty unless a build is still running
+        # in it, which moves its build dir out before removing it
+        build_machine._remove_container(container_id)
+        try:
+            os.rmdir(self.pool_dir(binds))
+        except OSError:
+            pass
+
+    def trim(self):
+        # called when a run ends: keeps the max_idle containers released
+        # last, the others mostly have binds of builds that are done
+        with self.lock:
+            retired = self.idle[:-self.max_idle] if self.max_idle else \
+                list(self.idle)
+            self.idle = self.idle[len(retired):]
+        self._remove(retired)
+
+    def close(self):
+        with self.lock:
+            retired = self.idle
+            self.idle = []
+        self._remove(retired)
+
+    def _remove(self, entries):
+        for (docker_cli, env, _, _), container_id, _, binds, _ in entries:
+            build_machine = BuildMachine(docker_cli=docker_cli,
+                                         env=dict(env) or None)
+            self.discard(build_machine, container_id, binds)
+
+
 class BuildMachine(object):
 
     def __init__(self, machine_logs=True, image=None, insecure_registry=False,
-                 docker_cli='docker'):
+                 docker_cli='docker', prewarmed_image=None, pool=None,
+                 reset_paths=None, env=None, remote=False, cpus=None,
+                 memory=None, jobs=None,
+                 log_tail_lines=defaults.LOG_TAIL_LINES, provision_key=None):
         self.logger = logging.getLogger('BuildMachine')
 
         self.machine_logs = machine_logs
         self.image = image
+        self.prewarmed_image = prewarmed_image
 
         self.container_id = None
+        self.shut_down = False
+        self.exit_code = None
+        self.phase_timer = PhaseTimer()
+        self.slim_report = SlimReport()
+        # the output of the build goes to a log file in its scratch dir when
+        # machine_logs is set, and its last lines are kept either way
+        self.log = None
+        self.log_tail = collections.deque(maxlen=log_tail_lines)
+
+        self.pool = pool
+        self.reset_paths = reset_paths
+        # the provisioning the build script does, see Builder._provisioning
+        self.provision_key = provision_key
+        self.pool_args = None
+        self.container_uses = 0
 
         self.docker_cli = docker_cli
+        # environment variables for the docker cli, like DOCKER_HOST
+        self.env = env
+        # a remote docker daemon can't bind mount local dirs, so they are
+        # copied into the container before the build and the build dir is
+        # copied back after it
+        self.remote = remote
+        if remote and pool is not None:
+            raise ValueError('containers on remote daemons are not pooled')
+
+        # the share of the host's cores and memory (in MiB) the container
+        # gets, and the number of parallel compile jobs the build script
+        # runs
+        self.cpus = cpus
+        self.memory = memory
+        self.jobs = jobs
 
         self.insecure_registry = insecure_registry
 
-    def _run_cli(self, cmd):
-        self.logger.info('Running command: "%s"' % cmd)
-        p = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        self.lock = threading.Lock()
+
+    def _cli_env(self):
+        if not self.env:
+            return None
+        env = dict(os.environ)
+        env.update(self.env)
+        return env
+
+    def _docker(self, *args):
+        # docker_cli may hold a command with arguments, like "sudo docker"
+        return shlex.split(self.docker_cli) + list(args)
 
-        media = [p.stdout, p.stderr]
-        first_line = self._read_from_media(media)
+    def _run_cli(self, args, capture_output=False):
+        # returns the exit code and, when asked for, everything the command
+        # wrote to stdout; build output can be huge, so it's only logged
+        # by default
+        self.logger.info('Running command: "%s"' % ' '.join(args))
+        with open(os.devnull) as devnull:
+            p = subprocess.Popen(
+                args,
+                stdin=devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=self._cli_env()
+            )
+
+        output = self._read_from_media([p.stdout, p.stderr], capture_output)
 
         p.stdout.close()
         p.stderr.close()
-        p.wait()
 
-        return first_line
+        return p.wait(), output
+
+    @staticmethod
+    def _split_lines(partial, chunk):
+        # returns the complete lines of what was read so far, and the
+        # incomplete last line
+        chunk = partial + chunk
+        end = chunk.rfind(b'\n') + 1
+        return chunk[:end].splitlines(True), chunk[end:]
+
+    def _log_lines(self, lines):
+        # with many builds running, their output is of no use on the
+        # console, so it's only logged at debug level
+        for line in lines:
+            line = line.decode('UTF-8', 'replace').rstrip()
+            self.phase_timer.feed(line)
+            self.slim_report.feed(line)
+            self.log_tail.append(line)
+            self.logger.debug(line)
+
+    @staticmethod
+    def _log_path(build_dir):
+        log_dir = os.path.join(build_dir, defaults.SCRATCH_DIR)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        return os.path.join(log_dir, defaults.SCRATCH_LOG_NAME)
+
+    def _open_log(self, build_dir):
+        if self.machine_logs:
+            self.log = BuildLog(self._log_path(build_dir))
+
+    def _close_log(self):
+        log = self.log
+        self.log = None
+        if log is not None:
+            log.close()
+
+    @staticmethod
+    def _drain(input_to_read, lines):
+        # reads whatever is available instead of a line at a time, and
+        # hands over all complete lines at once; that keeps up with
+        # hundreds of MB of compiler output
+        fd = input_to_read.fileno()
+        partial = b''
+        try:
+            while True:
+                chunk = os.read(fd, READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                complete, partial = BuildMachine._split_lines(partial, chunk)
+                if complete:
+                    lines.put((input_to_read, complete))
+            if partial:
+                lines.put((input_to_read, [partial]))
+        finally:
+            lines.put((input_to_read, None))
 
-    def _read_from_media(self, media):
-        first_line = None
+    def _read_from_media(self, media, capture_output=False):
+        # a reader thread per pipe keeps any of them from filling up and
+        # blocking the command, while lines are handled here in the order
+        # they arrived
+        lines = queue.Queue(maxsize=READ_QUEUE_SIZE)
         for input_to_read in media:
-            for line in iter(input_to_read.readline, b''):
-                line = str(line.decode("UTF-8")).strip()
-                if not first_line:
-                    first_line = line
-                self.logger.info(line)
-        return first_line
+            reader = threading.Thread(target=self._drain,
+                                      args=(input_to_read, lines))
+            reader.daemon = True
+            reader.start()
+
+        output = [] if capture_output else None
+        open_media = len(media)
+        while open_media:
+            input_to_read, chunk = lines.get()
+            if chunk is None:
+                open_media -= 1
+                continue
+            if capture_output and input_to_read is media[0]:
+                output.extend(chunk)
+            if self.log is not None:
+                self.log.write(chunk)
+            self._log_lines(chunk)
+
+        if capture_output:
+            return b''.join(output).decode('UTF-8', 'replace')
+        return None
 
     @staticmethod
-    def _binds_to_shell_volumes(binds):
-        if defaults.PYTHON3_INTERPRETER:
-            vol_list = ['-v %s:%s' % (k, v) for k, v in binds.items()]
-        else:
-            vol_list = ['-v %s:%s' % (k, v) for k, v in binds.iteritems()]
-        return ' '.join(vol_list)
+    def _binds_to_volumes(binds):
+        volumes = []
+        for host_path, container_path in sorted(binds.items()):
+            volumes += ['-v', '%s:%s' % (host_path, container_path)]
+        return volumes
+
+    def _run_args(self, image, binds):
+        args = ['run', '-d', '-ti']
+        if self.cpus is not None:
+            args += ['--cpus', '%.2f' % self.cpus]
+        if self.memory is not None:
+            args += ['--memory', '%dm' % self.memory]
+        return self._docker(*(args + self._binds_to_volumes(binds) +
+                              [image, 'bash']))
+
+    def _exec_args(self, container_id, command):
+        # the build script picks up the number of compile jobs from the
+        # environment, so it doesn't end up in the script (or cache key)
+        args = ['exec']
+        if self.jobs is not None:
+            args += ['-e', 'VDIST_JOBS=%d' % self.jobs]
+        return self._docker(*(args + [container_id, command]))
+
+    def _update_limits(self, container_id):
+        # gives a running container the limits of this build machine
+        args = ['update']
+        if self.cpus is not None:
+            args += ['--cpus', '%.2f' % self.cpus]
+        if self.memory is not None:
+            # docker run lets the container swap as much as its memory
+            args += ['--memory', '%dm' % self.memory,
+                     '--memory-swap', '%dm' % (2 * self.memory)]
+        exit_code, _ = self._run_cli(self._docker(*(args + [container_id])))
+        return exit_code == 0
+
+    def image_id(self, image=None):
+        # the id of the local image, or None when it isn't pulled yet
+        if image is None:
+            image = self.image
+        exit_code, output = self._run_cli(
+            self._docker('inspect', '--format', '{{.Id}}', image),
+            capture_output=True)
+        if exit_code != 0 or not output.strip():
+            return None
+        return output.strip()
+
+    def _start_container(self, image, binds):
+        self.logger.info('Starting container: %s' % image)
+        exit_code, output = self._run_cli(self._run_args(image, binds),
+                                          capture_output=True)
+        if exit_code != 0:
+            raise DockerHostException(
+                'could not start container from image %s (exit code %d)' %
+                (image, exit_code))
+        return output.strip()
+
+    @staticmethod
+    def _container_path(bind):
+        # binds may end in options like :ro
+        return bind.split(':', 1)[0]
+
+    def _copy_in(self, container_id, binds):
+        # parents first, so directories nested in others end up inside
+        for host_path, bind in sorted(binds.items(),
+                                      key=lambda b: b[1]):
+            container_path = self._container_path(bind)
+            exit_code, _ = self._run_cli(
+                self._docker('exec', container_id, 'mkdir', '-p',
+                             container_path))
+            if exit_code == 0:
+                exit_code, _ = self._run_cli(
+                    self._docker('cp', os.path.join(host_path, '.'),
+                                 '%s:%s' % (container_id, container_path)))
+            if exit_code != 0:
+                raise DockerHostException(
+                    'could not copy %s into container %s (exit code %d)' %
+                    (host_path, container_id, exit_code))
+
+    def _copy_out(self, container_id, build_dir):
+        exit_code, _ = self._run_cli(
+            self._docker('cp', '%s:%s' % (container_id,
+                                          posixpath.join(defaults.SHARED_DIR,
+                                                         '.')),
+                         build_dir))
+        if exit_code != 0:
+            raise DockerHostException(
+                'could not copy the build dir out of container %s '
+                '(exit code %d)' % (container_id, exit_code))
+
+    def _memory_usage(self, container_id):
+        # in MiB, or None when it can't be determined
+        exit_code, usage = self._run_cli(
+            self._docker('stats', '--no-stream', '--format', '{{.MemUsage}}',
+                         container_id),
+            capture_output=True)
+        match = re.match(r'([\d.]+)\s*([KMGT]?i?B)', usage or '')
+        if exit_code != 0 or match is None:
+            return None
+        factors = {'B': 1.0 / 1024 / 1024, 'KiB': 1.0 / 1024, 'MiB': 1,
+                   'GiB': 1024, 'TiB': 1024 * 1024}
+        return float(match.group(1)) * factors.get(match.group(2), 1)
+
+    @staticmethod
+    def _move_contents(source_dir, target_dir):
+        for name in os.listdir(source_dir):
+            os.rename(os.path.join(source_dir, name),
+                      os.path.join(target_dir, name))
 
     def launch(self, build_dir, extra_binds=None):
-        binds = {build_dir: defaults.SHARED_DIR}
+        binds = {}
+        if self.pool is None:
+            binds[build_dir] = defaults.SHARED_DIR
         if extra_binds:
-            binds = list(itertools.chain(binds.items(), extra_binds.items()))
-        path_to_command = os.path.join(
+            binds.update(extra_binds)
+        path_to_command = posixpath.join(
             defaults.SHARED_DIR,
             defaults.SCRATCH_DIR,
             defaults.SCRATCH_BUILDSCRIPT_NAME
         )
-        self.logger.info('Starting container: %s' % self.image)
-        self.container_id = self._run_cli(
-            '%s run -d -ti %s %s bash' %
-            (self.docker_cli,
-             self._binds_to_shell_volumes(binds),
-             self.image))
+        image = self.image
+        if self.prewarmed_image and self.image_id(self.prewarmed_image):
+            self.logger.info('Using prewarmed image: %s' %
+                             self.prewarmed_image)
+            image = self.prewarmed_image
+
+        if self.remote:
+            container_id = self._start_container(image, {})
+        elif self.pool is None:
+            container_id = self._start_container(image, binds)
+        else:
+            container_id, self.container_uses, pool_binds = \
+                self.pool.acquire(self, image, binds, build_dir)
+            self.pool_args = (image, pool_binds)
+
+        with self.lock:
+            shut_down = self.shut_down
+            if not shut_down:
+                self.container_id = container_id
+        if shut_down:
+            if self.pool is not None:
+                self.pool.discard(self, container_id, pool_binds)
+            else:
+                self._remove_container(container_id)
+            raise BuildMachineException(
+                'build machine was shut down while starting')
+
+        if self.remote:
+            self._copy_in(container_id, binds)
+
+        run_dir = build_dir
+        if self.pool is not None:
+            run_dir = self.pool.pool_dir(pool_binds)
+            self._move_contents(build_dir, run_dir)
+        self._open_log(run_dir)
+        try:
+            exit_code, _ = self._run_cli(
+                self._exec_args(container_id, path_to_command))
+        finally:
+            self._close_log()
+            if run_dir != build_dir:
+                self._move_contents(run_dir, build_dir)
+                if self.shut_down:
+                    # the container was removed during the build
+                    try:
+                        os.rmdir(run_dir)
+                    except OSError:
+                        pass
+        self.exit_code = exit_code
 
-        self._run_cli(
-            '%s exec %s %s' %
-            (self.docker_cli, self.container_id, path_to_command))
+        if self.remote:
+            # the build dir also holds the logs of failed builds
+            self._copy_out(container_id, build_dir)
+
+        if self.phases:
+            self.logger.info('Build phases: %s' % self.phase_timer.summary())
+        if self.slimmed:
+            self.logger.info('Slimmed: %s' % self.slim_report.summary())
+        return exit_code
+
+    @property
+    def phases(self):
+        return self.phase_timer.phases
+
+    @property
+    def slimmed(self):
+        return self.slim_report.saved
+
+    def commit(self, tag):
+        self.logger.info('Committing container %s as: %s' %
+                         (self.container_id, tag))
+        exit_code, _ = self._run_cli(
+            self._docker('commit', self.container_id, tag))
+        if exit_code != 0:
+            raise BuildMachineException(
+                'could not commit container as %s (exit code %d)' %
+                (tag, exit_code))
 
     def shutdown(self):
-        self.logger.info('Stopping container: %s' % self.container_id)
-        self._run_cli('%s stop %s' % (self.docker_cli, self.container_id))
+        # shutdown can be called from another thread while the build is
+        # still running (to abort it), so make sure it only happens once
+        with self.lock:
+            container_id = self.container_id
+            self.container_id = None
+            self.shut_down = True
+        if container_id is None:
+            return
+
+        # only containers that completed a build successfully are reused,
+        # the state of any other container is unknown
+        if self.pool is not None and self.exit_code == 0:
+            image, binds = self.pool_args
+            self.pool.release(self, image, binds, container_id,
+                              self.container_uses, self.reset_paths)
+        elif self.pool is not None:
+            self.pool.discard(self, container_id, self.pool_args[1])
+        else:
+            self._remove_container(container_id)
+
+    def _remove_container(self, container_id):
+        self.logger.info('Stopping container: %s' % container_id)
+        self._run_cli(self._docker('stop', container_id))
+
+        self.logger.info('Removing container: %s' % container_id)
+        self._run_cli(self._docker('rm', '-f', container_id))
+
+
+class BuildMachineException(Exception):
+    pass
+
 
-        self.logger.info('Removing container: %s' % self.container_id)
-        self._run_cli('%s rm -f %s' % (self.docker_cli, self.container_id))
+class DockerHostException(BuildMachineException):
+    # the docker daemon failed rather than the build, so the build may
+    # succeed on another one
+    pass
@@ -0,0 +1,207 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+
+from vdist import defaults
+from vdist.staging import source_files
+
+
+logger = logging.getLogger('Cache')
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _hash_file(path, digest=None):
+    if digest is None:
+        digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def _hash_tree(path):
+    # the files the build gets: those staging.source_files lists, which
+    # leaves out ignored files and follows symlinked directories like
+    # staging does
+    digest = hashlib.sha256()
+    for rel_path in source_files(path):
+        file_path = os.path.join(path, rel_path)
+        digest.update(rel_path.encode('utf-8') + b'\0')
+        if os.path.exists(file_path):
+            # staging copies what symlinks point to
+            _hash_file(file_path, digest)
+        else:
+            digest.update(os.readlink(file_path).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _git_output(args, cwd=None):
+    try:
+        p = subprocess.Popen(['git'] + args, cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    return out.decode('utf-8').strip()
+
+
+def fingerprint_source(source, git_commit=None):
+    # returns None when the source can't be fingerprinted, which makes
+    # the build uncacheable; git_commit is the commit a git source was
+    # resolved to in its mirror, and built from
+    if source['type'] == 'git':
+        if git_commit is not None:
+            return 'git:%s' % git_commit
+        out = _git_output(['ls-remote', source['uri'], source['branch']])
+        if out:
+            return 'git:%s' % out.split()[0]
+        # maybe the branch is a commit id already
+        if len(source['branch']) == 40:
+            return 'git:%s' % source['branch']
+        return None
+
+    if source['type'] in ['directory', 'git_directory']:
+        if not os.path.isdir(source['path']):
+            return None
+        fingerprint = 'tree:%s' % _hash_tree(source['path'])
+        # .git is left out of the tree, its index and logs change all the
+        # time, but the install step may take the version from its commit
+        # and tags. A git_directory is checked out at the given branch
+        # inside the build machine, so the branch commit takes part in the
+        # result.
+        if source['type'] == 'git_directory':
+            ref = source['branch']
+        elif os.path.exists(os.path.join(source['path'], '.git')):
+            ref = 'HEAD'
+        else:
+            return fingerprint
+        described = _git_output(['describe', '--tags', '--always', '--long',
+                                 '--abbrev=40', ref], cwd=source['path'])
+        if described is None:
+            # a repository without commits yet has nothing to describe
+            return None if source['type'] == 'git_directory' else fingerprint
+        return '%s:%s' % (fingerprint, described)
+
+    return None
+
+
+class ArtifactCache(object):
+    # finished packages are stored once, by their own digest, under
+    # objects/; a manifest per cache key in keys/ maps the package
+    # filenames of a build to those objects
+
+    def __init__(self, path=defaults.CACHE_DIR):
+        self.path = path
+        self.objects_dir = os.path.join(path, 'objects')
+        self.keys_dir = os.path.join(path, 'keys')
+
+    @staticmethod
+    def key(*inputs):
+        digest = hashlib.sha256()
+        for value in inputs:
+            if value is None:
+                return None
+            digest.update(value.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _manifest_path(self, key):
+        return os.path.join(self.keys_dir, '%s.json' % key)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    @staticmethod
+    def _makedirs(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def _link_or_copy(src, dst):
+        # hardlinking makes a cache hit take milliseconds; fall back to
+        # copying when the cache lives on another filesystem
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    @staticmethod
+    def _tmp_path(path):
+        # unique per process and thread, so concurrent writers of the
+        # same entry never share a temporary file
+        return '%s.%d.%d.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+
+    def _atomic_write(self, path, data):
+        tmp_path = self._tmp_path(path)
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def lookup(self, key):
+        if key is None:
+            return None
+        manifest_path = self._manifest_path(key)
+        if not os.path.isfile(manifest_path):
+            return None
+        try:
+            with open(manifest_path) as f:
+                manifest = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+        for digest in manifest.values():
+            if not os.path.isfile(self._object_path(digest)):
+                return None
+        return manifest
+
+    def restore(self, key, target_dir):
+        manifest = self.lookup(key)
+        if manifest is None:
+            return None
+
+        artifacts = []
+        for filename, digest in sorted(manifest.items()):
+            target = os.path.join(target_dir, filename)
+            if os.path.exists(target):
+                os.remove(target)
+            self._link_or_copy(self._object_path(digest), target)
+            artifacts.append(target)
+        logger.info('Restored %d artifacts from cache: %s' %
+                    (len(artifacts), key))
+        return artifacts
+
+    def store(self, key, artifacts):
+        if key is None or not artifacts:
+            return
+
+        manifest = {}
+        for artifact in artifacts:
+            digest = _hash_file(artifact).hexdigest()
+            object_path = self._object_path(digest)
+            if not os.path.isfile(object_path):
+                self._makedirs(os.path.dirname(object_path))
+                tmp_path = self._tmp_path(object_path)
+                shutil.copy2(artifact, tmp_path)
+                # cached objects get hardlinked into build dirs, make sure
+                # nobody changes them in place
+                os.chmod(tmp_path, 0o444)
+                os.rename(tmp_path, object_path)
+            manifest[os.path.basename(artifact)] = digest
+
+        self._makedirs(self.keys_dir)
+        self._atomic_write(self._manifest_path(key),
+                           json.dumps(manifest, indent=4, sort_keys=True))
+        logger.info('Stored %d artifacts in cache: %s' %
+                    (len(artifacts), key))
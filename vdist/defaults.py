@@ -9,8 +9,50 @@ VDIST_USERDIR = os.path.join(os.path.expanduser('~'), '.vdist')
 BUILD_BASEDIR = os.path.join(VDIST_USERDIR, 'dist')
 SCRATCH_BUILDSCRIPT_NAME = 'buildscript.sh'
 SCRATCH_DIR = 'scratch'
+SCRATCH_FINGERPRINT_NAME = 'fingerprint'
+SCRATCH_LOG_NAME = 'build.log'
+# the last lines of build output kept in memory, for reporting failed builds
+LOG_TAIL_LINES = 50
 SHARED_DIR = '/work'
+# pooled containers have a dir of their own in the build base dir bound as
+# SHARED_DIR, and the shared sources of all builds bound here
+POOL_DIR = '.pool'
+POOL_SOURCES_DIR = '/vdist-sources'
 PACKAGE_INSTALL_ROOT = PYTHON_BASEDIR
 PACKAGE_TMP_ROOT = '/tmp'
+MAX_WORKERS = 'auto'
+AUTO_WORKERS_MEMORY_PER_BUILD = 1024
+# the least memory (in MiB) a build container gets when memory is split
+# over the builds
+MIN_BUILD_MEMORY = 512
+BUILD_DURATIONS_FILE = os.path.join(VDIST_USERDIR, 'durations.json')
+CACHE_DIR = os.path.join(VDIST_USERDIR, 'cache')
+PYTHON_CACHE_DIR = os.path.join(CACHE_DIR, 'python')
+CONTAINER_PYTHON_CACHE_DIR = '/vdist-cache/python'
+WHEELHOUSE_DIR = os.path.join(CACHE_DIR, 'wheels')
+CONTAINER_WHEELHOUSE_DIR = '/vdist-cache/wheels'
+PACKAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'packages')
+CONTAINER_PACKAGE_CACHE_DIR = '/vdist-cache/packages'
+CCACHE_DIR = os.path.join(CACHE_DIR, 'ccache')
+CONTAINER_CCACHE_DIR = '/vdist-cache/ccache'
+CCACHE_MAX_SIZE = '5G'
+
+# the steps of slimming packages down, see profiles/slim.sh
+SLIM_STEPS = ['strip', 'tests', 'gui', 'static', 'headers', 'bytecode']
+
+# package compression, see profiles/compression.sh
+COMPRESSIONS = ['gzip', 'xz', 'zstd']
+# the levels every compressor takes; zstd only goes beyond 19 with --ultra
+COMPRESSION_LEVELS = {'gzip': (1, 9), 'xz': (0, 9), 'zstd': (1, 19)}
+PACKAGE_FORMATS = ['deb', 'rpm', 'tar']
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_DIR, 'templates')
+PREWARM_BASEDIR = os.path.join(VDIST_USERDIR, 'prewarm')
+PREWARMED_IMAGE_PREFIX = 'vdist-prewarmed'
+STAGE_SOURCES = 'link'
+GIT_MIRRORS_DIR = os.path.join(VDIST_USERDIR, 'git-mirrors')
+CONTAINER_SOURCE_DIR = '/vdist-source'
+SOURCE_FILES_NAME = 'source-files'
+SHARED_SOURCES_DIR = '.sources'
+SHARED_STAGES_DIR = '.stages'
 
 PYTHON3_INTERPRETER = True if sys.version_info[0] == 3 else False
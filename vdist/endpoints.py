@@ -0,0 +1,77 @@
+import logging
+import threading
+
+
+logger = logging.getLogger('Endpoints')
+
+
+class Endpoint(object):
+    # a docker daemon builds run on, reached through DOCKER_HOST or a
+    # wrapper around the docker cli (like "ssh buildhost docker"); capacity
+    # is the number of builds it runs at the same time. Daemons on other
+    # hosts can't bind mount local dirs, so unless local is given, only
+    # daemons without a DOCKER_HOST or with a unix socket count as local.
+
+    def __init__(self, docker_host=None, docker_cli='docker', capacity=1,
+                 name=None, local=None):
+        if capacity < 1:
+            raise ValueError('capacity should be at least 1')
+        self.docker_host = docker_host
+        self.docker_cli = docker_cli
+        self.capacity = capacity
+        self.name = name or docker_host or docker_cli
+        if local is None:
+            local = docker_host is None or docker_host.startswith('unix://')
+        self.local = local
+
+        self.running = 0
+        self.failures = 0
+
+    def build_machine_args(self):
+        env = None
+        if self.docker_host is not None:
+            env = {'DOCKER_HOST': self.docker_host}
+        return dict(docker_cli=self.docker_cli, env=env,
+                    remote=not self.local)
+
+    def __str__(self):
+        return self.name
+
+
+class EndpointPool(object):
+    # hands out the least loaded endpoint with room for another build;
+    # endpoints that failed builds before come last among equally loaded
+    # ones
+
+    def __init__(self, endpoints):
+        if not endpoints:
+            raise ValueError('no endpoints given')
+        self.endpoints = list(endpoints)
+        self.condition = threading.Condition()
+
+    @property
+    def capacity(self):
+        return sum(endpoint.capacity for endpoint in self.endpoints)
+
+    def acquire(self, exclude=()):
+        # blocks until one of the endpoints not in exclude has room;
+        # returns None when exclude holds all of them
+        with self.condition:
+            while True:
+                candidates = [e for e in self.endpoints if e not in exclude]
+                if not candidates:
+                    return None
+                available = [e for e in candidates if e.running < e.capacity]
+                if available:
+                    endpoint = min(available, key=lambda e: (
+                        float(e.running) / e.capacity, e.failures))
+                    endpoint.running += 1
+                    return endpoint
+                self.condition.wait()
+
+    def release(self, endpoint, failed=False):
+        with self.condition:
+            endpoint.running -= 1
+            if failed:
+                endpoint.failures += 1
+            self.condition.notify_all()
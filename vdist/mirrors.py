@@ -0,0 +1,179 @@
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from vdist import defaults
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger('GitMirrors')
+
+
+def git_available():
+    try:
+        subprocess.Popen(['git', '--version'], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+    except OSError:
+        return False
+    return True
+
+
+class GitMirrors(object):
+    # bare mirrors of the git sources of builds, kept on the host so a
+    # build only fetches what changed since the last one, and exports the
+    # requested commit into the build dir instead of cloning in the build
+    # machine
+
+    def __init__(self, path=defaults.GIT_MIRRORS_DIR):
+        self.path = path
+        # uris fetched during the current run of builds
+        self.fetched = set()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def mirror_path(self, uri):
+        name = re.sub('[^A-Za-z0-9._-]', '_',
+                      uri.rstrip('/').rsplit('/', 1)[-1])
+        digest = hashlib.sha256(uri.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.path, '%s-%s.git' % (name, digest))
+
+    @staticmethod
+    def _git(args, cwd=None):
+        p = subprocess.Popen(['git'] + args, cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise GitMirrorException(
+                'git %s failed: %s' %
+                (' '.join(args), err.decode('utf-8', 'replace').strip()))
+        return out.decode('utf-8').strip()
+
+    def _lock(self, mirror_path):
+        with self.locks_lock:
+            if mirror_path not in self.locks:
+                self.locks[mirror_path] = threading.Lock()
+            return self.locks[mirror_path]
+
+    def forget_fetched(self):
+        self.fetched.clear()
+
+    def update(self, uri, commit=None):
+        # creates or fetches the mirror of uri, at most once per run;
+        # threads use a lock per mirror, other vdist processes a lock file.
+        # When fetching fails, a mirror that has commit (a full commit id)
+        # is good enough, since that can't have changed.
+        mirror_path = self.mirror_path(uri)
+        with self._lock(mirror_path):
+            if uri in self.fetched:
+                return mirror_path
+
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            with open(mirror_path + '.lock', 'w') as lock_file:
+                # without fcntl, only the threads of this process are kept
+                # apart
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if os.path.isdir(mirror_path):
+                    logger.info('Fetching mirror of: %s' % uri)
+                    try:
+                        self._fetch(uri, mirror_path)
+                    except GitMirrorException as e:
+                        if not self._has_commit(mirror_path, commit):
+                            raise
+                        logger.warning('Using mirror with commit %s, %s' %
+                                       (commit, e))
+                        return mirror_path
+                else:
+                    logger.info('Creating mirror of: %s' % uri)
+                    self._clone(uri, mirror_path)
+
+            self.fetched.add(uri)
+        return mirror_path
+
+    def _clone(self, uri, mirror_path):
+        tmp_path = '%s.%d.tmp' % (mirror_path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        self._git(['clone', '--quiet', '--mirror', uri, tmp_path])
+        os.rename(tmp_path, mirror_path)
+
+    def _fetch(self, uri, mirror_path):
+        self._git(['fetch', '--quiet', '--prune', uri, '+refs/*:refs/*'],
+                  cwd=mirror_path)
+
+    def _has_commit(self, mirror_path, commit):
+        # branches, tags and abbreviated ids may point elsewhere by now
+        if commit is None or not re.match('^[0-9a-f]{40}$', commit):
+            return False
+        try:
+            self._git(['cat-file', '-e', '%s^{commit}' % commit],
+                      cwd=mirror_path)
+        except GitMirrorException:
+            return False
+        return True
+
+    def resolve(self, uri, ref):
+        # the commit a branch, tag or (abbreviated) commit id points to
+        mirror_path = self.update(uri, ref)
+        try:
+            return self._git(['rev-parse', '--verify', '--quiet',
+                              '%s^{commit}' % ref], cwd=mirror_path)
+        except GitMirrorException:
+            raise GitMirrorException(
+                'no branch, tag or commit %s in %s' % (ref, uri))
+
+    def contains(self, uri, commit, path):
+        mirror_path = self.update(uri, commit)
+        try:
+            self._git(['cat-file', '-e', '%s:%s' % (commit, path.strip('/'))],
+                      cwd=mirror_path)
+        except GitMirrorException:
+            return False
+        return True
+
+    def read(self, uri, commit, path):
+        # the contents of a file at commit, or None when it doesn't exist
+        mirror_path = self.update(uri, commit)
+        p = subprocess.Popen(
+            ['git', 'show', '%s:%s' % (commit, path.strip('/'))],
+            cwd=mirror_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            return None
+        return out
+
+    def commit_time(self, uri, commit):
+        # the committer date of commit, in seconds since the epoch
+        mirror_path = self.update(uri, commit)
+        return int(self._git(['show', '-s', '--format=%ct', commit],
+                             cwd=mirror_path))
+
+    def export(self, uri, commit, target_dir):
+        # a clone of the mirror checked out at the commit, with its history
+        # and tags, so tools taking the version from .git (git describe,
+        # setuptools_scm) work like in a clone of uri. Cloning a local path
+        # hardlinks the objects instead of copying them.
+        mirror_path = self.update(uri, commit)
+        self._git(['clone', '--quiet', '--no-checkout',
+                   os.path.abspath(mirror_path), target_dir])
+        self._git(['remote', 'set-url', 'origin', uri], cwd=target_dir)
+        self._git(['checkout', '--quiet', commit], cwd=target_dir)
+        logger.info('Exported %s at %s to: %s' % (uri, commit, target_dir))
+
+
+class GitMirrorException(Exception):
+    pass
@@ -0,0 +1,38 @@
+{#
+    Included by debian.sh when builds share a package cache. Sets APT_GET
+    to vdist_apt_get, which runs apt-get with the shared cache.
+#}
+# downloaded packages and package lists are shared with the other builds of
+# this profile through a directory on the host. Only updating the lists and
+# downloading take the lock on it: builds install from it at the same time,
+# each with a copy of the lists of its own, so they install what they
+# downloaded
+{% include 'package_cache.sh' %}
+mkdir -p $VDIST_PACKAGE_CACHE/archives/partial $VDIST_PACKAGE_CACHE/lists/partial
+rm -f /etc/apt/apt.conf.d/docker-clean
+VDIST_APT_ARCHIVES="-o Dir::Cache::Archives=$VDIST_PACKAGE_CACHE/archives"
+
+vdist_apt_update() {
+    apt-get -o Dir::State::Lists=$VDIST_PACKAGE_CACHE/lists update
+    rm -rf /var/lib/apt/lists
+    cp -a $VDIST_PACKAGE_CACHE/lists /var/lib/apt/lists
+}
+
+vdist_apt_get() {
+    case "$1" in
+        update)
+            vdist_cache_locked vdist_apt_update
+            ;;
+        install|build-dep|upgrade|dist-upgrade)
+            vdist_cache_locked apt-get $VDIST_APT_ARCHIVES --download-only "$@"
+            # apt locks the archives even when it has all it needs; should
+            # it still miss something, it's downloaded under the lock
+            apt-get $VDIST_APT_ARCHIVES -o Debug::NoLocking=1 "$@" || \
+                vdist_cache_locked apt-get $VDIST_APT_ARCHIVES "$@"
+            ;;
+        *)
+            apt-get "$@"
+            ;;
+    esac
+}
+APT_GET=vdist_apt_get
@@ -0,0 +1,24 @@
+{% if ccache_dir %}
+if ! command -v ccache > /dev/null; then
+    vdist_install ccache || true
+fi
+if command -v ccache > /dev/null; then
+    export CCACHE_DIR={{ccache_dir}}
+    export CCACHE_MAXSIZE={{ccache_max_size}}
+    # pip builds every package in another temporary dir, relative paths
+    # keep those from missing the cache
+    export CCACHE_BASEDIR=/
+    export CCACHE_NOHASHDIR=true
+    # compilers are found through links to ccache in front of PATH; CC
+    # stays unset, so configure doesn't write ccache into the sysconfig of
+    # the packaged Python
+    VDIST_CCACHE_LINKS=$(mktemp -d)
+    for compiler in cc gcc c++ g++; do
+        ln -s $(command -v ccache) $VDIST_CCACHE_LINKS/$compiler
+    done
+    export PATH=$VDIST_CCACHE_LINKS:$PATH
+    trap 'chown -R {{local_uid}}:{{local_gid}} {{ccache_dir}}' EXIT
+else
+    echo "ccache not available, compiling without it"
+fi
+{% endif %}
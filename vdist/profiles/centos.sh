@@ -5,38 +5,123 @@ PYTHON_BASEDIR="{{python_basedir}}"
 # fail on error
 set -e
 
-# install general prerequisites
-yum -y update
-yum install -y ruby-devel curl libyaml-devel which tar rpm-build rubygems git python-setuptools zlib-devel bzip2-devel openssl-devel ncurses-devel sqlite-devel readline-devel tk-devel gdbm-devel db4-devel libpcap-devel xz-devel epel-release
-yum -y install python34
-curl -O https://bootstrap.pypa.io/get-pip.py
-/usr/bin/python3 get-pip.py
-yum groupinstall -y "Development Tools"
-
-# install build dependencies needed for this specific build
-{% if build_deps %}
-yum install -y {{build_deps|join(' ')}}
+{% if reproducible %}
+# reproducible packages take their times from the source; sources checked
+# out in the build machine set SOURCE_DATE_EPOCH once they are
+{% if source_date_epoch is not none %}
+export SOURCE_DATE_EPOCH={{source_date_epoch}}
+{% endif %}
+export PYTHONHASHSEED=0
 {% endif %}
 
-# only install when needed, to save time with
-# pre-provisioned containers
-if [ ! -f /usr/bin/fpm ]; then
-    gem install fpm
+# vdist passes the share of the host's cores this build gets
+VDIST_JOBS=${VDIST_JOBS:-$(nproc)}
+export MAKEFLAGS="-j$VDIST_JOBS"
+# picked up by the build systems pip runs for packages with extensions
+export MAX_JOBS=$VDIST_JOBS
+export NPY_NUM_BUILD_JOBS=$VDIST_JOBS
+export CMAKE_BUILD_PARALLEL_LEVEL=$VDIST_JOBS
+
+# print machine readable phase markers; vdist parses these to report
+# how long every phase of the build took
+vdist_phase() {
+    echo "##vdist-phase $1 $2 $(date +%s.%N)"
+}
+
+{% if package_cache_dir %}
+{% include 'yum_cache.sh' %}
+{% else %}
+YUM="yum"
+{% endif %}
+
+# provisioning is skipped on images prewarmed by vdist (see
+# Builder.prewarm) for the same profile and build dependencies
+VDIST_PROVISIONED=false
+{% if provision_key %}
+if [ -f /etc/vdist-provisioned ] && [ "$(cat /etc/vdist-provisioned)" = "{{provision_key}}" ]; then
+    VDIST_PROVISIONED=true
 fi
+{% endif %}
 
-# install prerequisites
-easy_install virtualenv
+if ! $VDIST_PROVISIONED; then
+    # install general prerequisites
+    vdist_phase start provision
+    {% if package_cache_dir and system_update_interval %}
+    # skip the full system update when another build did one recently
+    if [ -n "$(find {{package_cache_dir}}/last-update -mmin -{{(system_update_interval * 60)|int}} 2>/dev/null)" ]; then
+        $YUM makecache
+    else
+        $YUM -y update
+        touch {{package_cache_dir}}/last-update
+    fi
+    {% else %}
+    $YUM -y update
+    {% endif %}
+    $YUM install -y ruby-devel curl libyaml-devel which tar rpm-build rubygems git python-setuptools zlib-devel bzip2-devel openssl-devel ncurses-devel sqlite-devel readline-devel tk-devel gdbm-devel db4-devel libpcap-devel xz-devel epel-release
+    $YUM -y install python34
+    curl -O https://bootstrap.pypa.io/get-pip.py
+    /usr/bin/python3 get-pip.py
+    $YUM groupinstall -y "Development Tools"
+    vdist_phase end provision
+
+    # install build dependencies needed for this specific build
+    {% if build_deps %}
+    vdist_phase start build_deps
+    $YUM install -y {{build_deps|join(' ')}}
+    vdist_phase end build_deps
+    {% endif %}
+
+    vdist_phase start install_fpm
+    # only install when needed, to save time with
+    # pre-provisioned containers
+    if [ ! -f /usr/bin/fpm ]; then
+        gem install fpm
+    fi
+    vdist_phase end install_fpm
+
+    # install prerequisites
+    easy_install virtualenv
+fi
+
+{% if provision_key %}
+# remember the provisioning, for prewarmed images and reused containers
+echo "{{provision_key}}" > /etc/vdist-provisioned
+{% endif %}
+
+{% if provision_only %}
+exit 0
+{% endif %}
+
+# installs the optional tools a build uses, after provisioning
+vdist_install() {
+    $YUM install -y "$@"
+}
+
+{% include 'ccache.sh' %}
 
 {% if compile_python %}
-    # compile and install python
-    cd /var/tmp
-    curl -O https://www.python.org/ftp/python/$PYTHON_VERSION/Python-$PYTHON_VERSION.tgz
-    tar xzvf Python-$PYTHON_VERSION.tgz
-    cd Python-$PYTHON_VERSION
-    ./configure --prefix=$PYTHON_BASEDIR
-    make && make install
+    vdist_phase start compile_python
+    PYTHON_CONFIGURE_FLAGS=(--prefix=$PYTHON_BASEDIR)
+
+    vdist_compile_python() {
+        # compile and install python
+        cd /var/tmp
+        curl -O https://www.python.org/ftp/python/$PYTHON_VERSION/Python-$PYTHON_VERSION.tgz
+        tar xzvf Python-$PYTHON_VERSION.tgz
+        cd Python-$PYTHON_VERSION
+        ./configure "${PYTHON_CONFIGURE_FLAGS[@]}"
+        make -j$VDIST_JOBS && make install
+    }
+
+    {% include 'compile_python.sh' %}
+    vdist_phase end compile_python
+{% endif %}
+
+{% if stop_after == 'compile_python' %}
+exit 0
 {% endif %}
 
+vdist_phase start fetch_source
 if [ ! -d {{package_tmp_root}} ]; then
     mkdir -p {{package_tmp_root}}
 fi
@@ -45,17 +130,35 @@ cd {{package_tmp_root}}
 
 {% if source.type == 'git' %}
 
+    {% if git_commit %}
+    # {{source.uri}} at {{git_commit}}, exported from a mirror on the host
+    cp -r {{source_mount}}/{{project_root}} .
+    cd {{project_root}}
+    {% else %}
     git clone {{source.uri}}
     cd {{project_root}}
     git checkout {{source.branch}}
+    {% if reproducible and source_date_epoch is none %}
+    export SOURCE_DATE_EPOCH=$(git log -1 --format=%ct)
+    {% endif %}
+    {% endif %}
 
 {% elif source.type in ['directory', 'git_directory'] %}
 
-    cp -r {{scratch_dir}}/{{project_root}} .
+    {% if source_files %}
+    # the source is mounted read-only, copy the files that aren't ignored;
+    # pipefail keeps a failing read from leaving a partial tree
+    (set -o pipefail; tar -C {{source_mount}} --null -T {{source_files}} -cf - | tar --no-same-owner -xf -)
+    {% else %}
+    cp -r {{source_mount}}/{{project_root}} .
+    {% endif %}
     cd {{package_tmp_root}}/{{project_root}}
 
     {% if source.type == 'git_directory' %}
         git checkout {{source.branch}}
+        {% if reproducible and source_date_epoch is none %}
+        export SOURCE_DATE_EPOCH=$(git log -1 --format=%ct)
+        {% endif %}
     {% endif %}
 
 {% else %}
@@ -78,6 +181,8 @@ cd {{package_tmp_root}}
     {% set project_root = working_dir %}
 {% endif %}
 
+vdist_phase end fetch_source
+
 # brutally remove virtualenv stuff from the current directory
 rm -rf bin include lib local
 
@@ -90,13 +195,21 @@ else
     PIP_BIN="$PYTHON_BASEDIR/bin/pip3"
 fi
 
+vdist_phase start install_requirements
 if [ -f "$PWD{{requirements_path}}" ]; then
     $PIP_BIN install -U pip setuptools
     virtualenv -p $PYTHON_BIN .
     source bin/activate
-    $PIP_BIN install {{pip_args}} -r $PWD{{requirements_path}}
+    {% include 'pip_install.sh' %}
 fi
 
+vdist_phase end install_requirements
+
+{% if stop_after == 'install_requirements' %}
+exit 0
+{% endif %}
+
+vdist_phase start install_app
 if [ -f "setup.py" ]; then
     $PYTHON_BIN setup.py install
     built=true
@@ -104,28 +217,20 @@ else
     built=false
 fi
 
+vdist_phase end install_app
+
 cd /
 
+{% include 'slim.sh' %}
+
+vdist_phase start package
 # get rid of VCS info
 find {{package_tmp_root}} -type d -name '.git' -print0 | xargs -0 rm -rf
 find {{package_tmp_root}} -type d -name '.svn' -print0 | xargs -0 rm -rf
 
-if $built; then
-    {% if custom_filename %}
-        fpm -s dir -t rpm -n {{app}} -p {{package_tmp_root}}/{{custom_filename}} -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} $PYTHON_BASEDIR
-    {% else %}
-        fpm -s dir -t rpm -n {{app}} -p {{package_tmp_root}} -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} $PYTHON_BASEDIR
-    {% endif %}
-    cp {{package_tmp_root}}/*rpm {{shared_dir}}
-else
-    mkdir -p {{package_install_root}}/{{app}}
-    cp -r {{package_tmp_root}}/{{app}}/* {{package_install_root}}/{{app}}/.
-    {% if custom_filename %}
-        fpm -s dir -t rpm -n {{app}} -p {{package_tmp_root}}/{{custom_filename}} -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} {{package_install_root}}/{{project_root}} $PYTHON_BASEDIR
-    {% else %}
-        fpm -s dir -t rpm -n {{app}} -p {{package_tmp_root}} -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} {{package_install_root}}/{{project_root}} $PYTHON_BASEDIR
-    {% endif %}
-    cp {{package_tmp_root}}/*rpm {{shared_dir}}
-fi
+{% set native_format = 'rpm' %}
+{% include 'package.sh' %}
+
+vdist_phase end package
 
 chown -R {{local_uid}}:{{local_gid}} {{shared_dir}}
@@ -0,0 +1,81 @@
+{#
+    Included by the build scripts to compile and install Python into
+    $PYTHON_BASEDIR. The including script defines PYTHON_CONFIGURE_FLAGS
+    (a bash array of ./configure arguments) and a vdist_compile_python
+    function doing the actual compile using those flags. PYTHON_SHARED=true
+    marks an --enable-shared build, which relies on rpath to find libpython.
+#}
+
+{% if optimize_python %}
+# profile guided optimization runs the test suite, so this takes a while
+PYTHON_CONFIGURE_FLAGS+=(--enable-optimizations --with-lto)
+{% endif %}
+
+PYTHON_CACHE_HIT=""
+
+{% if python_cache_dir %}
+# compiled interpreters are kept on the host, keyed by image, Python version
+# and configure flags; the prefix is left out of the key so other apps can
+# reuse the interpreter after relocating it
+PYTHON_CACHE_FLAGS="${PYTHON_CONFIGURE_FLAGS[*]}"
+PYTHON_CACHE_KEY=$(echo "{{python_cache_tag}} $PYTHON_VERSION ${PYTHON_CACHE_FLAGS//$PYTHON_BASEDIR/@PREFIX@}" | sha256sum | cut -d' ' -f1)
+PYTHON_PREFIX_KEY=$(echo "$PYTHON_BASEDIR" | sha256sum | cut -c1-16)
+PYTHON_CACHE_ENTRY="{{python_cache_dir}}/$PYTHON_CACHE_KEY-$PYTHON_PREFIX_KEY"
+
+# an interpreter compiled for another prefix can only be relocated when its
+# rpath can be rewritten
+PYTHON_RELOCATABLE=true
+if [ "$PYTHON_SHARED" = true ] && ! command -v patchelf > /dev/null; then
+    vdist_install patchelf || true
+    if ! command -v patchelf > /dev/null; then
+        PYTHON_RELOCATABLE=false
+    fi
+fi
+
+if [ -f "$PYTHON_CACHE_ENTRY.tar.gz" ]; then
+    PYTHON_CACHE_HIT="$PYTHON_CACHE_ENTRY"
+elif $PYTHON_RELOCATABLE; then
+    for entry in {{python_cache_dir}}/$PYTHON_CACHE_KEY-*.tar.gz; do
+        if [ -f "$entry" ]; then
+            PYTHON_CACHE_HIT="${entry%.tar.gz}"
+            break
+        fi
+    done
+fi
+{% endif %}
+
+if [ -n "$PYTHON_CACHE_HIT" ]; then
+    mkdir -p $PYTHON_BASEDIR
+    tar xzf "$PYTHON_CACHE_HIT.tar.gz" -C $PYTHON_BASEDIR
+    PYTHON_CACHED_PREFIX=$(cat "$PYTHON_CACHE_HIT.prefix")
+
+    if [ "$PYTHON_CACHED_PREFIX" != "$PYTHON_BASEDIR" ]; then
+        # the interpreter finds its prefix at runtime, only scripts,
+        # sysconfig data, Makefile and pkgconfig files hold the old one;
+        # it is only replaced where the path ends, so /opt/app doesn't turn
+        # /opt/app-data into something else
+        PYTHON_PREFIX_PATTERN=$(printf '%s' "$PYTHON_CACHED_PREFIX" | sed 's/[][\\.*^$+?(){}|#]/\\&/g')
+        PYTHON_PREFIX_REPLACEMENT=$(printf '%s' "$PYTHON_BASEDIR" | sed 's/[\\&#]/\\&/g')
+        find $PYTHON_BASEDIR -type f -exec grep -lI -- "$PYTHON_CACHED_PREFIX" {} + | xargs -r sed -i -E "s#$PYTHON_PREFIX_PATTERN([^A-Za-z0-9._+-]|\$)#$PYTHON_PREFIX_REPLACEMENT\1#g"
+
+        if [ "$PYTHON_SHARED" = true ]; then
+            for elf in $PYTHON_BASEDIR/bin/* $PYTHON_BASEDIR/lib/libpython*; do
+                if [ ! -L "$elf" ] && patchelf --print-rpath "$elf" > /dev/null 2>&1; then
+                    patchelf --set-rpath "\$ORIGIN/../lib:$PYTHON_BASEDIR/lib" "$elf"
+                fi
+            done
+        fi
+    fi
+else
+    vdist_compile_python
+
+    {% if python_cache_dir %}
+    # write under a temporary name first, concurrent builds may be
+    # compiling the same interpreter
+    tar czf "$PYTHON_CACHE_ENTRY.tar.gz.$HOSTNAME" -C $PYTHON_BASEDIR .
+    echo "$PYTHON_BASEDIR" > "$PYTHON_CACHE_ENTRY.prefix.$HOSTNAME"
+    mv "$PYTHON_CACHE_ENTRY.prefix.$HOSTNAME" "$PYTHON_CACHE_ENTRY.prefix"
+    mv "$PYTHON_CACHE_ENTRY.tar.gz.$HOSTNAME" "$PYTHON_CACHE_ENTRY.tar.gz"
+    chown {{local_uid}}:{{local_gid}} "$PYTHON_CACHE_ENTRY.tar.gz" "$PYTHON_CACHE_ENTRY.prefix"
+    {% endif %}
+fi
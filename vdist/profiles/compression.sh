@@ -0,0 +1,67 @@
+{#
+    Included by package.sh. Sets FPM_DEB_COMPRESSION_ARGS and
+    FPM_RPM_COMPRESSION_ARGS to the fpm arguments selecting the compression
+    of the build, and TAR_EXTENSION to the extension of tarballs. Debs and
+    tarballs are compressed by the compressors tar runs for fpm, so those
+    get wrapped (see vdist_wrap in package.sh), using a parallel compressor
+    when there is one and passing the compression level. Rpms are compressed
+    by rpmbuild itself.
+#}
+FPM_DEB_COMPRESSION_ARGS=()
+FPM_RPM_COMPRESSION_ARGS=()
+TAR_EXTENSION=tar.gz
+{% if compression %}
+{% set level = '-%d' % compression_level if compression_level is not none else '' %}
+{% if 'deb' in package_formats or 'tar' in package_formats %}
+{% if reproducible %}
+# threaded compressors may write other bytes for another number of threads,
+# so reproducible builds use the same number on every host
+COMPRESS_JOBS=4
+{% else %}
+COMPRESS_JOBS=$VDIST_JOBS
+{% endif %}
+
+{% if compression == 'gzip' %}
+command -v pigz > /dev/null || vdist_install pigz || true
+if command -v pigz > /dev/null; then
+    vdist_wrap gzip $(command -v pigz) -p $COMPRESS_JOBS{% if reproducible %} -n{% endif %} {{level}}
+else
+    vdist_wrap gzip $(command -v gzip){% if reproducible %} -n{% endif %} {{level}}
+fi
+FPM_DEB_COMPRESSION_ARGS=(--deb-compression gz)
+{% elif compression == 'xz' %}
+# xz compresses with threads since 5.2, pxz does on older systems
+if xz -T $COMPRESS_JOBS -c < /dev/null > /dev/null 2>&1; then
+    vdist_wrap xz $(command -v xz) -T $COMPRESS_JOBS {{level}}
+else
+    command -v pxz > /dev/null || vdist_install pxz || true
+    if command -v pxz > /dev/null; then
+        vdist_wrap xz $(command -v pxz) -T $COMPRESS_JOBS {{level}}
+    else
+        vdist_wrap xz $(command -v xz) {{level}}
+    fi
+fi
+FPM_DEB_COMPRESSION_ARGS=(--deb-compression xz)
+TAR_EXTENSION=tar.xz
+{% elif compression == 'zstd' %}
+# only fpm 1.15 and newer build zstd compressed debs, and only dpkg 1.21.18
+# and newer install them
+command -v zstd > /dev/null || vdist_install zstd
+vdist_wrap zstd $(command -v zstd) -T$COMPRESS_JOBS {{level}}
+FPM_DEB_COMPRESSION_ARGS=(--deb-compression zst)
+# fpm doesn't compress tarballs with zstd, package.sh does that afterwards
+TAR_EXTENSION=tar.zst
+{% endif %}
+{% endif %}
+
+{% if 'rpm' in package_formats %}
+{% if compression == 'zstd' %}
+echo "zstd compressed rpms are not supported" >&2
+exit 1
+{% endif %}
+FPM_RPM_COMPRESSION_ARGS=(--rpm-compression {{compression}})
+{% if compression_level is not none %}
+FPM_RPM_COMPRESSION_ARGS+=(--rpm-compression-level {{compression_level}})
+{% endif %}
+{% endif %}
+{% endif %}
@@ -0,0 +1,69 @@
+{#
+    Included by the build scripts to package the installed app with fpm, in
+    all formats of the build at the same time. The including script sets
+    native_format to the package format of the profile, which is the
+    default, and the only one custom_filename applies to.
+#}
+{% set package_formats = formats or [native_format] %}
+
+# wrappers for the tools fpm runs go in front of PATH
+VDIST_WRAPPERS=$(mktemp -d)
+export PATH=$VDIST_WRAPPERS:$PATH
+
+vdist_wrap() {
+    # vdist_wrap NAME COMMAND...: fpm runs COMMAND instead of NAME
+    local name=$1
+    shift
+    printf '#!/bin/sh\nexec %s "$@"\n' "$*" > $VDIST_WRAPPERS/$name
+    chmod +x $VDIST_WRAPPERS/$name
+}
+
+{% include 'compression.sh' %}
+
+if $built; then
+    PACKAGE_PATHS=($PYTHON_BASEDIR)
+else
+    mkdir -p {{package_install_root}}/{{app}}
+    cp -r {{package_tmp_root}}/{{app}}/* {{package_install_root}}/{{app}}/.
+    PACKAGE_PATHS=({{package_install_root}}/{{project_root}} $PYTHON_BASEDIR)
+fi
+
+{% include 'reproducible.sh' %}
+
+{% if 'rpm' in package_formats and native_format != 'rpm' %}
+command -v rpmbuild > /dev/null || vdist_install rpm
+{% endif %}
+
+vdist_package() {
+    # vdist_package FORMAT OUTPUT FPM_ARGS...
+    local format=$1
+    local output=$2
+    shift 2
+    fpm -s dir -t $format "$@" -n {{app}} -p $output -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} "${PACKAGE_PATHS[@]}"
+}
+
+vdist_phase start fpm
+# every format gets its own output dir, and its own fpm running in the
+# background
+PACKAGE_PIDS=()
+{% for format in package_formats %}
+mkdir -p {{package_tmp_root}}/vdist-{{format}}
+{% if format == 'deb' %}
+vdist_package deb {{package_tmp_root}}/vdist-deb{% if custom_filename and format == native_format %}/{{custom_filename}}{% endif %} "${FPM_DEB_COMPRESSION_ARGS[@]}" "${FPM_DEB_REPRODUCIBLE_ARGS[@]}" &
+{% elif format == 'rpm' %}
+vdist_package rpm {{package_tmp_root}}/vdist-rpm{% if custom_filename and format == native_format %}/{{custom_filename}}{% endif %} "${FPM_RPM_COMPRESSION_ARGS[@]}" "${FPM_RPM_REPRODUCIBLE_ARGS[@]}" &
+{% elif compression == 'zstd' %}
+(vdist_package tar {{package_tmp_root}}/vdist-tar/{{app}}-{{version}}.tar && zstd -q --rm {{package_tmp_root}}/vdist-tar/{{app}}-{{version}}.tar) &
+{% else %}
+vdist_package tar {{package_tmp_root}}/vdist-tar/{{app}}-{{version}}.$TAR_EXTENSION &
+{% endif %}
+PACKAGE_PIDS+=($!)
+{% endfor %}
+for pid in "${PACKAGE_PIDS[@]}"; do
+    wait $pid
+done
+vdist_phase end fpm
+
+{% for format in package_formats %}
+cp {{package_tmp_root}}/vdist-{{format}}/* {{shared_dir}}
+{% endfor %}
@@ -0,0 +1,21 @@
+{#
+    Included by apt_cache.sh and yum_cache.sh. Defines vdist_cache_locked,
+    which runs a command holding the lock on the package cache the builds
+    of a profile share.
+#}
+VDIST_PACKAGE_CACHE={{package_cache_dir}}
+mkdir -p $VDIST_PACKAGE_CACHE
+
+vdist_cache_locked() {
+    # the files the command adds to the cache are handed to the user
+    # running vdist, so they can be cleaned up from the host
+    (
+        flock 9
+        local marker status=0
+        marker=$(mktemp)
+        "$@" || status=$?
+        find $VDIST_PACKAGE_CACHE -cnewer $marker ! -user {{local_uid}} -exec chown -h {{local_uid}}:{{local_gid}} {} +
+        rm -f $marker
+        exit $status
+    ) 9> $VDIST_PACKAGE_CACHE/lock
+}
@@ -0,0 +1,46 @@
+{#
+    Included by the build scripts to install the pip requirements with
+    $PIP_BIN. When a wheelhouse is mounted, requirements are installed from
+    it, and wheels that are missing are built and added to it.
+#}
+{% if wheelhouse_dir %}
+# wheels are kept on the host per profile and Python ABI
+PYTHON_ABI=$($PYTHON_BIN -c "import sys, sysconfig; print(sysconfig.get_config_var('SOABI') or 'cp%d%d' % sys.version_info[:2])")
+WHEELHOUSE="{{wheelhouse_dir}}/$PYTHON_ABI"
+mkdir -p $WHEELHOUSE
+
+# pinned requirements are what the index would give as well, so when every
+# requirement is pinned and in the wheelhouse already, no index is needed;
+# anything else (like an included file) gets resolved against the index
+REQUIREMENTS_UNPINNED=$(sed -e 's/[[:space:]]*#.*//' $PWD{{requirements_path}} | grep -vE '^[[:space:]]*$' | grep -vE '^[[:space:]]*[^-[:space:]][^;]*==' || true)
+if [ -n "$REQUIREMENTS_UNPINNED" ] || ! $PIP_BIN install {{pip_args}} --no-index --find-links $WHEELHOUSE -r $PWD{{requirements_path}}; then
+    WHEEL_TMP=$(mktemp -d)
+    # building wheels needs wheel, which isn't to end up in the package
+    WHEEL_INSTALLED=false
+    if ! $PIP_BIN freeze | grep -i '^wheel==' > /dev/null; then
+        $PIP_BIN install wheel
+        WHEEL_INSTALLED=true
+    fi
+    $PIP_BIN wheel {{pip_args}} --find-links $WHEELHOUSE -w $WHEEL_TMP -r $PWD{{requirements_path}}
+
+    # copy under a temporary name first, concurrent builds may be adding
+    # the same wheels
+    for wheel in $WHEEL_TMP/*.whl; do
+        wheel_name=$(basename $wheel)
+        if [ -f "$wheel" ] && [ ! -f "$WHEELHOUSE/$wheel_name" ]; then
+            cp $wheel "$WHEELHOUSE/.$wheel_name.$HOSTNAME"
+            chown {{local_uid}}:{{local_gid}} "$WHEELHOUSE/.$wheel_name.$HOSTNAME"
+            mv "$WHEELHOUSE/.$wheel_name.$HOSTNAME" "$WHEELHOUSE/$wheel_name"
+        fi
+    done
+
+    if $WHEEL_INSTALLED; then
+        $PIP_BIN uninstall -y wheel
+    fi
+    $PIP_BIN install {{pip_args}} --no-index --find-links $WHEEL_TMP --find-links $WHEELHOUSE -r $PWD{{requirements_path}}
+    rm -rf $WHEEL_TMP
+fi
+chown {{local_uid}}:{{local_gid}} $WHEELHOUSE
+{% else %}
+$PIP_BIN install {{pip_args}} -r $PWD{{requirements_path}}
+{% endif %}
@@ -0,0 +1,49 @@
+{#
+    Included by package.sh once PACKAGE_PATHS is set. Sets
+    FPM_DEB_REPRODUCIBLE_ARGS and FPM_RPM_REPRODUCIBLE_ARGS to the fpm
+    arguments of the build; in reproducible mode, the packaged files are
+    made the same on every build first: bytecode is compiled again, and all
+    files get SOURCE_DATE_EPOCH as their time and root as their owner. The
+    archives fpm writes then sort their members and leave out build times,
+    owner names and the build host.
+#}
+FPM_DEB_REPRODUCIBLE_ARGS=()
+FPM_RPM_REPRODUCIBLE_ARGS=()
+{% if reproducible %}
+vdist_phase start reproducible
+export SOURCE_DATE_EPOCH=${SOURCE_DATE_EPOCH:-0}
+
+# bytecode holds the time of its source, so sources get their time before
+# compiling; Python 3.7 and newer hash the source instead when
+# SOURCE_DATE_EPOCH is set
+find "${PACKAGE_PATHS[@]}" -exec touch -h -d @$SOURCE_DATE_EPOCH {} +
+find "${PACKAGE_PATHS[@]}" -type f \( -name '*.pyc' -o -name '*.pyo' \) -delete
+$PYTHON_BIN -m compileall -q -f "${PACKAGE_PATHS[@]}" > /dev/null || true
+find "${PACKAGE_PATHS[@]}" -exec touch -h -d @$SOURCE_DATE_EPOCH {} +
+chown -hR 0:0 "${PACKAGE_PATHS[@]}"
+
+# tar writes debs and tarballs; sorting members needs tar 1.28 or newer
+TAR_OPTIONS="--owner=0 --group=0 --numeric-owner --mtime=@$SOURCE_DATE_EPOCH"
+if tar --sort=name -cf /dev/null /dev/null 2> /dev/null; then
+    TAR_OPTIONS="--sort=name $TAR_OPTIONS"
+else
+    echo "tar can't sort archive members, packages may differ between builds"
+fi
+export TAR_OPTIONS
+
+# ar puts the parts of a deb together, its D modifier leaves out their
+# times and owners
+VDIST_AR=$(command -v ar || true)
+if [ -n "$VDIST_AR" ]; then
+    printf '#!/bin/sh\nmodifiers=$1\nshift\nexec %s ${modifiers}D "$@"\n' "$VDIST_AR" > $VDIST_WRAPPERS/ar
+    chmod +x $VDIST_WRAPPERS/ar
+fi
+
+FPM_DEB_REPRODUCIBLE_ARGS=(--deb-user root --deb-group root)
+# the rpmbuild macros need rpm 4.14 or newer, older ones ignore them
+FPM_RPM_REPRODUCIBLE_ARGS=(--rpm-user root --rpm-group root
+    --rpm-rpmbuild-define "clamp_mtime_to_source_date_epoch 1"
+    --rpm-rpmbuild-define "use_source_date_epoch_as_buildtime 1"
+    --rpm-rpmbuild-define "_buildhost vdist")
+vdist_phase end reproducible
+{% endif %}
@@ -0,0 +1,93 @@
+{#
+    Included by the build scripts before packaging, to leave what isn't
+    needed at runtime out of $PYTHON_BASEDIR. Every step prints the bytes it
+    saved in a line like
+        ##vdist-slim strip 1048576
+    which vdist collects per build.
+#}
+{% if slim or slim_globs %}
+vdist_phase start slim
+
+vdist_slim_size() {
+    du -sb $PYTHON_BASEDIR | cut -f1
+}
+
+vdist_slim() {
+    # runs a step, and reports how many bytes it saved
+    local step=$1
+    local before=$(vdist_slim_size)
+    vdist_slim_$step
+    echo "##vdist-slim $step $(($before - $(vdist_slim_size)))"
+}
+
+{% if 'strip' in slim %}
+vdist_slim_strip() {
+    # debug symbols of the interpreter and of compiled extensions
+    if command -v strip > /dev/null; then
+        find $PYTHON_BASEDIR -type f \( -name '*.so' -o -name '*.so.*' -o -path '*/bin/*' \) -exec strip --strip-unneeded {} + 2> /dev/null || true
+    fi
+}
+vdist_slim strip
+{% endif %}
+
+{% if 'tests' in slim %}
+vdist_slim_tests() {
+    # the test suites and documentation of the standard library
+    find $PYTHON_BASEDIR/lib/python* -depth -type d -not -path '*/site-packages/*' \( -path '*/lib/python*/test' -o -name tests -o -name test -o -name idle_test -o -name pydoc_data \) -exec rm -rf {} +
+    rm -rf $PYTHON_BASEDIR/share/man
+}
+vdist_slim tests
+{% endif %}
+
+{% if 'gui' in slim %}
+vdist_slim_gui() {
+    # IDLE, tkinter and turtle, which need a display anyway
+    rm -rf $PYTHON_BASEDIR/lib/python*/idlelib $PYTHON_BASEDIR/lib/python*/tkinter $PYTHON_BASEDIR/lib/python*/lib-tk $PYTHON_BASEDIR/lib/python*/turtledemo $PYTHON_BASEDIR/lib/python*/turtle.py* $PYTHON_BASEDIR/lib/python*/lib-dynload/_tkinter* $PYTHON_BASEDIR/bin/idle*
+}
+vdist_slim gui
+{% endif %}
+
+{% if 'static' in slim %}
+vdist_slim_static() {
+    find $PYTHON_BASEDIR -type f -name 'libpython*.a' -delete
+}
+vdist_slim static
+{% endif %}
+
+{% if 'headers' in slim %}
+vdist_slim_headers() {
+    # only needed to compile extensions against this Python
+    rm -rf $PYTHON_BASEDIR/include
+}
+vdist_slim headers
+{% endif %}
+
+{% if 'bytecode' in slim %}
+vdist_slim_bytecode() {
+    # bytecode of other Pythons, and optimized bytecode, which is only
+    # used with python -O
+    PYTHON_CACHE_TAG=$($PYTHON_BIN -c "import sys; print(getattr(getattr(sys, 'implementation', None), 'cache_tag', ''))")
+    if [ -n "$PYTHON_CACHE_TAG" ]; then
+        find $PYTHON_BASEDIR -type f -path '*/__pycache__/*.pyc' \( -not -name "*.$PYTHON_CACHE_TAG.pyc" -o -name '*.opt-*.pyc' \) -delete
+    fi
+    find $PYTHON_BASEDIR -type f -name '*.pyo' -delete
+}
+vdist_slim bytecode
+{% endif %}
+
+{% if slim_globs %}
+vdist_slim_globs() {
+    # patterns relative to $PYTHON_BASEDIR, ** matches any number of dirs
+    (
+        shopt -s globstar nullglob
+        cd $PYTHON_BASEDIR
+        {% for pattern in slim_globs %}
+        rm -rf -- {{pattern}}
+        {% endfor %}
+    )
+}
+vdist_slim globs
+{% endif %}
+
+vdist_phase end slim
+{% endif %}
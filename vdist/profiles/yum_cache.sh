@@ -0,0 +1,27 @@
+{#
+    Included by the CentOS build scripts when builds share a package cache.
+    Sets YUM to vdist_yum, which runs yum with the shared cache.
+#}
+# downloaded packages and repository metadata are shared with the other
+# builds of this profile through a directory on the host. Only downloading
+# takes the lock on it: builds install from it at the same time
+{% include 'package_cache.sh' %}
+VDIST_YUM="yum --setopt=cachedir=$VDIST_PACKAGE_CACHE/\$basearch/\$releasever --setopt=keepcache=1"
+
+vdist_yum() {
+    case " $* " in
+        *" install "*|*" groupinstall "*|*" update "*|*" upgrade "*)
+            # some versions of yum exit with 1 after only downloading, so
+            # installing from the cache tells whether that worked
+            vdist_cache_locked $VDIST_YUM --downloadonly "$@" || true
+            # metadata another build refreshed in the meantime may ask for
+            # packages this build didn't download, that is done under the
+            # lock
+            $VDIST_YUM -C "$@" || vdist_cache_locked $VDIST_YUM "$@"
+            ;;
+        *)
+            vdist_cache_locked $VDIST_YUM "$@"
+            ;;
+    esac
+}
+YUM=vdist_yum
@@ -0,0 +1,148 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+
+from vdist import defaults
+
+
+logger = logging.getLogger('Scheduler')
+
+
+def _free_memory_mb():
+    # MemAvailable is only present on Linux >= 3.14; fall back to
+    # MemFree + Cached on older kernels, and give up on other platforms
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = {}
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+    except (IOError, OSError, ValueError):
+        return None
+
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable'] // 1024
+    return (meminfo.get('MemFree', 0) + meminfo.get('Cached', 0)) // 1024
+
+
+def _load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def auto_max_workers():
+    # start with the number of cores that are not already busy according
+    # to the load average, and cap that by the memory that is available
+    # per build
+    workers = int(_cpu_count() - _load_average())
+
+    free_memory = _free_memory_mb()
+    if free_memory is not None:
+        workers = min(workers,
+                      free_memory // defaults.AUTO_WORKERS_MEMORY_PER_BUILD)
+
+    return max(1, workers)
+
+
+def resolve_max_workers(max_workers, build_count):
+    if max_workers in (None, 'auto'):
+        max_workers = auto_max_workers()
+    else:
+        max_workers = int(max_workers)
+        if max_workers < 1:
+            raise ValueError('max_workers should be at least 1 or "auto"')
+    return max(1, min(max_workers, build_count))
+
+
+def host_resources():
+    # the cores of this host and the MiB of memory available on it, or
+    # None for the memory when it is unknown
+    return float(_cpu_count()), _free_memory_mb()
+
+
+def partition_resources(resources, concurrent_builds):
+    # splits resources (see host_resources) evenly over the builds running
+    # at the same time; returns the cores (a fraction when they don't
+    # divide evenly) and the MiB of memory per build
+    cpus, memory = resources
+    cpus = cpus / concurrent_builds
+    if memory is not None:
+        memory = max(memory // concurrent_builds, defaults.MIN_BUILD_MEMORY)
+    return cpus, memory
+
+
+def build_jobs(cpus):
+    # the number of parallel compile jobs for a share of the cores
+    return max(1, int(round(cpus)))
+
+
+class BuildDurations(object):
+    # durations of earlier builds, used to schedule the longest builds
+    # first; they are keyed on the inputs that dominate the build time
+    # rather than on the build name, so a new version of the same app
+    # still gets a sensible estimate
+
+    # rough estimates in seconds for builds that never ran on this host
+    DEFAULT_ESTIMATE = 300
+    COMPILE_PYTHON_ESTIMATE = 600
+    PROFILE_ESTIMATES = {
+        'centos6': 300,
+    }
+
+    def __init__(self, path=defaults.BUILD_DURATIONS_FILE):
+        self.path = path
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(build):
+        return '|'.join([build.app, build.profile, build.python_version,
+                         str(build.compile_python)])
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return self
+        try:
+            with open(self.path) as f:
+                self.durations = json.loads(f.read())
+        except (IOError, ValueError):
+            logger.warning('ignoring unreadable durations file: %s' %
+                           self.path)
+            self.durations = {}
+        return self
+
+    def save(self):
+        with self.lock:
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(self.durations, indent=4, sort_keys=True))
+            os.rename(tmp_path, self.path)
+
+    def record(self, build, seconds):
+        with self.lock:
+            self.durations[self._key(build)] = seconds
+
+    def expected(self, build):
+        key = self._key(build)
+        if key in self.durations:
+            return self.durations[key]
+
+        estimate = self.DEFAULT_ESTIMATE
+        estimate += self.PROFILE_ESTIMATES.get(build.profile, 0)
+        if build.compile_python:
+            estimate += self.COMPILE_PYTHON_ESTIMATE
+        return estimate
+
+    def longest_first(self, builds):
+        return sorted(builds, key=self.expected, reverse=True)
@@ -0,0 +1,76 @@
+import collections
+import threading
+
+from concurrent.futures import Future
+
+
+class StageGraph(object):
+    # stages keyed on what they produce; adding a stage that is in the
+    # graph already returns the existing one, so every stage shared by
+    # several builds runs once
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def add(self, key, func, depends_on=(), on_dependency_failure=None):
+        # func runs once all stages it depends on succeeded; when one of
+        # them failed, on_dependency_failure (if given) is called with the
+        # exception instead, and otherwise the stage fails with it as well
+        if key not in self.stages:
+            self.stages[key] = (
+                func,
+                [dependency for dependency in depends_on
+                 if dependency is not None],
+                on_dependency_failure)
+        return key
+
+    def run(self, executor):
+        # returns a future per stage; stages are submitted to the executor
+        # once they can run, so a stage waiting for another never occupies
+        # a worker
+        futures = collections.OrderedDict(
+            (key, Future()) for key in self.stages)
+        for key, (func, depends_on, on_dependency_failure) in \
+                self.stages.items():
+            self._schedule(executor, futures[key], func,
+                           [futures[dependency] for dependency in depends_on],
+                           on_dependency_failure)
+        return futures
+
+    @staticmethod
+    def _submit(executor, future, func, *args):
+        def copy_outcome(inner):
+            if inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+
+        executor.submit(func, *args).add_done_callback(copy_outcome)
+
+    def _schedule(self, executor, future, func, dependencies,
+                  on_dependency_failure):
+        lock = threading.Lock()
+        waiting = [len(dependencies)]
+
+        def start():
+            failed = [d.exception() for d in dependencies
+                      if d.exception() is not None]
+            if not failed:
+                self._submit(executor, future, func)
+            elif on_dependency_failure is not None:
+                self._submit(executor, future, on_dependency_failure,
+                             failed[0])
+            else:
+                future.set_exception(failed[0])
+
+        def dependency_done(_):
+            with lock:
+                waiting[0] -= 1
+                ready = waiting[0] == 0
+            if ready:
+                start()
+
+        if not dependencies:
+            start()
+        for dependency in dependencies:
+            dependency.add_done_callback(dependency_done)
@@ -0,0 +1,318 @@
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger('Staging')
+
+IGNORE_FILES = ['.gitignore', '.vdistignore']
+VCS_DIRS = ['.git', '.svn']
+
+# ioctl cloning a file on copy-on-write filesystems like btrfs and xfs
+FICLONE = 0x40049409
+
+
+def _glob_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            charset = pattern[i + 1:end].replace('\\', '\\\\')
+            if charset.startswith('!'):
+                charset = '^' + charset[1:]
+            regex += '[%s]' % charset
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r'\Z')
+
+
+class IgnoreRules(object):
+    # the patterns of .gitignore files (and .vdistignore files, which use
+    # the same syntax); like git, the last matching pattern wins, and
+    # patterns only apply below the directory of the file they are in.
+    # Like in git, patterns of .gitignore files don't apply to files git
+    # tracks.
+
+    def __init__(self):
+        self.rules = []
+
+    def add_pattern(self, pattern, base='', untracked_only=False):
+        pattern = pattern.rstrip('\n').rstrip()
+        if not pattern or pattern.startswith('#'):
+            return
+
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # patterns without a slash match a name at any depth
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        if not pattern:
+            return
+
+        self.rules.append((base, _glob_to_regex(pattern), negate, dir_only,
+                           anchored, untracked_only))
+
+    def add_file(self, path, base='', untracked_only=False):
+        with open(path) as f:
+            for line in f:
+                self.add_pattern(line, base, untracked_only)
+
+    def ignored(self, rel_path, is_dir=False, tracked=False):
+        ignored = False
+        for base, regex, negate, dir_only, anchored, untracked_only in \
+                self.rules:
+            if dir_only and not is_dir:
+                continue
+            if untracked_only and tracked:
+                continue
+            if base:
+                if not rel_path.startswith(base + '/'):
+                    continue
+                path = rel_path[len(base) + 1:]
+            else:
+                path = rel_path
+            if not anchored:
+                path = path.rsplit('/', 1)[-1]
+            if regex.match(path):
+                ignored = not negate
+        return ignored
+
+
+def _tracked_files(path):
+    # the files (relative to path) git tracks below path, and the
+    # directories holding them; both are empty outside a git work tree
+    try:
+        p = subprocess.Popen(['git', 'ls-files', '-z'], cwd=path,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return set(), set()
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return set(), set()
+
+    files = set(f for f in out.decode('utf-8', 'replace').split('\0') if f)
+    dirs = set()
+    for rel_path in files:
+        while '/' in rel_path:
+            rel_path = rel_path.rsplit('/', 1)[0]
+            dirs.add(rel_path)
+    return files, dirs
+
+
+def _in_cycle(root, path, real_roots):
+    # whether root is a symlink to one of the directories it is in
+    parent = root
+    while parent != path:
+        parent = os.path.dirname(parent)
+        if real_roots.get(parent) == real_roots[root]:
+            return True
+    return False
+
+
+def source_files(path, include_vcs=False):
+    # yields the paths (relative to path) of all files and symlinks that
+    # aren't ignored; ignored directories aren't entered at all, and
+    # neither are symlinks to a directory they are in
+    path = os.path.normpath(path)
+    rules = IgnoreRules()
+    tracked_files, tracked_dirs = _tracked_files(path)
+    real_roots = {}
+    tracked_only = set()
+    for root, dirs, files in os.walk(path, followlinks=True):
+        real_roots[root] = os.path.realpath(root)
+        if _in_cycle(root, path, real_roots):
+            dirs[:] = []
+            continue
+
+        rel_root = os.path.relpath(root, path).replace(os.sep, '/')
+        if rel_root == '.':
+            rel_root = ''
+
+        for ignore_file in IGNORE_FILES:
+            if ignore_file in files:
+                rules.add_file(os.path.join(root, ignore_file), rel_root,
+                               untracked_only=ignore_file == '.gitignore')
+
+        def rel(name):
+            return '%s/%s' % (rel_root, name) if rel_root else name
+
+        # ignore files don't apply to the VCS metadata itself
+        if set(rel_root.split('/')) & set(VCS_DIRS):
+            dirs.sort()
+            for name in sorted(files):
+                yield rel(name)
+            continue
+
+        # a directory .gitignore ignores is still entered for the files git
+        # tracks in it, but its other files are left out
+        only_tracked = rel_root in tracked_only
+        entered = []
+        for d in dirs:
+            if d in VCS_DIRS:
+                if include_vcs:
+                    entered.append(d)
+                continue
+            tracked = rel(d) in tracked_dirs
+            if (only_tracked and not tracked) or \
+                    rules.ignored(rel(d), is_dir=True, tracked=tracked):
+                continue
+            if only_tracked or rules.ignored(rel(d), is_dir=True):
+                tracked_only.add(rel(d))
+            entered.append(d)
+        dirs[:] = sorted(entered)
+
+        for name in sorted(files):
+            tracked = rel(name) in tracked_files
+            if (only_tracked and not tracked) or \
+                    rules.ignored(rel(name), tracked=tracked):
+                continue
+            yield rel(name)
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except (IOError, OSError):
+                failed = True
+            else:
+                failed = False
+    if failed:
+        os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def _stage_file(src, dst, methods):
+    # tries a reflink first, then a hardlink, and copies the file when
+    # neither works. A reflink shares the data until either file changes.
+    # A hardlink is the source file itself: writing to a hardlinked file
+    # in the staged tree changes the source, so staged files must never be
+    # edited in place (the shared sources are bound read-only, and build
+    # scripts copy them before building). Changing the owner of one changes
+    # the source too, and the build scripts chown the build dir, so only
+    # files we own already are hardlinked. Methods the filesystem doesn't
+    # support are removed from methods, so they're only tried once per
+    # tree.
+    if 'reflink' in methods:
+        if _reflink(src, dst):
+            return 'reflinked'
+        methods.remove('reflink')
+    if 'hardlink' in methods and os.stat(src).st_uid == os.getuid():
+        try:
+            os.link(src, dst)
+            return 'hardlinked'
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                methods.remove('hardlink')
+    shutil.copy2(src, dst)
+    return 'copied'
+
+
+def stage_tree(src, dst, include_vcs=False):
+    # like shutil.copytree, but skips ignored files and links files
+    # instead of copying them where the filesystem allows it
+    methods = ['hardlink']
+    if fcntl is not None:
+        methods.insert(0, 'reflink')
+    counts = {'reflinked': 0, 'hardlinked': 0, 'copied': 0}
+
+    os.makedirs(dst)
+    for rel_path in source_files(src, include_vcs):
+        src_path = os.path.realpath(os.path.join(src, rel_path))
+        dst_path = os.path.join(dst, rel_path)
+        dst_dir = os.path.dirname(dst_path)
+        try:
+            os.makedirs(dst_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        counts[_stage_file(src_path, dst_path, methods)] += 1
+
+    logger.info('Staged %s: %d reflinked, %d hardlinked, %d copied' %
+                (src, counts['reflinked'], counts['hardlinked'],
+                 counts['copied']))
+    return counts
+
+
+def write_file_list(src, path, prefix='', include_vcs=False):
+    # a NUL separated list of the files to copy, for tar --null -T
+    with open(path, 'wb') as f:
+        for rel_path in source_files(src, include_vcs):
+            f.write(('%s%s' % (prefix, rel_path)).encode('utf-8') + b'\0')
+
+
+class SharedSources(object):
+    # prepares every distinct source once, for all builds using it; a
+    # build waits for the preparation of its own source only, so a slow
+    # clone doesn't hold up builds of other sources
+
+    def __init__(self, path):
+        self.path = path
+        self.prepared = {}
+        self.lock = threading.Lock()
+
+    def source_dir(self, key):
+        # the directory the source with key is prepared in
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:16])
+
+    def prepare(self, key, stage):
+        # calls stage with the directory to prepare the source in, unless
+        # another build prepares the same source already; returns that
+        # directory
+        with self.lock:
+            future = self.prepared.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.prepared[key] = future
+
+        if owner:
+            source_dir = self.source_dir(key)
+            try:
+                if os.path.exists(source_dir):
+                    shutil.rmtree(source_dir)
+                os.makedirs(source_dir)
+                stage(source_dir)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(source_dir)
+
+        return future.result()